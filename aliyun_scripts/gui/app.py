@@ -1,63 +1,76 @@
+import queue
 import tkinter as tk
 from argparse import ArgumentParser
-
-from aliyun_scripts.lib.actions import shutdown_ecs, start_ecs
-from aliyun_scripts.lib.utils import get_client_config_and_ecs, update_config
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, List
+
+from aliyun_scripts.lib.actions import (
+    add_state_listener,
+    get_available_ecs,
+    shutdown_ecs,
+    start_ecs,
+)
+from aliyun_scripts.lib.instances import EcsInstance, EcsStatus
+from aliyun_scripts.lib.snapshot import StateSnapshot
+from aliyun_scripts.lib.utils import (
+    SNAPSHOT,
+    get_client_config_and_ecs,
+    update_config,
+    wait_ecs_status,
+)
 from aliyun_scripts.tools.eip_tool import (
-    load_config_and_unbind_allocate_and_bind_new_eip,
+    get_eip_config,
+    unbind_allocate_and_bind_new_eip,
     unbind_release,
 )
 
+# Describe results are cached for a few seconds, so most refreshes are free
+REFRESH_INTERVAL_MS = 5000
+POLL_INTERVAL_MS = 100
+MAX_LOG_LINES = 200
+
 
 class Application(tk.Frame):
     def __init__(self, master=None):
         super().__init__(master)
         self.master = master
         self.pack(ipadx=2, ipady=2, padx=20, pady=20)
-        self.client, _, self.ecs = get_client_config_and_ecs()
+        self.client, self.config, self.ecs = get_client_config_and_ecs()
+        # Api calls run on the workers; Tk may only be used from the main loop,
+        # so the workers hand callbacks back through this queue
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.callbacks: "queue.Queue[Callable[[], Any]]" = queue.Queue()
+        self.busy = False
+        self.refreshing = False
         self.create_widgets()
+        self.after(POLL_INTERVAL_MS, self.process_callbacks)
+        self.after(REFRESH_INTERVAL_MS, self.auto_refresh)
 
     def create_widgets(self):
         self.btns = tk.Frame(self)
         self.btns.pack(side="top")
-
-        self.status_btn = tk.Button(self.btns)
-        self.status_btn["text"] = f"Refresh"
-        self.status_btn["command"] = self.get_status
-        self.status_btn.pack(side="left")
-
-        self.status_btn = tk.Button(self.btns)
-        self.status_btn["text"] = f"Start"
-        self.status_btn["command"] = lambda: start_ecs(self.client, self.ecs)
-        self.status_btn.pack(side="left")
-
-        self.status_btn = tk.Button(self.btns)
-        self.status_btn["text"] = f"Stop"
-        self.status_btn["command"] = lambda: shutdown_ecs(
-            self.client, self.ecs, "StopCharging"
-        )
-        self.status_btn.pack(side="left")
-
-        self.status_btn = tk.Button(self.btns)
-        self.status_btn["text"] = f"Rebind"
-        self.status_btn[
-            "command"
-        ] = lambda: load_config_and_unbind_allocate_and_bind_new_eip(
-            True, False, True, True
-        )
-        self.status_btn.pack(side="left")
-
-        self.status_btn = tk.Button(self.btns)
-        self.status_btn["text"] = f"Release"
-        self.status_btn["command"] = lambda: unbind_release(
-            self.client, self.ecs, True, True, False
-        )
-        self.status_btn.pack(side="left")
+        self.action_btns: List[tk.Button] = []
+
+        for text, command in (
+            ("Start", self.start),
+            ("Stop", self.stop),
+            ("Rebind", self.rebind),
+            ("Release", self.release),
+        ):
+            btn = tk.Button(self.btns)
+            btn["text"] = text
+            btn["command"] = command
+            btn.pack(side="left")
+            self.action_btns.append(btn)
 
         self.status_text = tk.Label(self)
         self.update_text()
         self.status_text.pack(side="top")
 
+        self.progress_text = tk.Text(self, height=8, width=60, state="disabled")
+        self.progress_text.pack(side="top")
+
         self.quit = tk.Button(self, text="QUIT", fg="red", command=self.master.destroy)
 
     def update_text(self):
@@ -70,9 +83,147 @@ Status: {self.ecs.Status}
         """.strip()
         self.status_text["text"] = status
 
-    def get_status(self):
-        self.client, _, self.ecs = get_client_config_and_ecs()
-        self.update_text()
+    def show_progress(self, message: str):
+        self.progress_text["state"] = "normal"
+        self.progress_text.insert("end", message + "\n")
+        self.progress_text.delete("1.0", f"end-{MAX_LOG_LINES + 1}l")
+        self.progress_text.see("end")
+        self.progress_text["state"] = "disabled"
+
+    def log(self, message: str):
+        # Called by the workers
+        self.callbacks.put(partial(self.show_progress, message))
+
+    def process_callbacks(self):
+        while True:
+            try:
+                callback = self.callbacks.get_nowait()
+            except queue.Empty:
+                break
+            callback()
+        self.after(POLL_INTERVAL_MS, self.process_callbacks)
+
+    def submit(
+        self,
+        work: Callable[[], Any],
+        done: Callable[[Any], Any],
+        failed: Callable[[Exception], Any],
+    ):
+        def run():
+            try:
+                result = work()
+            except Exception as e:
+                self.callbacks.put(partial(failed, e))
+            else:
+                self.callbacks.put(partial(done, result))
+
+        self.executor.submit(run)
+
+    def run_action(self, name: str, action: Callable[[EcsInstance], Any]):
+        if self.busy:
+            return
+        self.set_busy(True)
+        self.show_progress(f"+ {name}")
+        ecs = self.ecs
+
+        def done(_):
+            self.set_busy(False)
+            self.show_progress(f"{name} finished")
+            self.refresh()
+
+        def failed(e: Exception):
+            self.set_busy(False)
+            self.show_progress(f"{name} failed: {e}")
+            self.refresh()
+
+        self.submit(lambda: action(ecs), done, failed)
+
+    def set_busy(self, busy: bool):
+        self.busy = busy
+        for btn in self.action_btns:
+            btn["state"] = "disabled" if busy else "normal"
+
+    def start(self):
+        def action(ecs: EcsInstance):
+            start_ecs(self.client, ecs)
+            wait_ecs_status(
+                self.client,
+                ecs,
+                EcsStatus.running,
+                lambda: self.log("Waiting the ecs to start running..."),
+            )
+
+        self.run_action("Start", action)
+
+    def stop(self):
+        def action(ecs: EcsInstance):
+            shutdown_ecs(self.client, ecs, "StopCharging")
+            wait_ecs_status(
+                self.client,
+                ecs,
+                EcsStatus.stopped,
+                lambda: self.log("Waiting the ecs to stop..."),
+            )
+
+        self.run_action("Stop", action)
+
+    def rebind(self):
+        def action(ecs: EcsInstance):
+            # The eip may have changed since the last refresh
+            ecs = self.fetch_ecs(ecs, True)
+            report = unbind_allocate_and_bind_new_eip(
+                self.client,
+                ecs,
+                get_eip_config(self.config, ecs.RegionId),
+                False,
+                False,
+                True,
+                True,
+                log=self.log,
+            )
+            if report is None:
+                raise RuntimeError("No eip available")
+
+        self.run_action("Rebind", action)
+
+    def release(self):
+        def action(ecs: EcsInstance):
+            unbind_release(
+                self.client, self.fetch_ecs(ecs, True), True, False, False, log=self.log
+            )
+
+        self.run_action("Release", action)
+
+    def fetch_ecs(self, ecs: EcsInstance, fresh: bool = False) -> EcsInstance:
+        ecs_list = get_available_ecs(self.client, ecs.InstanceId, fresh=fresh)
+        if len(ecs_list) == 0:
+            raise RuntimeError(f"The ecs {ecs.InstanceId} does not exist anymore")
+        return ecs_list[0]
+
+    def auto_refresh(self):
+        self.refresh()
+        self.after(REFRESH_INTERVAL_MS, self.auto_refresh)
+
+    def refresh(self):
+        if self.refreshing:
+            return
+        self.refreshing = True
+
+        def done(ecs: EcsInstance):
+            self.refreshing = False
+            self.ecs = ecs
+            self.update_text()
+
+        def failed(e: Exception):
+            self.refreshing = False
+            self.show_progress(f"Refresh failed: {e}")
+
+        ecs = self.ecs
+        self.submit(lambda: self.fetch_ecs(ecs), done, failed)
+
+    def destroy(self):
+        self.executor.shutdown(wait=False)
+        super().destroy()
 
 
 def parse_args():
@@ -89,6 +240,7 @@ def main():
     args = parse_args()
 
     update_config(args.secrets, args.config)
+    add_state_listener(StateSnapshot(SNAPSHOT))
 
     root = tk.Tk()
     app = Application(master=root)
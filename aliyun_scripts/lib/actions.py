@@ -1,30 +1,25 @@
+from __future__ import annotations
+
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
-from typing import List, Optional, Union
-
-from aliyunsdkcore.client import AcsClient
-from aliyunsdkecs.request.v20140526.AllocateEipAddressRequest import (
-    AllocateEipAddressRequest,
-)
-from aliyunsdkecs.request.v20140526.AssociateEipAddressRequest import (
-    AssociateEipAddressRequest,
-)
-from aliyunsdkecs.request.v20140526.DescribeInstancesRequest import (
-    DescribeInstancesRequest,
-)
-from aliyunsdkecs.request.v20140526.StartInstanceRequest import StartInstanceRequest
-from aliyunsdkecs.request.v20140526.StopInstanceRequest import StopInstanceRequest
-from aliyunsdkecs.request.v20140526.UnassociateEipAddressRequest import (
-    UnassociateEipAddressRequest,
-)
-from aliyunsdkvpc.request.v20160428.DescribeEipAddressesRequest import (
-    DescribeEipAddressesRequest,
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
 )
-from aliyunsdkvpc.request.v20160428.ReleaseEipAddressRequest import (
-    ReleaseEipAddressRequest,
-)
-from typing_extensions import Literal
 
+from typing_extensions import Literal, Protocol
+
+from aliyun_scripts.lib.cache import describe_cache, describe_flights
 from aliyun_scripts.lib.exceptions import AllocationFailureError, UnbindFailureError
 from aliyun_scripts.lib.instances import (
     EcsInstance,
@@ -33,91 +28,155 @@ from aliyun_scripts.lib.instances import (
     EipInstance,
     EipStatus,
 )
+from aliyun_scripts.lib.tracing import traced
 from aliyun_scripts.lib.utils import acs_req, p
 
+if TYPE_CHECKING:
+    from aliyunsdkcore.client import AcsClient
 
-def bind_eip_to_ecs(client: AcsClient, eip: EipInstance, ecs: EcsInstance) -> str:
-    return acs_req(
-        client,
-        AssociateEipAddressRequest(),
-        {
-            "InstanceId": ecs.InstanceId,
-            "AllocationId": eip.AllocationId,
-            "RegionId": ecs.RegionId,
-        },
-    )
+# The sdk and its request modules are slow to import, so each action imports
+# only the request class it needs when it runs
 
+# DescribeInstances accepts at most 100 ids in InstanceIds and 100 items per page
+MAX_INSTANCE_IDS_PER_CALL = 100
+# DescribeEipAddresses accepts at most 50 comma separated ids and 100 items per page
+MAX_ALLOCATION_IDS_PER_CALL = 50
+MAX_EIPS_PER_CALL = 100
 
-def unbind_eip_from_ecs(
-    client: AcsClient, ecs: EcsInstance, eip: Optional[EipInstance] = None
-) -> EipInstance:
+
+class StateListener(Protocol):
+    def ecs_observed(self, ecs_list: List[EcsInstance]) -> None:
+        ...
+
+    def eip_observed(self, eip_list: List[EipInstance]) -> None:
+        ...
+
+    def invalidated(
+        self, instance_ids: Sequence[str], allocation_ids: Sequence[str]
+    ) -> None:
+        ...
+
+
+# Notified with every Describe result fetched from the API and after every
+# mutating action, see snapshot.py
+_state_listeners: List[StateListener] = []
+
+# The request builders, response parsers, cache keys and listener updates below
+# are shared with the asyncio twin of this module in aio_actions.py, so both
+# always send the same requests and keep the same state.
+
+
+def _bind_params(eip: EipInstance, ecs: EcsInstance) -> Dict[str, Any]:
+    return {
+        "InstanceId": ecs.InstanceId,
+        "AllocationId": eip.AllocationId,
+        "RegionId": ecs.RegionId,
+    }
+
+
+def _unbind_params(
+    ecs: EcsInstance, eip: Optional[EipInstance]
+) -> Tuple[EipInstance, Dict[str, Any]]:
     if eip is None and (ecs.EipAddress is None or ecs.EipAddress.AllocationId is None):
         raise UnbindFailureError("There is no existing eip to be unbinded")
     eip = eip if eip is not None else ecs.EipAddress
-    allocation_id = eip.AllocationId if eip is not None else ecs.EipAddress.AllocationId
-    acs_req(
-        client,
-        UnassociateEipAddressRequest(),
-        {
-            "InstanceId": ecs.InstanceId,
-            "AllocationId": allocation_id,
-            "RegionId": ecs.RegionId,
-        },
-    )
-    return eip
+    return eip, {
+        "InstanceId": ecs.InstanceId,
+        "AllocationId": eip.AllocationId,
+        "RegionId": ecs.RegionId,
+    }
 
 
-def get_available_ecs(
-    client: AcsClient,
-    instance_id: Optional[str] = None,
-    status: Optional[EcsStatus] = None,
-) -> List[EcsInstance]:
-    params = {
-        "InstanceIds": [instance_id],
-        "Status": status.value if status is not None else None,
-    }
+def _describe_ecs_batches(
+    instance_id: Optional[Union[str, Sequence[str]]],
+    status: Optional[EcsStatus],
+    tags: Optional[Dict[str, str]],
+) -> List[Dict[str, Any]]:
+    params: Dict[str, Any] = {"PageSize": MAX_INSTANCE_IDS_PER_CALL}
+    if status is not None:
+        params["Status"] = status.value
+    for i, (key, value) in enumerate((tags or {}).items(), start=1):
+        params[f"Tag.{i}.Key"] = key
+        params[f"Tag.{i}.Value"] = value
+
     if instance_id is None:
-        del params["InstanceIds"]
-    if status is None:
-        del params["Status"]
+        return [params]
+    instance_ids = [instance_id] if isinstance(instance_id, str) else instance_id
     return [
-        EcsInstance(
-            instance["InstanceId"],
-            instance["InstanceName"],
-            instance["Status"],
-            instance["RegionId"],
-            (
-                lambda eip: EipInstance(
-                    eip["AllocationId"],
-                    eip["IpAddress"],
-                    eip["Bandwidth"],
-                    eip["InternetChargeType"],
-                    eip["IsSupportUnassociate"],
-                )
-                if eip is not None and len(eip["AllocationId"]) > 0
-                else None
-            )(instance.get("EipAddress")),
+        {
+            **params,
+            "InstanceIds": json.dumps(
+                list(instance_ids[i : i + MAX_INSTANCE_IDS_PER_CALL])
+            ),
+        }
+        for i in range(0, len(instance_ids), MAX_INSTANCE_IDS_PER_CALL)
+    ]
+
+
+def _next_page(batch: Dict[str, Any], result: dict) -> Optional[Dict[str, Any]]:
+    page_number = result.get("PageNumber", batch.get("PageNumber", 1))
+    page_size = result.get("PageSize", batch["PageSize"])
+    if result.get("TotalCount", 0) <= page_number * page_size:
+        return None
+    return {**batch, "PageNumber": page_number + 1}
+
+
+def _parse_ecs(instance: dict) -> EcsInstance:
+    eip = instance.get("EipAddress")
+    return EcsInstance(
+        instance["InstanceId"],
+        instance["InstanceName"],
+        instance["Status"],
+        instance["RegionId"],
+        EipInstance(
+            eip["AllocationId"],
+            eip["IpAddress"],
+            eip["Bandwidth"],
+            eip["InternetChargeType"],
+            eip["IsSupportUnassociate"],
+            RegionId=instance["RegionId"],
+            InstanceId=instance["InstanceId"],
         )
-        for instance in acs_req(client, DescribeInstancesRequest(), params,)[
-            "Instances"
-        ]["Instance"]
+        if eip is not None and len(eip["AllocationId"]) > 0
+        else None,
+    )
+
+
+def _parse_ecs_list(result: dict) -> List[EcsInstance]:
+    return [_parse_ecs(instance) for instance in result["Instances"]["Instance"]]
+
+
+def _describe_eip_batches(
+    status: Optional[EipStatus],
+    region_id: Optional[str],
+    eip: Optional[Union[EipInstance, str, Sequence[str]]],
+) -> List[Dict[str, Any]]:
+    params: Dict[str, Any] = {"PageSize": MAX_EIPS_PER_CALL}
+    if status is not None:
+        params["Status"] = status.value
+    if region_id is not None:
+        params["RegionId"] = region_id
+
+    if eip is None:
+        return [params]
+    if isinstance(eip, EipInstance):
+        allocation_ids: Sequence[str] = [eip.AllocationId]
+    elif isinstance(eip, str):
+        allocation_ids = [eip]
+    else:
+        allocation_ids = eip
+    return [
+        {
+            **params,
+            "AllocationId": ",".join(
+                allocation_ids[i : i + MAX_ALLOCATION_IDS_PER_CALL]
+            ),
+        }
+        for i in range(0, len(allocation_ids), MAX_ALLOCATION_IDS_PER_CALL)
     ]
 
 
-def get_available_eip(
-    client: AcsClient,
-    status: Optional[EipStatus] = None,
-    region_id: Optional[str] = None,
-    eip: Optional[Union[EipInstance, str]] = None,
-) -> List[EipInstance]:
-    allocation_id = eip.AllocationId if isinstance(eip, EipInstance) else eip
-    params = {
-        "Status": status.value,
-        "RegionId": region_id,
-        "AllocationId": allocation_id,
-    }
-    if allocation_id is None:
-        del params["AllocationId"]
+def _parse_eip_list(result: dict) -> List[EipInstance]:
     return [
         EipInstance(
             instance["AllocationId"],
@@ -125,21 +184,22 @@ def get_available_eip(
             instance["Bandwidth"],
             instance["InternetChargeType"],
             instance.get("IsSupportUnassociate"),
+            instance.get("Status"),
+            instance.get("RegionId"),
+            # Empty when the eip is not bound
+            instance.get("InstanceId") or None,
+            instance.get("ISP"),
+            instance.get("ChargeType"),
         )
-        for instance in acs_req(client, DescribeEipAddressesRequest(), params)[
-            "EipAddresses"
-        ]["EipAddress"]
+        for instance in result["EipAddresses"]["EipAddress"]
     ]
 
 
-def allocate_eip(
-    client: AcsClient, config: EipConfiguration, verbose: bool
-) -> EipInstance:
-    result = acs_req(
-        client,
-        AllocateEipAddressRequest(),
-        asdict(config),
-    )
+def _parse_regions(result: dict) -> List[str]:
+    return [region["RegionId"] for region in result["Regions"]["Region"]]
+
+
+def _parse_allocated_eip(result: dict, verbose: bool) -> EipInstance:
     try:
         return EipInstance(
             IpAddress=result["EipAddress"], AllocationId=result["AllocationId"]
@@ -149,9 +209,288 @@ def allocate_eip(
         raise AllocationFailureError("Cannot allocate a new eip, see the result above")
 
 
-def release_eip(client: AcsClient, eip: Union[EipInstance, str]) -> str:
+def _release_params(eip: Union[EipInstance, str]) -> Dict[str, Any]:
     allocation_id = eip.AllocationId if isinstance(eip, EipInstance) else eip
-    return acs_req(client, ReleaseEipAddressRequest(), {"AllocationId": allocation_id})
+    return {"AllocationId": allocation_id}
+
+
+def _shutdown_params(
+    ecs: Union[EcsInstance, str],
+    stopped_mode: Literal["StopCharging", "KeepCharing"],
+    force_stop: bool,
+) -> Dict[str, Any]:
+    instance_id = ecs.InstanceId if isinstance(ecs, EcsInstance) else ecs
+    return {
+        "InstanceId": instance_id,
+        "StoppedMode": stopped_mode,
+        "ForceStop": force_stop,
+    }
+
+
+def _start_params(ecs: Union[EcsInstance, str]) -> Dict[str, Any]:
+    instance_id = ecs.InstanceId if isinstance(ecs, EcsInstance) else ecs
+    return {"InstanceId": instance_id}
+
+
+def _batch_ids(batch: Dict[str, Any]) -> List[str]:
+    if "InstanceIds" in batch:
+        return json.loads(batch["InstanceIds"])
+    if "AllocationId" in batch:
+        return batch["AllocationId"].split(",")
+    return []
+
+
+def add_state_listener(listener: StateListener) -> None:
+    # Every command of the agent adds the snapshot, it is only kept once
+    if listener not in _state_listeners:
+        _state_listeners.append(listener)
+
+
+def remove_state_listener(listener: StateListener) -> None:
+    _state_listeners.remove(listener)
+
+
+def _describe_key(
+    client: AcsClient, request_class: type, batch: Dict[str, Any]
+) -> Tuple[Any, ...]:
+    # Clients of different accounts must not see each other's resources
+    return (
+        request_class.__name__[: -len("Request")],
+        client.get_access_key(),
+        client.get_region_id(),
+        tuple(sorted(batch.items())),
+    )
+
+
+def _cached_describe(
+    client: AcsClient, request_class: type, batch: Dict[str, Any], fresh: bool
+) -> Tuple[dict, bool]:
+    key = _describe_key(client, request_class, batch)
+    if not fresh:
+        found, result = describe_cache.get(key)
+        if found:
+            return result, False
+
+    def describe() -> dict:
+        generation = describe_cache.generation(key[0])
+        result = acs_req(client, request_class(), batch)
+        describe_cache.put(key, result, _batch_ids(batch), generation)
+        return result
+
+    # Only the caller that sent the request reports it to the listeners
+    return describe_flights.do(key, describe)
+
+
+def _iter_pages(
+    client: AcsClient,
+    request_class: type,
+    batches: List[Dict[str, Any]],
+    fresh: bool,
+    prefetch: bool,
+) -> Iterator[Tuple[dict, bool]]:
+    # Yields every page of every batch; with prefetch the next page is already
+    # requested while the caller works through the current one
+    pending = deque(batches)
+    executor: Optional[ThreadPoolExecutor] = None
+
+    def fetch(batch: Dict[str, Any]) -> Tuple[Dict[str, Any], dict, bool]:
+        return (batch, *_cached_describe(client, request_class, batch, fresh))
+
+    def request(
+        batch: Dict[str, Any]
+    ) -> Callable[[], Tuple[Dict[str, Any], dict, bool]]:
+        nonlocal executor
+
+        if not prefetch:
+            return lambda: fetch(batch)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1)
+        return executor.submit(fetch, batch).result
+
+    try:
+        upcoming: Optional[Callable] = None
+        if len(pending) > 0:
+            first = pending.popleft()
+            upcoming = lambda: fetch(first)
+        while upcoming is not None:
+            batch, result, from_api = upcoming()
+            following = _next_page(batch, result)
+            if following is None and len(pending) > 0:
+                following = pending.popleft()
+            upcoming = request(following) if following is not None else None
+            yield result, from_api
+    finally:
+        if executor is not None:
+            # A prefetched page the caller stopped waiting for is dropped
+            executor.shutdown(wait=False)
+
+
+def _observed_ecs(result: dict, from_api: bool) -> List[EcsInstance]:
+    parsed = _parse_ecs_list(result)
+    if from_api:
+        for listener in _state_listeners:
+            listener.ecs_observed(parsed)
+    return parsed
+
+
+def _observed_eip(result: dict, from_api: bool) -> List[EipInstance]:
+    parsed = _parse_eip_list(result)
+    if from_api:
+        for listener in _state_listeners:
+            listener.eip_observed(parsed)
+    return parsed
+
+
+def _observe_ecs(pages: Iterator[Tuple[dict, bool]]) -> Iterator[EcsInstance]:
+    for result, from_api in pages:
+        yield from _observed_ecs(result, from_api)
+
+
+def _observe_eip(pages: Iterator[Tuple[dict, bool]]) -> Iterator[EipInstance]:
+    for result, from_api in pages:
+        yield from _observed_eip(result, from_api)
+
+
+def _invalidate(
+    instance_ids: Sequence[str] = (), allocation_ids: Optional[Sequence[str]] = None
+) -> None:
+    # Instances embed their eip, so every eip change also affects DescribeInstances
+    describe_cache.invalidate("DescribeInstances", instance_ids)
+    describe_flights.forget("DescribeInstances")
+    if allocation_ids is not None:
+        describe_cache.invalidate("DescribeEipAddresses", allocation_ids)
+        describe_flights.forget("DescribeEipAddresses")
+    for listener in _state_listeners:
+        listener.invalidated(instance_ids, allocation_ids or ())
+
+
+def bind_eip_to_ecs(client: AcsClient, eip: EipInstance, ecs: EcsInstance) -> str:
+    from aliyunsdkecs.request.v20140526.AssociateEipAddressRequest import (
+        AssociateEipAddressRequest,
+    )
+
+    try:
+        return acs_req(client, AssociateEipAddressRequest(), _bind_params(eip, ecs))
+    finally:
+        _invalidate([ecs.InstanceId], [eip.AllocationId])
+
+
+def unbind_eip_from_ecs(
+    client: AcsClient, ecs: EcsInstance, eip: Optional[EipInstance] = None
+) -> EipInstance:
+    from aliyunsdkecs.request.v20140526.UnassociateEipAddressRequest import (
+        UnassociateEipAddressRequest,
+    )
+
+    eip, params = _unbind_params(ecs, eip)
+    try:
+        acs_req(client, UnassociateEipAddressRequest(), params)
+    finally:
+        _invalidate([ecs.InstanceId], [eip.AllocationId])
+    return eip
+
+
+def iter_available_ecs(
+    client: AcsClient,
+    instance_id: Optional[Union[str, Sequence[str]]] = None,
+    status: Optional[EcsStatus] = None,
+    tags: Optional[Dict[str, str]] = None,
+    fresh: bool = False,
+    prefetch: bool = True,
+) -> Iterator[EcsInstance]:
+    from aliyunsdkecs.request.v20140526.DescribeInstancesRequest import (
+        DescribeInstancesRequest,
+    )
+
+    return _observe_ecs(
+        _iter_pages(
+            client,
+            DescribeInstancesRequest,
+            _describe_ecs_batches(instance_id, status, tags),
+            fresh,
+            prefetch,
+        )
+    )
+
+
+def get_available_ecs(
+    client: AcsClient,
+    instance_id: Optional[Union[str, Sequence[str]]] = None,
+    status: Optional[EcsStatus] = None,
+    tags: Optional[Dict[str, str]] = None,
+    fresh: bool = False,
+) -> List[EcsInstance]:
+    return list(iter_available_ecs(client, instance_id, status, tags, fresh))
+
+
+def iter_available_eip(
+    client: AcsClient,
+    status: Optional[EipStatus] = None,
+    region_id: Optional[str] = None,
+    eip: Optional[Union[EipInstance, str, Sequence[str]]] = None,
+    fresh: bool = False,
+    prefetch: bool = True,
+) -> Iterator[EipInstance]:
+    from aliyunsdkvpc.request.v20160428.DescribeEipAddressesRequest import (
+        DescribeEipAddressesRequest,
+    )
+
+    return _observe_eip(
+        _iter_pages(
+            client,
+            DescribeEipAddressesRequest,
+            _describe_eip_batches(status, region_id, eip),
+            fresh,
+            prefetch,
+        )
+    )
+
+
+def get_available_eip(
+    client: AcsClient,
+    status: Optional[EipStatus] = None,
+    region_id: Optional[str] = None,
+    eip: Optional[Union[EipInstance, str, Sequence[str]]] = None,
+    fresh: bool = False,
+) -> List[EipInstance]:
+    return list(iter_available_eip(client, status, region_id, eip, fresh))
+
+
+def get_regions(client: AcsClient, fresh: bool = False) -> List[str]:
+    from aliyunsdkecs.request.v20140526.DescribeRegionsRequest import (
+        DescribeRegionsRequest,
+    )
+
+    result, _ = _cached_describe(client, DescribeRegionsRequest, {}, fresh)
+    return _parse_regions(result)
+
+
+@traced("allocate eip")
+def allocate_eip(
+    client: AcsClient, config: EipConfiguration, verbose: bool
+) -> EipInstance:
+    from aliyunsdkecs.request.v20140526.AllocateEipAddressRequest import (
+        AllocateEipAddressRequest,
+    )
+
+    try:
+        return _parse_allocated_eip(
+            acs_req(client, AllocateEipAddressRequest(), asdict(config)), verbose
+        )
+    finally:
+        _invalidate(allocation_ids=[])
+
+
+def release_eip(client: AcsClient, eip: Union[EipInstance, str]) -> str:
+    from aliyunsdkvpc.request.v20160428.ReleaseEipAddressRequest import (
+        ReleaseEipAddressRequest,
+    )
+
+    params = _release_params(eip)
+    try:
+        return acs_req(client, ReleaseEipAddressRequest(), params)
+    finally:
+        _invalidate(allocation_ids=[params["AllocationId"]])
 
 
 def shutdown_ecs(
@@ -160,27 +499,23 @@ def shutdown_ecs(
     stopped_mode: Literal["StopCharging", "KeepCharing"],
     force_stop: bool = False,
 ) -> str:
-    instance_id = ecs.InstanceId if isinstance(ecs, EcsInstance) else ecs
-    return acs_req(
-        client,
-        StopInstanceRequest(),
-        {
-            "InstanceId": instance_id,
-            "StoppedMode": stopped_mode,
-            "ForceStop": force_stop,
-        },
-    )
+    from aliyunsdkecs.request.v20140526.StopInstanceRequest import StopInstanceRequest
+
+    params = _shutdown_params(ecs, stopped_mode, force_stop)
+    try:
+        return acs_req(client, StopInstanceRequest(), params)
+    finally:
+        _invalidate([params["InstanceId"]])
 
 
 def start_ecs(
     client: AcsClient,
     ecs: Union[EcsInstance, str],
 ) -> str:
-    instance_id = ecs.InstanceId if isinstance(ecs, EcsInstance) else ecs
-    return acs_req(
-        client,
-        StartInstanceRequest(),
-        {
-            "InstanceId": instance_id,
-        },
-    )
+    from aliyunsdkecs.request.v20140526.StartInstanceRequest import StartInstanceRequest
+
+    params = _start_params(ecs)
+    try:
+        return acs_req(client, StartInstanceRequest(), params)
+    finally:
+        _invalidate([params["InstanceId"]])
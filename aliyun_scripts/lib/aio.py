@@ -0,0 +1,161 @@
+import json
+from time import monotonic
+from typing import Any, Dict, Optional, Tuple
+
+import aiohttp
+from aliyunsdkcore.acs_exception.exceptions import ServerException
+from aliyunsdkcore.client import AcsClient
+from aliyunsdkcore.request import RpcRequest
+
+from aliyun_scripts.lib.resilience import resilience
+from aliyun_scripts.lib.throttle import scheduler
+from aliyun_scripts.lib.tracing import tracer
+from aliyun_scripts.lib.utils import _copy_request, _prepare_request, _record_call
+
+
+class AsyncAcsClient:
+    def __init__(
+        self,
+        ak: str,
+        secret: str,
+        region_id: str,
+        port: int = 80,
+        pool_size: int = 100,
+        timeout: float = 10,
+    ):
+        self._ak = ak
+        self._secret = secret
+        self._region_id = region_id
+        self._port = port
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._endpoints: Dict[Tuple[str, str], str] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    def from_client(cls, client: AcsClient, **kwargs: Any) -> "AsyncAcsClient":
+        return cls(
+            client.get_access_key(),
+            client.get_access_secret(),
+            client.get_region_id(),
+            port=client.get_port(),
+            **kwargs,
+        )
+
+    def get_region_id(self) -> str:
+        return self._region_id
+
+    def get_access_key(self) -> str:
+        return self._ak
+
+    def add_endpoint(self, region_id: str, product_code: str, endpoint: str) -> None:
+        self._endpoints[(region_id, product_code.lower())] = endpoint
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session has to be created from within the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self._pool_size, keepalive_timeout=30
+                ),
+                timeout=aiohttp.ClientTimeout(total=self._timeout),
+            )
+        return self._session
+
+    def _resolve_endpoint(self, request: RpcRequest) -> str:
+        if request.endpoint:
+            return request.endpoint
+        product = request.get_product().lower()
+        override = self._endpoints.get((self._region_id, product))
+        if override is not None:
+            return override
+        if request.endpoint_map and self._region_id in request.endpoint_map:
+            return request.endpoint_map[self._region_id]
+        return f"{product}.{self._region_id}.aliyuncs.com"
+
+    async def do_action_with_exception(self, request: RpcRequest) -> bytes:
+        request.set_accept_format("JSON")
+        # Let the sdk sign the request so that it matches what AcsClient sends
+        url = request.get_url(self._region_id, self._ak, self._secret)
+        port = "" if self._port in (80, 443) else f":{self._port}"
+        async with self._get_session().request(
+            request.get_method(),
+            f"{request.get_protocol_type()}://{self._resolve_endpoint(request)}{port}{url}",
+        ) as response:
+            body = await response.read()
+            if response.status < 200 or response.status >= 300:
+                raise _server_exception(response.status, body)
+            return body
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self) -> "AsyncAcsClient":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+
+def _server_exception(http_status: int, body: bytes) -> ServerException:
+    try:
+        result = json.loads(body.decode())
+    except ValueError:
+        result = {}
+    return ServerException(
+        result.get("Code", "SDK.UnknownServerError"),
+        result.get("Message", f"ServerResponseBody: {body!r}"),
+        http_status=http_status,
+        request_id=result.get("RequestId"),
+    )
+
+
+async def acs_req(
+    client: AsyncAcsClient, r: RpcRequest, params: Optional[Dict[str, Any]] = None
+) -> dict:
+    # The coroutine twin of utils.acs_req, with the same rate limiting,
+    # deadline, hedging, retries, metrics and spans
+    region_id, endpoint = _prepare_request(client, r, params)
+    action = r.get_action_name()
+    bucket = scheduler.bucket(action, region_id)
+    deadline = resilience.deadline()
+    hedge_request = _copy_request(r) if resilience.may_hedge(action) else None
+
+    async def send(request: RpcRequest) -> bytes:
+        started = monotonic()
+        try:
+            with tracer.span("http", "api"):
+                response = await client.do_action_with_exception(request)
+        except Exception as e:
+            _record_call(request, region_id, started, error=e)
+            raise
+        _record_call(request, region_id, started, response)
+        return response
+
+    async def attempt(hedge: bool) -> bytes:
+        if not hedge:
+            return await send(r)
+        # A hedge overlaps the first attempt, only that one is part of the
+        # action's own time
+        with tracer.detached():
+            return await send(hedge_request)
+
+    async def exchange() -> bytes:
+        return await resilience.exchange_async(
+            action,
+            endpoint,
+            attempt,
+            deadline,
+            lambda: hedge_request is not None and bucket.try_acquire(),
+        )
+
+    with tracer.span(action, "api", region=region_id):
+        response = await resilience.call_async(
+            action,
+            endpoint,
+            lambda: scheduler.call_async(action, region_id, exchange, deadline),
+            deadline,
+        )
+        return json.loads(response.decode())
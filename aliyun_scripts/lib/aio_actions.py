@@ -0,0 +1,281 @@
+import asyncio
+from dataclasses import asdict
+from enum import Enum
+from time import monotonic
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from aliyunsdkecs.request.v20140526.AllocateEipAddressRequest import (
+    AllocateEipAddressRequest,
+)
+from aliyunsdkecs.request.v20140526.AssociateEipAddressRequest import (
+    AssociateEipAddressRequest,
+)
+from aliyunsdkecs.request.v20140526.DescribeInstancesRequest import (
+    DescribeInstancesRequest,
+)
+from aliyunsdkecs.request.v20140526.DescribeRegionsRequest import (
+    DescribeRegionsRequest,
+)
+from aliyunsdkecs.request.v20140526.StartInstanceRequest import StartInstanceRequest
+from aliyunsdkecs.request.v20140526.StopInstanceRequest import StopInstanceRequest
+from aliyunsdkecs.request.v20140526.UnassociateEipAddressRequest import (
+    UnassociateEipAddressRequest,
+)
+from aliyunsdkvpc.request.v20160428.DescribeEipAddressesRequest import (
+    DescribeEipAddressesRequest,
+)
+from aliyunsdkvpc.request.v20160428.ReleaseEipAddressRequest import (
+    ReleaseEipAddressRequest,
+)
+from typing_extensions import Literal
+
+from aliyun_scripts.lib import utils
+from aliyun_scripts.lib.actions import (
+    _batch_ids,
+    _bind_params,
+    _describe_ecs_batches,
+    _describe_eip_batches,
+    _describe_key,
+    _invalidate,
+    _next_page,
+    _observed_ecs,
+    _observed_eip,
+    _parse_allocated_eip,
+    _parse_regions,
+    _release_params,
+    _shutdown_params,
+    _start_params,
+    _unbind_params,
+)
+from aliyun_scripts.lib.aio import AsyncAcsClient, acs_req
+from aliyun_scripts.lib.cache import describe_cache, describe_flights
+from aliyun_scripts.lib.exceptions import WaitTimeoutError
+from aliyun_scripts.lib.instances import (
+    EcsInstance,
+    EcsStatus,
+    EipConfiguration,
+    EipInstance,
+    EipStatus,
+)
+from aliyun_scripts.lib.polling import DEFAULT_POLICY, WaitPolicy
+from aliyun_scripts.lib.tracing import tracer
+
+
+async def bind_eip_to_ecs(
+    client: AsyncAcsClient, eip: EipInstance, ecs: EcsInstance
+) -> dict:
+    try:
+        return await acs_req(
+            client, AssociateEipAddressRequest(), _bind_params(eip, ecs)
+        )
+    finally:
+        _invalidate([ecs.InstanceId], [eip.AllocationId])
+
+
+async def unbind_eip_from_ecs(
+    client: AsyncAcsClient, ecs: EcsInstance, eip: Optional[EipInstance] = None
+) -> EipInstance:
+    eip, params = _unbind_params(ecs, eip)
+    try:
+        await acs_req(client, UnassociateEipAddressRequest(), params)
+    finally:
+        _invalidate([ecs.InstanceId], [eip.AllocationId])
+    return eip
+
+
+async def _cached_describe(
+    client: AsyncAcsClient, request_class: type, batch: Dict[str, Any], fresh: bool
+) -> Tuple[dict, bool]:
+    key = _describe_key(client, request_class, batch)
+    if not fresh:
+        found, result = describe_cache.get(key)
+        if found:
+            return result, False
+
+    async def describe() -> dict:
+        generation = describe_cache.generation(key[0])
+        result = await acs_req(client, request_class(), batch)
+        describe_cache.put(key, result, _batch_ids(batch), generation)
+        return result
+
+    return await describe_flights.do_async(key, describe)
+
+
+async def _describe_pages(
+    client: AsyncAcsClient, request_class: type, batch: Dict[str, Any], fresh: bool
+) -> List[Tuple[dict, bool]]:
+    pages = []
+    page: Optional[Dict[str, Any]] = batch
+    while page is not None:
+        result, from_api = await _cached_describe(client, request_class, page, fresh)
+        pages.append((result, from_api))
+        page = _next_page(page, result)
+    return pages
+
+
+async def get_available_ecs(
+    client: AsyncAcsClient,
+    instance_id: Optional[Union[str, Sequence[str]]] = None,
+    status: Optional[EcsStatus] = None,
+    tags: Optional[Dict[str, str]] = None,
+    fresh: bool = False,
+) -> List[EcsInstance]:
+    results = await asyncio.gather(
+        *(
+            _describe_pages(client, DescribeInstancesRequest, batch, fresh)
+            for batch in _describe_ecs_batches(instance_id, status, tags)
+        )
+    )
+    return [
+        ecs
+        for pages in results
+        for result, from_api in pages
+        for ecs in _observed_ecs(result, from_api)
+    ]
+
+
+async def get_available_eip(
+    client: AsyncAcsClient,
+    status: Optional[EipStatus] = None,
+    region_id: Optional[str] = None,
+    eip: Optional[Union[EipInstance, str, Sequence[str]]] = None,
+    fresh: bool = False,
+) -> List[EipInstance]:
+    results = await asyncio.gather(
+        *(
+            _describe_pages(client, DescribeEipAddressesRequest, batch, fresh)
+            for batch in _describe_eip_batches(status, region_id, eip)
+        )
+    )
+    return [
+        eip
+        for pages in results
+        for result, from_api in pages
+        for eip in _observed_eip(result, from_api)
+    ]
+
+
+async def get_regions(client: AsyncAcsClient, fresh: bool = False) -> List[str]:
+    result, _ = await _cached_describe(client, DescribeRegionsRequest, {}, fresh)
+    return _parse_regions(result)
+
+
+async def allocate_eip(
+    client: AsyncAcsClient, config: EipConfiguration, verbose: bool
+) -> EipInstance:
+    try:
+        return _parse_allocated_eip(
+            await acs_req(client, AllocateEipAddressRequest(), asdict(config)),
+            verbose,
+        )
+    finally:
+        _invalidate(allocation_ids=[])
+
+
+async def release_eip(client: AsyncAcsClient, eip: Union[EipInstance, str]) -> dict:
+    params = _release_params(eip)
+    try:
+        return await acs_req(client, ReleaseEipAddressRequest(), params)
+    finally:
+        _invalidate(allocation_ids=[params["AllocationId"]])
+
+
+async def shutdown_ecs(
+    client: AsyncAcsClient,
+    ecs: Union[EcsInstance, str],
+    stopped_mode: Literal["StopCharging", "KeepCharing"],
+    force_stop: bool = False,
+) -> dict:
+    params = _shutdown_params(ecs, stopped_mode, force_stop)
+    try:
+        return await acs_req(client, StopInstanceRequest(), params)
+    finally:
+        _invalidate([params["InstanceId"]])
+
+
+async def start_ecs(client: AsyncAcsClient, ecs: Union[EcsInstance, str]) -> dict:
+    params = _start_params(ecs)
+    try:
+        return await acs_req(client, StartInstanceRequest(), params)
+    finally:
+        _invalidate([params["InstanceId"]])
+
+
+async def wait_status(
+    get_status: Callable[[], Awaitable[Optional[str]]],
+    till_status: Enum,
+    cb: Optional[Callable[[], Any]] = None,
+    policy: Optional[WaitPolicy] = None,
+    transition: Optional[str] = None,
+) -> None:
+    if policy is None:
+        policy = (
+            utils.transition_history.policy_for(transition)
+            if transition is not None
+            else DEFAULT_POLICY
+        )
+    start = monotonic()
+    for delay in policy.delays():
+        with tracer.span("poll", "wait"):
+            last_status = await get_status()
+        elapsed = monotonic() - start
+        if last_status == till_status.value:
+            if transition is not None:
+                utils.transition_history.record(transition, elapsed)
+            return
+        if elapsed >= policy.timeout:
+            raise WaitTimeoutError(till_status.value, last_status, elapsed)
+        if cb is not None:
+            cb()
+        with tracer.span("sleep", "wait"):
+            await asyncio.sleep(min(delay, policy.timeout - elapsed))
+
+
+async def wait_eip_status(
+    client: AsyncAcsClient,
+    eip: EipInstance,
+    till_status: EipStatus,
+    region_id: str,
+    cb: Optional[Callable[[], Any]] = None,
+    policy: Optional[WaitPolicy] = None,
+) -> None:
+    if eip.AllocationId is None:
+        raise ValueError("The eip address needs to have an allocationId")
+
+    async def get_status() -> Optional[str]:
+        eip_list = await get_available_eip(client, None, region_id, eip, fresh=True)
+        return eip_list[0].Status if len(eip_list) > 0 else None
+
+    transition = f"eip:{till_status.value}"
+    with tracer.span(f"wait {transition}", "wait", eip=eip.AllocationId):
+        await wait_status(get_status, till_status, cb, policy, transition)
+
+
+async def wait_ecs_status(
+    client: AsyncAcsClient,
+    ecs: Union[EcsInstance, str],
+    till_status: EcsStatus,
+    cb: Optional[Callable[[], Any]] = None,
+    policy: Optional[WaitPolicy] = None,
+) -> None:
+    instance_id = ecs.InstanceId if isinstance(ecs, EcsInstance) else ecs
+    if instance_id is None:
+        raise ValueError("The InstanceId cannot be None")
+
+    async def get_status() -> Optional[str]:
+        ecs_list = await get_available_ecs(client, instance_id, fresh=True)
+        return ecs_list[0].Status if len(ecs_list) > 0 else None
+
+    transition = f"ecs:{till_status.value}"
+    with tracer.span(f"wait {transition}", "wait", ecs=instance_id):
+        await wait_status(get_status, till_status, cb, policy, transition)
@@ -0,0 +1,176 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from time import monotonic
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Hashable,
+    Iterable,
+    Optional,
+    Tuple,
+)
+
+
+class TTLCache:
+    def __init__(self, ttl: float = 10, max_size: int = 256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a result requested before a change
+        # is not stored after it
+        self._generations: Dict[str, int] = {}
+        # key -> (expires at, tags, value); the namespace of an entry is key[0]
+        self._entries: "OrderedDict[Tuple, Tuple[float, FrozenSet[str], Any]]" = (
+            OrderedDict()
+        )
+
+    def get(self, key: Tuple[Hashable, ...]) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[2]
+
+    def generation(self, namespace: str) -> int:
+        with self._lock:
+            return self._generations.get(namespace, 0)
+
+    def put(
+        self,
+        key: Tuple[Hashable, ...],
+        value: Any,
+        tags: Iterable[str] = (),
+        generation: Optional[int] = None,
+    ) -> None:
+        # With a generation, the value is dropped if its namespace was
+        # invalidated since that generation was read
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if (
+                generation is not None
+                and self._generations.get(key[0], 0) != generation
+            ):
+                return
+            self._entries[key] = (monotonic() + self.ttl, frozenset(tags), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, namespace: str, ids: Optional[Iterable[str]] = None) -> None:
+        # Entries without tags are listings that may contain any resource, so
+        # they are dropped whenever anything in their namespace changes
+        ids = frozenset(ids) if ids is not None else None
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            stale = [
+                key
+                for key, (_, tags, _) in self._entries.items()
+                if key[0] == namespace
+                and (ids is None or len(tags) == 0 or not tags.isdisjoint(ids))
+            ]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "size": len(self._entries),
+            }
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share the call that is already in
+    # flight; nothing is kept once it returns, so this never serves old results
+    def __init__(self):
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._calls: Dict[Tuple, Future] = {}
+
+    def _join(self, key: Tuple[Hashable, ...]) -> Tuple[Future, bool]:
+        with self._lock:
+            future = self._calls.get(key)
+            if future is None:
+                future = self._calls[key] = Future()
+                return future, True
+            self.shared += 1
+            return future, False
+
+    def do(
+        self, key: Tuple[Hashable, ...], func: Callable[[], Any]
+    ) -> Tuple[Any, bool]:
+        # Returns the result and whether this caller made the call itself
+        future, leader = self._join(key)
+        if not leader:
+            return future.result(), False
+
+        try:
+            result = func()
+        except BaseException as e:
+            self._done(key, future, error=e)
+            raise
+        self._done(key, future, result)
+        return result, True
+
+    async def do_async(
+        self, key: Tuple[Hashable, ...], func: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        # Shares calls with do, so threads and coroutines join each other
+        import asyncio
+
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future), False
+
+        try:
+            result = await func()
+        except BaseException as e:
+            self._done(key, future, error=e)
+            raise
+        self._done(key, future, result)
+        return result, True
+
+    def _done(
+        self,
+        key: Tuple[Hashable, ...],
+        future: Future,
+        result: Any = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def forget(self, namespace: str) -> None:
+        # Calls started before a change are not joined by later callers
+        with self._lock:
+            for key in [key for key in self._calls if key[0] == namespace]:
+                del self._calls[key]
+
+
+describe_cache = TTLCache()
+describe_flights = SingleFlight()
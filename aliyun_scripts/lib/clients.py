@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Dict, Tuple
+
+if TYPE_CHECKING:
+    from aliyunsdkcore.client import AcsClient
+
+
+class JsonFileCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # path -> ((mtime, size), parsed content)
+        self._files: Dict[str, Tuple[Tuple[int, int], Any]] = {}
+        self.loads = 0
+
+    def load(self, path: str) -> Any:
+        # Parsed once and reloaded only when the file changes; callers share
+        # the returned object and must not modify it
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        with open(path) as f:
+            content = json.load(f)
+        with self._lock:
+            self._files[path] = (version, content)
+            self.loads += 1
+        return content
+
+    def clear(self) -> None:
+        with self._lock:
+            self._files.clear()
+
+
+class ClientRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (access key, region) -> (secret, client)
+        self._clients: Dict[Tuple[str, str], Tuple[str, AcsClient]] = {}
+
+    def get(self, access_key_id: str, secret: str, region_id: str) -> AcsClient:
+        # Every client keeps its own connection pool, so one client per
+        # credentials and region is shared by the whole process
+        from aliyunsdkcore.client import AcsClient
+
+        key = (access_key_id, region_id)
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None and entry[0] == secret:
+                return entry[1]
+            # acs_req decides which calls are retried, within their deadline
+            client = AcsClient(
+                ak=access_key_id, secret=secret, region_id=region_id, auto_retry=False
+            )
+            self._clients[key] = (secret, client)
+        if entry is not None:
+            # The secret was rotated, the old client is not handed out anymore
+            _close(entry[1])
+        return client
+
+    def for_region(self, client: AcsClient, region_id: str) -> AcsClient:
+        if client.get_region_id() == region_id:
+            return client
+        return self.get(client.get_access_key(), client.get_access_secret(), region_id)
+
+    def close(self) -> None:
+        with self._lock:
+            entries = list(self._clients.values())
+            self._clients.clear()
+        for _, client in entries:
+            _close(client)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+
+def _close(client: AcsClient) -> None:
+    session = getattr(client, "session", None)
+    if session is not None:
+        session.close()
+
+
+json_files = JsonFileCache()
+clients = ClientRegistry()
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence
+
+from aliyun_scripts.lib.actions import get_available_ecs, get_available_eip, get_regions
+from aliyun_scripts.lib.clients import clients
+from aliyun_scripts.lib.instances import EcsInstance, EipInstance, EipStatus
+
+if TYPE_CHECKING:
+    from aliyunsdkcore.client import AcsClient
+
+# Regions are independent of each other, so by default every query gets its own
+# worker and the discovery takes about as long as the slowest region
+MAX_DISCOVERY_WORKERS = 64
+
+
+@dataclass
+class Inventory:
+    regions: List[str]
+    ecs: List[EcsInstance] = field(default_factory=list)
+    eips: List[EipInstance] = field(default_factory=list)
+    # Regions that failed to answer, the rest of the inventory is still usable
+    errors: Dict[str, Exception] = field(default_factory=dict)
+    # Seconds taken by each region
+    durations: Dict[str, float] = field(default_factory=dict)
+
+    def ecs_in(self, region_id: str) -> List[EcsInstance]:
+        return [ecs for ecs in self.ecs if ecs.RegionId == region_id]
+
+    def eips_in(self, region_id: str) -> List[EipInstance]:
+        return [eip for eip in self.eips if eip.RegionId == region_id]
+
+    def idle_eips(self) -> List[EipInstance]:
+        return [eip for eip in self.eips if eip.Status == EipStatus.available.value]
+
+    def find_ecs(self, instance_id: str) -> Optional[EcsInstance]:
+        for ecs in self.ecs:
+            if ecs.InstanceId == instance_id:
+                return ecs
+        return None
+
+
+def discover(
+    client: AcsClient,
+    regions: Optional[Sequence[str]] = None,
+    concurrency: Optional[int] = None,
+    include_ecs: bool = True,
+    include_eip: bool = True,
+    client_for_region: Callable[[AcsClient, str], AcsClient] = clients.for_region,
+) -> Inventory:
+    # Without regions every region returned by DescribeRegions is queried
+    if regions is None:
+        regions = get_regions(client)
+    inventory = Inventory(list(regions))
+    if len(regions) == 0:
+        return inventory
+
+    lock = threading.Lock()
+
+    def describe(region_id: str, kind: str) -> list:
+        region_client = client_for_region(client, region_id)
+        started = monotonic()
+        try:
+            if kind == "ecs":
+                return get_available_ecs(region_client)
+            eips = get_available_eip(region_client, region_id=region_id)
+            for eip in eips:
+                # Not every response carries it, but the query already tells us
+                eip.RegionId = eip.RegionId or region_id
+            return eips
+        finally:
+            elapsed = monotonic() - started
+            with lock:
+                inventory.durations[region_id] = max(
+                    inventory.durations.get(region_id, 0), elapsed
+                )
+
+    kinds = [
+        kind for kind, wanted in (("ecs", include_ecs), ("eip", include_eip)) if wanted
+    ]
+    tasks = [(region_id, kind) for region_id in regions for kind in kinds]
+    workers = concurrency or min(len(tasks), MAX_DISCOVERY_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            (region_id, kind, executor.submit(describe, region_id, kind))
+            for region_id, kind in tasks
+        ]
+        for region_id, kind, future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                inventory.errors.setdefault(region_id, e)
+                continue
+            if kind == "ecs":
+                inventory.ecs.extend(result)
+            else:
+                inventory.eips.extend(result)
+    return inventory
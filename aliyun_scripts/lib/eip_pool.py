@@ -0,0 +1,273 @@
+from __future__ import annotations
+
+import sys
+import threading
+from collections import deque
+from dataclasses import astuple, dataclass
+from time import monotonic
+from typing import TYPE_CHECKING, Deque, Dict, Optional, Set, Tuple
+
+from aliyun_scripts.lib.actions import allocate_eip, get_available_eip, release_eip
+from aliyun_scripts.lib.instances import EipConfiguration, EipInstance, EipStatus
+
+if TYPE_CHECKING:
+    from aliyunsdkcore.client import AcsClient
+
+_claim_lock = threading.Lock()
+_claimed_eips: Set[str] = set()
+
+
+def claim_eip(allocation_id: str) -> bool:
+    # Available eips are visible to every rebind in the process, so whoever
+    # wants to bind one has to claim it first
+    with _claim_lock:
+        if allocation_id in _claimed_eips:
+            return False
+        _claimed_eips.add(allocation_id)
+        return True
+
+
+def unclaim_eip(allocation_id: str) -> None:
+    with _claim_lock:
+        _claimed_eips.discard(allocation_id)
+
+
+def matches_config(eip: EipInstance, config: EipConfiguration) -> bool:
+    # Fields the API did not return are not held against the eip
+    return (
+        (eip.Bandwidth is None or int(eip.Bandwidth) == config.BandWidth)
+        and (
+            eip.InternetChargeType is None
+            or eip.InternetChargeType == config.InternetChargeType
+        )
+        and (eip.ISP is None or eip.ISP == config.ISP)
+        and (eip.ChargeType is None or eip.ChargeType == config.InstanceChargeType)
+    )
+
+
+@dataclass
+class _PooledEip:
+    eip: EipInstance
+    added: float
+    # Only eips allocated by the pool are released when it is trimmed
+    owned: bool
+
+
+@dataclass
+class PoolMetrics:
+    hits: int = 0
+    misses: int = 0
+    allocated: int = 0
+    adopted: int = 0
+    released: int = 0
+    # Total time eips spent waiting in the pool, summed over every eip
+    idle_seconds: float = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+    def idle_cost(self, hourly_price: float) -> float:
+        return self.idle_seconds / 3600 * hourly_price
+
+
+class EipPool:
+    def __init__(
+        self,
+        client: AcsClient,
+        config: EipConfiguration,
+        size: int = 2,
+        idle_timeout: float = 1800,
+        refill_interval: float = 5,
+        adopt_existing: bool = True,
+    ):
+        self._client = client
+        self._config = config
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._refill_interval = refill_interval
+        self._adopt_existing = adopt_existing
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._eips: Deque[_PooledEip] = deque()
+        self._last_used = monotonic()
+        self.metrics = PoolMetrics()
+        self.last_error: Optional[Exception] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self, release: bool = False) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._drain(release, False)
+
+    def acquire(self) -> Optional[EipInstance]:
+        with self._lock:
+            self._last_used = monotonic()
+            if len(self._eips) == 0:
+                self.metrics.misses += 1
+                item = None
+            else:
+                self.metrics.hits += 1
+                item = self._eips.popleft()
+                self.metrics.idle_seconds += monotonic() - item.added
+        # Refill right away instead of waiting for the next interval
+        self._wakeup.set()
+        # The caller keeps the claim until the eip is bound, see unclaim_eip
+        return item.eip if item is not None else None
+
+    @property
+    def region_id(self) -> str:
+        return self._config.RegionId
+
+    def __len__(self) -> int:
+        return len(self._eips)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            idle_seconds = self.metrics.idle_seconds + sum(
+                monotonic() - item.added for item in self._eips
+            )
+            return {
+                "size": len(self._eips),
+                "hits": self.metrics.hits,
+                "misses": self.metrics.misses,
+                "hit_rate": self.metrics.hit_rate,
+                "allocated": self.metrics.allocated,
+                "adopted": self.metrics.adopted,
+                "released": self.metrics.released,
+                "idle_seconds": idle_seconds,
+            }
+
+    def _run(self) -> None:
+        if self._adopt_existing:
+            self._guard(self._adopt)
+        while not self._stopped.is_set():
+            self._guard(self._trim)
+            self._guard(self._refill)
+            self._wakeup.wait(self._refill_interval)
+            self._wakeup.clear()
+
+    def _guard(self, step) -> None:
+        # Keep the background thread alive, the next round will try again
+        try:
+            step()
+        except Exception as e:
+            self.last_error = e
+
+    def _idle(self) -> bool:
+        return monotonic() - self._last_used > self.idle_timeout
+
+    def _adopt(self) -> None:
+        for eip in get_available_eip(
+            self._client, EipStatus.available, self._config.RegionId
+        ):
+            if len(self._eips) >= self.size:
+                return
+            if matches_config(eip, self._config) and claim_eip(eip.AllocationId):
+                with self._lock:
+                    self._eips.append(_PooledEip(eip, monotonic(), False))
+                    self.metrics.adopted += 1
+
+    def _refill(self) -> None:
+        while (
+            not self._stopped.is_set()
+            and not self._idle()
+            and len(self._eips) < self.size
+        ):
+            eip = allocate_eip(self._client, self._config, False)
+            claim_eip(eip.AllocationId)
+            with self._lock:
+                self._eips.append(_PooledEip(eip, monotonic(), True))
+                self.metrics.allocated += 1
+
+    def _trim(self) -> None:
+        # Nobody has asked for an eip in a while, stop paying for idle ones
+        if self._idle():
+            self._drain(True, True)
+
+    def _drain(self, release: bool, keep_failed: bool) -> None:
+        # One eip at a time, so a failed release loses track of no other eip
+        while True:
+            with self._lock:
+                if len(self._eips) == 0:
+                    return
+                item = self._eips.popleft()
+            try:
+                self._retire(item, release and item.owned)
+            except Exception as e:
+                self.last_error = e
+                print(
+                    f"Failed to release the pooled eip {item.eip.AllocationId}: {e}",
+                    file=sys.stderr,
+                )
+                if keep_failed:
+                    # Released on a later round
+                    with self._lock:
+                        self._eips.appendleft(item)
+                    return
+                # Left available, so a later run can still adopt it
+                unclaim_eip(item.eip.AllocationId)
+
+    def _retire(self, item: _PooledEip, release: bool) -> None:
+        if release:
+            release_eip(self._client, item.eip)
+        with self._lock:
+            self.metrics.idle_seconds += monotonic() - item.added
+            if release:
+                self.metrics.released += 1
+        unclaim_eip(item.eip.AllocationId)
+
+
+class EipPoolRegistry:
+    # One running pool per account and eip configuration, started on first use
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools: Dict[Tuple, EipPool] = {}
+
+    def get(
+        self,
+        client: AcsClient,
+        config: EipConfiguration,
+        size: int,
+        idle_timeout: float,
+    ) -> EipPool:
+        key = (client.get_access_key(), astuple(config))
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = EipPool(client, config, size, idle_timeout)
+                pool.start()
+            else:
+                # The configuration may have changed since the pool was started
+                pool.size = size
+                pool.idle_timeout = idle_timeout
+            return pool
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            pools = list(self._pools.values())
+        return {pool.region_id: pool.stats() for pool in pools}
+
+    def close(self) -> None:
+        # Releases what the pools allocated, the adopted eips stay available
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.stop(release=True)
+
+
+# Set by the agent, whose pools stay warm between commands and are trimmed
+# once idle; other processes allocate eips on demand
+hosted_pools: Optional[EipPoolRegistry] = None
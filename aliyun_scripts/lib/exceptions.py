@@ -1,6 +1,36 @@
+from typing import Optional
+
+
 class UnbindFailureError(Exception):
     pass
 
 
 class AllocationFailureError(Exception):
     pass
+
+
+class WaitTimeoutError(Exception):
+    def __init__(self, till_status: str, last_status: Optional[str], elapsed: float):
+        super().__init__(
+            f"Gave up waiting for status {till_status} after {elapsed:.1f}s, "
+            f"last observed status was {last_status}"
+        )
+        self.till_status = till_status
+        self.last_status = last_status
+        self.elapsed = elapsed
+
+
+class DeadlineExceededError(Exception):
+    def __init__(self, action: str, deadline: float):
+        super().__init__(f"{action} did not answer within {deadline:.1f}s")
+        self.action = action
+        self.deadline = deadline
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(
+            f"{endpoint} kept failing, calls to it fail fast for another {retry_in:.1f}s"
+        )
+        self.endpoint = endpoint
+        self.retry_in = retry_in
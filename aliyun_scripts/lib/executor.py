@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from functools import partial
+from time import monotonic
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Sequence
+
+from typing_extensions import Literal
+
+from aliyun_scripts.lib.actions import shutdown_ecs, start_ecs
+from aliyun_scripts.lib.instances import EcsInstance, EcsStatus
+from aliyun_scripts.lib.poller import StatusPoller
+from aliyun_scripts.lib.tracing import traced
+from aliyun_scripts.lib.utils import wait_ecs_status
+
+if TYPE_CHECKING:
+    from aliyunsdkcore.client import AcsClient
+
+DEFAULT_CONCURRENCY = 8
+
+
+@dataclass
+class TaskResult:
+    target: EcsInstance
+    result: Any = None
+    error: Optional[BaseException] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _run_task(func: Callable[[EcsInstance], Any], ecs: EcsInstance) -> TaskResult:
+    try:
+        return TaskResult(ecs, result=func(ecs))
+    except Exception as e:
+        return TaskResult(ecs, error=e)
+
+
+def run_concurrently(
+    func: Callable[[EcsInstance], Any],
+    ecs_list: Sequence[EcsInstance],
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> List[TaskResult]:
+    if concurrency < 1:
+        raise ValueError("The concurrency needs to be at least 1")
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(ecs_list) or 1)) as pool:
+        return list(pool.map(partial(_run_task, func), ecs_list))
+
+
+@dataclass
+class RolloutResult:
+    results: List[TaskResult]
+    # Never started because the rollout was aborted
+    skipped: List[EcsInstance] = field(default_factory=list)
+    wall_time: float = 0
+
+    @property
+    def aborted(self) -> bool:
+        return len(self.skipped) > 0
+
+    @property
+    def failed(self) -> List[TaskResult]:
+        return [result for result in self.results if not result.ok]
+
+
+def parse_budget(value: str, total: int) -> int:
+    # "3" means 3 ecs and "25%" a quarter of them, rounded down
+    if value.endswith("%"):
+        return int(total * float(value[:-1]) / 100)
+    return int(value)
+
+
+def run_rolling(
+    func: Callable[[EcsInstance], Any],
+    ecs_list: Sequence[EcsInstance],
+    max_in_flight: int,
+    max_failures: int = 0,
+    cb: Optional[Callable[[TaskResult], Any]] = None,
+) -> RolloutResult:
+    # Keeps max_in_flight ecs busy, starting the next one whenever one is done,
+    # and stops starting new ones once more than max_failures have failed
+    if max_in_flight < 1:
+        raise ValueError("At least one ecs needs to be handled at a time")
+
+    started = monotonic()
+    pending = list(reversed(ecs_list))
+    results: Dict[int, TaskResult] = {}
+    failures = 0
+    with ThreadPoolExecutor(max_workers=min(max_in_flight, len(ecs_list) or 1)) as pool:
+        in_flight: Dict[Future, int] = {}
+        while len(pending) > 0 or len(in_flight) > 0:
+            while (
+                len(pending) > 0
+                and len(in_flight) < max_in_flight
+                and failures <= max_failures
+            ):
+                index = len(ecs_list) - len(pending)
+                in_flight[pool.submit(_run_task, func, pending.pop())] = index
+            if len(in_flight) == 0:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results[in_flight.pop(future)] = result
+                if not result.ok:
+                    failures += 1
+                if cb is not None:
+                    cb(result)
+    return RolloutResult(
+        [results[index] for index in sorted(results)],
+        list(reversed(pending)),
+        monotonic() - started,
+    )
+
+
+def start_many(
+    client: AcsClient,
+    ecs_list: Sequence[EcsInstance],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    cb: Optional[Callable[[EcsInstance], Any]] = None,
+) -> List[TaskResult]:
+    poller = StatusPoller(client)
+
+    @traced("start ecs")
+    def start(ecs: EcsInstance) -> str:
+        result = start_ecs(client, ecs)
+        wait_ecs_status(
+            client,
+            ecs,
+            EcsStatus.running,
+            (lambda: cb(ecs)) if cb is not None else None,
+            poller=poller,
+        )
+        return result
+
+    return run_concurrently(start, ecs_list, concurrency)
+
+
+def shutdown_many(
+    client: AcsClient,
+    ecs_list: Sequence[EcsInstance],
+    stopped_mode: Literal["StopCharging", "KeepCharing"],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    cb: Optional[Callable[[EcsInstance], Any]] = None,
+    force_stop: bool = False,
+) -> List[TaskResult]:
+    poller = StatusPoller(client)
+
+    @traced("stop ecs")
+    def shutdown(ecs: EcsInstance) -> str:
+        result = shutdown_ecs(client, ecs, stopped_mode, force_stop)
+        wait_ecs_status(
+            client,
+            ecs,
+            EcsStatus.stopped,
+            (lambda: cb(ecs)) if cb is not None else None,
+            poller=poller,
+        )
+        return result
+
+    return run_concurrently(shutdown, ecs_list, concurrency)
@@ -0,0 +1,480 @@
+import copy
+import itertools
+import json
+import random
+import threading
+import uuid
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from time import monotonic, sleep
+from typing import Any, Callable, Deque, Dict, List, Optional, Union
+
+from aliyun_scripts.lib.instances import EcsStatus, EipStatus
+
+# A latency is either a fixed number of seconds or a function returning one
+Latency = Union[float, Callable[[], float]]
+
+
+def constant(seconds: float) -> Callable[[], float]:
+    return lambda: seconds
+
+
+def uniform(low: float, high: float) -> Callable[[], float]:
+    return lambda: random.uniform(low, high)
+
+
+def lognormal(median: float, sigma: float = 0.5) -> Callable[[], float]:
+    # Api latencies have a long tail, a log-normal distribution models that well
+    return lambda: median * random.lognormvariate(0, sigma)
+
+
+DEFAULT_TRANSITION_DELAYS: Dict[str, Latency] = {
+    EcsStatus.starting.value: 1,
+    EcsStatus.stopping.value: 1,
+    EipStatus.associating.value: 0.3,
+    EipStatus.unassociating.value: 0.3,
+}
+
+_SETTLED_STATUS = {
+    EcsStatus.starting.value: EcsStatus.running.value,
+    EcsStatus.stopping.value: EcsStatus.stopped.value,
+    EipStatus.associating.value: EipStatus.in_use.value,
+    EipStatus.unassociating.value: EipStatus.available.value,
+}
+
+
+class FakeApiError(Exception):
+    def __init__(self, code: str, message: str, http_status: int = 400):
+        super().__init__(f"{code}: {message}")
+        self.error_code = code
+        self.message = message
+        self.http_status = http_status
+
+
+@dataclass
+class _FakeEcs:
+    InstanceId: str
+    InstanceName: str
+    RegionId: str
+    Status: str
+    Tags: Dict[str, str] = field(default_factory=dict)
+    AllocationId: Optional[str] = None
+    settles_at: float = 0
+
+
+@dataclass
+class _FakeEip:
+    AllocationId: str
+    IpAddress: str
+    RegionId: str
+    Bandwidth: str
+    InternetChargeType: str
+    Status: str
+    InstanceId: Optional[str] = None
+    ISP: str = "BGP"
+    ChargeType: str = "PostPaid"
+    settles_at: float = 0
+
+
+def _sample(latency: Latency) -> float:
+    return latency() if callable(latency) else latency
+
+
+def _settle(resource: Union[_FakeEcs, _FakeEip], now: float) -> str:
+    if resource.Status in _SETTLED_STATUS and now >= resource.settles_at:
+        resource.Status = _SETTLED_STATUS[resource.Status]
+    return resource.Status
+
+
+def _page(items: List[dict], params: Dict[str, Any]) -> Dict[str, Any]:
+    page_size = int(params.get("PageSize", 10))
+    page_number = int(params.get("PageNumber", 1))
+    start = (page_number - 1) * page_size
+    return {
+        "TotalCount": len(items),
+        "PageNumber": page_number,
+        "PageSize": page_size,
+        "items": items[start : start + page_size],
+    }
+
+
+# An in-memory stand-in for AcsClient that understands the ECS and VPC actions
+# used by this project, for benchmarks and trying things out without an account
+class FakeAcsClient:
+    def __init__(
+        self,
+        region_id: str = "cn-hangzhou",
+        latency: Latency = 0,
+        transition_delays: Optional[Dict[str, Latency]] = None,
+        throttle_rate: float = 0,
+        qps_limits: Optional[Dict[str, float]] = None,
+    ):
+        self._region_id = region_id
+        self.latency = latency
+        self.transition_delays = {
+            **DEFAULT_TRANSITION_DELAYS,
+            **(transition_delays or {}),
+        }
+        # Probability that any call is rejected with a Throttling error
+        self.throttle_rate = throttle_rate
+        # Calls per second accepted for each action before throttling kicks in
+        self.qps_limits = dict(qps_limits or {})
+        self.calls: Counter = Counter()
+        self.throttled: Counter = Counter()
+        self._lock = threading.Lock()
+        self._ecs: Dict[str, _FakeEcs] = {}
+        self._eips: Dict[str, _FakeEip] = {}
+        self._recent_calls: Dict[str, Deque[float]] = {}
+        # action -> errors raised by its next calls, see fail
+        self._failures: Dict[str, Deque[FakeApiError]] = {}
+        self._ids = itertools.count(1)
+
+    def get_region_id(self) -> str:
+        return self._region_id
+
+    def with_region(self, region_id: str) -> "FakeAcsClient":
+        # Another client of the same account, like ClientRegistry.for_region
+        client = copy.copy(self)
+        client._region_id = region_id
+        return client
+
+    def get_access_key(self) -> str:
+        return "fake-access-key"
+
+    def get_access_secret(self) -> str:
+        return "fake-access-secret"
+
+    def get_port(self) -> int:
+        return 80
+
+    def add_ecs(
+        self,
+        instance_id: Optional[str] = None,
+        name: Optional[str] = None,
+        status: EcsStatus = EcsStatus.running,
+        region_id: Optional[str] = None,
+        tags: Optional[Dict[str, str]] = None,
+        eip: bool = False,
+    ) -> str:
+        n = next(self._ids)
+        ecs = _FakeEcs(
+            instance_id or f"i-fake{n:08d}",
+            name or f"fake-ecs-{n}",
+            region_id or self._region_id,
+            status.value,
+            dict(tags or {}),
+        )
+        with self._lock:
+            self._ecs[ecs.InstanceId] = ecs
+        if eip:
+            allocation_id = self.add_eip(ecs.RegionId)
+            with self._lock:
+                self._eips[allocation_id].Status = EipStatus.in_use.value
+                self._eips[allocation_id].InstanceId = ecs.InstanceId
+                ecs.AllocationId = allocation_id
+        return ecs.InstanceId
+
+    def add_eip(
+        self,
+        region_id: Optional[str] = None,
+        bandwidth: int = 5,
+        internet_charge_type: str = "PayByTraffic",
+        isp: str = "BGP",
+        charge_type: str = "PostPaid",
+    ) -> str:
+        with self._lock:
+            return self._new_eip(
+                region_id or self._region_id,
+                bandwidth,
+                internet_charge_type,
+                isp,
+                charge_type,
+            ).AllocationId
+
+    def _new_eip(
+        self,
+        region_id: str,
+        bandwidth: int,
+        internet_charge_type: str,
+        isp: str,
+        charge_type: str,
+    ) -> _FakeEip:
+        n = next(self._ids)
+        eip = _FakeEip(
+            f"eip-fake{n:08d}",
+            f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}",
+            region_id,
+            str(bandwidth),
+            internet_charge_type,
+            EipStatus.available.value,
+            ISP=isp,
+            ChargeType=charge_type,
+        )
+        self._eips[eip.AllocationId] = eip
+        return eip
+
+    def fail(
+        self,
+        action: str,
+        code: str = "ServiceUnavailable",
+        http_status: int = 503,
+        times: int = 1,
+    ) -> None:
+        # The next calls of action are rejected with this error before they
+        # change anything
+        with self._lock:
+            self._failures.setdefault(action, deque()).extend(
+                FakeApiError(code, f"Injected failure of {action}", http_status)
+                for _ in range(times)
+            )
+
+    def do_action_with_exception(self, request: Any) -> bytes:
+        from aliyunsdkcore.acs_exception.exceptions import ServerException
+
+        params = {**request.get_query_params(), **request.get_body_params()}
+        try:
+            result = self.handle(request.get_action_name(), params)
+        except FakeApiError as e:
+            raise ServerException(
+                e.error_code, e.message, e.http_status, str(uuid.uuid4())
+            )
+        return json.dumps(result).encode()
+
+    def handle(self, action: str, params: Dict[str, Any]) -> dict:
+        sleep(_sample(self.latency))
+        self._check_throttling(action)
+        with self._lock:
+            failures = self._failures.get(action)
+            failure = failures.popleft() if failures else None
+        if failure is not None:
+            raise failure
+        handler = getattr(self, f"_{action}", None)
+        if handler is None:
+            raise FakeApiError("InvalidAction.NotFound", f"{action} is not supported")
+        region_id = params.get("RegionId") or self._region_id
+        with self._lock:
+            result = handler(params, region_id, monotonic())
+        return {"RequestId": str(uuid.uuid4()), **result}
+
+    def _check_throttling(self, action: str) -> None:
+        with self._lock:
+            self.calls[action] += 1
+            throttled = random.random() < self.throttle_rate
+            limit = self.qps_limits.get(action)
+            if limit is not None and not throttled:
+                now = monotonic()
+                recent = self._recent_calls.setdefault(action, deque())
+                while len(recent) > 0 and now - recent[0] >= 1:
+                    recent.popleft()
+                throttled = len(recent) >= limit
+                if not throttled:
+                    recent.append(now)
+            if throttled:
+                self.throttled[action] += 1
+        if throttled:
+            raise FakeApiError(
+                "Throttling.User", "Request was denied due to user flow control."
+            )
+
+    def _get_ecs(self, params: Dict[str, Any]) -> _FakeEcs:
+        ecs = self._ecs.get(params.get("InstanceId", ""))
+        if ecs is None:
+            raise FakeApiError(
+                "InvalidInstanceId.NotFound",
+                "The specified InstanceId does not exist.",
+                404,
+            )
+        return ecs
+
+    def _get_eip(self, params: Dict[str, Any]) -> _FakeEip:
+        eip = self._eips.get(params.get("AllocationId", ""))
+        if eip is None:
+            raise FakeApiError(
+                "InvalidAllocationId.NotFound",
+                "The specified AllocationId does not exist.",
+                404,
+            )
+        return eip
+
+    def _transition(
+        self, resource: Union[_FakeEcs, _FakeEip], status: str, now: float
+    ) -> None:
+        resource.Status = status
+        resource.settles_at = now + _sample(self.transition_delays[status])
+
+    def _describe_ecs(self, ecs: _FakeEcs, now: float) -> dict:
+        eip = self._eips.get(ecs.AllocationId or "")
+        return {
+            "InstanceId": ecs.InstanceId,
+            "InstanceName": ecs.InstanceName,
+            "Status": _settle(ecs, now),
+            "RegionId": ecs.RegionId,
+            "EipAddress": {
+                "AllocationId": eip.AllocationId if eip is not None else "",
+                "IpAddress": eip.IpAddress if eip is not None else "",
+                "Bandwidth": int(eip.Bandwidth) if eip is not None else 0,
+                "InternetChargeType": eip.InternetChargeType if eip is not None else "",
+                "IsSupportUnassociate": True,
+            },
+        }
+
+    def _describe_eip(self, eip: _FakeEip, now: float) -> dict:
+        return {
+            "AllocationId": eip.AllocationId,
+            "IpAddress": eip.IpAddress,
+            "RegionId": eip.RegionId,
+            "Bandwidth": eip.Bandwidth,
+            "InternetChargeType": eip.InternetChargeType,
+            "Status": _settle(eip, now),
+            "InstanceId": eip.InstanceId or "",
+            "ISP": eip.ISP,
+            "ChargeType": eip.ChargeType,
+        }
+
+    def _DescribeInstances(
+        self, params: Dict[str, Any], region_id: str, now: float
+    ) -> dict:
+        candidates = [ecs for ecs in self._ecs.values() if ecs.RegionId == region_id]
+        if "InstanceIds" in params:
+            instance_ids = set(json.loads(params["InstanceIds"]))
+            candidates = [ecs for ecs in candidates if ecs.InstanceId in instance_ids]
+        i = 1
+        while f"Tag.{i}.Key" in params:
+            key, value = params[f"Tag.{i}.Key"], params.get(f"Tag.{i}.Value")
+            candidates = [
+                ecs
+                for ecs in candidates
+                if key in ecs.Tags and (value is None or ecs.Tags[key] == value)
+            ]
+            i += 1
+        instances = [self._describe_ecs(ecs, now) for ecs in candidates]
+        if "Status" in params:
+            instances = [ecs for ecs in instances if ecs["Status"] == params["Status"]]
+        page = _page(instances, params)
+        return {**page, "Instances": {"Instance": page.pop("items")}}
+
+    def _DescribeEipAddresses(
+        self, params: Dict[str, Any], region_id: str, now: float
+    ) -> dict:
+        candidates = [eip for eip in self._eips.values() if eip.RegionId == region_id]
+        if "AllocationId" in params:
+            allocation_ids = set(params["AllocationId"].split(","))
+            candidates = [
+                eip for eip in candidates if eip.AllocationId in allocation_ids
+            ]
+        eips = [self._describe_eip(eip, now) for eip in candidates]
+        if "Status" in params:
+            eips = [eip for eip in eips if eip["Status"] == params["Status"]]
+        page = _page(eips, params)
+        return {**page, "EipAddresses": {"EipAddress": page.pop("items")}}
+
+    def _DescribeRegions(
+        self, params: Dict[str, Any], region_id: str, now: float
+    ) -> dict:
+        region_ids = sorted(
+            {self._region_id}
+            | {ecs.RegionId for ecs in self._ecs.values()}
+            | {eip.RegionId for eip in self._eips.values()}
+        )
+        return {
+            "Regions": {
+                "Region": [
+                    {
+                        "RegionId": region_id,
+                        "LocalName": region_id,
+                        "RegionEndpoint": f"ecs.{region_id}.aliyuncs.com",
+                    }
+                    for region_id in region_ids
+                ]
+            }
+        }
+
+    def _StartInstance(
+        self, params: Dict[str, Any], region_id: str, now: float
+    ) -> dict:
+        ecs = self._get_ecs(params)
+        if _settle(ecs, now) != EcsStatus.stopped.value:
+            raise FakeApiError(
+                "IncorrectInstanceStatus",
+                "The current status of the resource does not support this operation.",
+                403,
+            )
+        self._transition(ecs, EcsStatus.starting.value, now)
+        return {}
+
+    def _StopInstance(self, params: Dict[str, Any], region_id: str, now: float) -> dict:
+        ecs = self._get_ecs(params)
+        if _settle(ecs, now) != EcsStatus.running.value:
+            raise FakeApiError(
+                "IncorrectInstanceStatus",
+                "The current status of the resource does not support this operation.",
+                403,
+            )
+        self._transition(ecs, EcsStatus.stopping.value, now)
+        return {}
+
+    def _AllocateEipAddress(
+        self, params: Dict[str, Any], region_id: str, now: float
+    ) -> dict:
+        eip = self._new_eip(
+            region_id,
+            params.get("Bandwidth", params.get("BandWidth", 5)),
+            params.get("InternetChargeType", "PayByTraffic"),
+            params.get("ISP", "BGP"),
+            params.get("InstanceChargeType", "PostPaid"),
+        )
+        return {"AllocationId": eip.AllocationId, "EipAddress": eip.IpAddress}
+
+    def _AssociateEipAddress(
+        self, params: Dict[str, Any], region_id: str, now: float
+    ) -> dict:
+        eip = self._get_eip(params)
+        ecs = self._get_ecs(params)
+        if _settle(eip, now) != EipStatus.available.value:
+            raise FakeApiError(
+                "IncorrectEipStatus",
+                "The current status of the resource does not support this operation.",
+                403,
+            )
+        if ecs.AllocationId is not None:
+            raise FakeApiError(
+                "InvalidAssociation.Duplicated",
+                "The specified instance is already associated with an eip.",
+                403,
+            )
+        eip.InstanceId = ecs.InstanceId
+        ecs.AllocationId = eip.AllocationId
+        self._transition(eip, EipStatus.associating.value, now)
+        return {}
+
+    def _UnassociateEipAddress(
+        self, params: Dict[str, Any], region_id: str, now: float
+    ) -> dict:
+        eip = self._get_eip(params)
+        ecs = self._get_ecs(params)
+        if (
+            _settle(eip, now) != EipStatus.in_use.value
+            or eip.InstanceId != ecs.InstanceId
+        ):
+            raise FakeApiError(
+                "IncorrectEipStatus",
+                "The current status of the resource does not support this operation.",
+                403,
+            )
+        eip.InstanceId = None
+        ecs.AllocationId = None
+        self._transition(eip, EipStatus.unassociating.value, now)
+        return {}
+
+    def _ReleaseEipAddress(
+        self, params: Dict[str, Any], region_id: str, now: float
+    ) -> dict:
+        eip = self._get_eip(params)
+        if _settle(eip, now) != EipStatus.available.value:
+            raise FakeApiError(
+                "IncorrectEipStatus",
+                "The current status of the resource does not support this operation.",
+                403,
+            )
+        del self._eips[eip.AllocationId]
+        return {}
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Set
+from urllib.parse import parse_qsl, quote, urlsplit
+
+from aliyun_scripts.lib.fake_client import FakeAcsClient, FakeApiError
+
+if TYPE_CHECKING:
+    from aliyunsdkcore.client import AcsClient
+
+# Products whose endpoints connect() points at the server
+PRODUCTS = ["Ecs", "Vpc"]
+
+
+def _percent_encode(value: str) -> str:
+    return quote(value, safe="~")
+
+
+def string_to_sign(method: str, params: Dict[str, str]) -> str:
+    # RPC signature version 1.0, as composed by aliyunsdkcore
+    query = "&".join(
+        f"{_percent_encode(k)}={_percent_encode(v)}"
+        for k, v in sorted(params.items())
+        if k != "Signature"
+    )
+    return f"{method}&%2F&{_percent_encode(query)}"
+
+
+def sign(method: str, params: Dict[str, str], secret: str) -> str:
+    digest = hmac.new(
+        f"{secret}&".encode(),
+        string_to_sign(method, params).encode(),
+        hashlib.sha1,
+    ).digest()
+    return base64.b64encode(digest).decode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keeps connections open, so the client's connection pool is exercised
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which Nagle would delay
+    disable_nagle_algorithm = True
+    server: FakeAcsServer
+
+    def do_GET(self) -> None:
+        self._handle()
+
+    def do_POST(self) -> None:
+        self._handle()
+
+    def _handle(self) -> None:
+        params = dict(parse_qsl(urlsplit(self.path).query, keep_blank_values=True))
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > 0:
+            body = self.rfile.read(length).decode()
+            params.update(parse_qsl(body, keep_blank_values=True))
+        try:
+            self.server.check_signature(self.command, params)
+            result = self.server.fake.handle(params.get("Action", ""), params)
+            self._reply(200, result)
+        except FakeApiError as e:
+            self._reply(
+                e.http_status,
+                {
+                    "RequestId": str(uuid.uuid4()),
+                    "Code": e.error_code,
+                    "Message": e.message,
+                },
+            )
+
+    def _reply(self, status: int, result: dict) -> None:
+        body = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+# Serves the ECS and VPC RPC actions of a FakeAcsClient over HTTP and checks
+# the signatures, so requests go through the real AcsClient: signing, the
+# connection pool, retries and response decoding
+class FakeAcsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        fake: FakeAcsClient,
+        credentials: Dict[str, str],
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        super().__init__((host, port), _Handler)
+        self.fake = fake
+        # access key id -> secret
+        self.credentials = credentials
+        self._nonces: Set[str] = set()
+        self._nonces_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def check_signature(self, method: str, params: Dict[str, str]) -> None:
+        secret = self.credentials.get(params.get("AccessKeyId", ""))
+        if secret is None:
+            raise FakeApiError(
+                "InvalidAccessKeyId.NotFound", "Specified access key is not found."
+            )
+        expected = sign(method, params, secret)
+        if not hmac.compare_digest(expected, params.get("Signature", "")):
+            # The sdk compares the part after the colon with its own string
+            raise FakeApiError(
+                "SignatureDoesNotMatch",
+                "Specified signature is not matched with our calculation. server string to sign is:"
+                + string_to_sign(method, params),
+            )
+        with self._nonces_lock:
+            nonce = params.get("SignatureNonce", "")
+            if nonce in self._nonces:
+                raise FakeApiError(
+                    "SignatureNonceUsed", "Specified signature nonce was used already."
+                )
+            self._nonces.add(nonce)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> FakeAcsServer:
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def connect(
+        self,
+        access_key_id: str,
+        region_id: str = "cn-hangzhou",
+        regions: Iterable[str] = (),
+        **kwargs,
+    ) -> AcsClient:
+        # An AcsClient whose ECS and VPC endpoints are this server
+        from aliyunsdkcore.client import AcsClient
+
+        kwargs.setdefault("auto_retry", False)
+        client = AcsClient(
+            ak=access_key_id,
+            secret=self.credentials[access_key_id],
+            region_id=region_id,
+            port=self.port,
+            **kwargs,
+        )
+        host = f"http://{self.server_address[0]}"
+        for region in {region_id, *regions}:
+            for product in PRODUCTS:
+                client.add_endpoint(region, product, host)
+        return client
@@ -19,6 +19,12 @@ class EipInstance:
     Bandwidth: Optional[int] = None
     InternetChargeType: Optional[str] = None
     IsSupportUnassociate: Optional[bool] = None
+    Status: Optional[str] = None
+    RegionId: Optional[str] = None
+    InstanceId: Optional[str] = None
+    ISP: Optional[str] = None
+    # PostPaid or PrePaid, the InstanceChargeType it was allocated with
+    ChargeType: Optional[str] = None
 
 
 @dataclass
@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def error_code(error: Exception) -> str:
+    # Both ServerException and ClientException carry an error_code
+    code = getattr(error, "error_code", None)
+    return code if isinstance(code, str) and code != "" else type(error).__name__
+
+
+@dataclass
+class RequestMetrics:
+    calls: int = 0
+    response_bytes: int = 0
+    latency_sum: float = 0
+    # Non-cumulative counts, the last one is for latencies above every bucket
+    latency_counts: List[int] = field(
+        default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1)
+    )
+    errors: Dict[str, int] = field(default_factory=dict)
+
+    def observe(
+        self, latency: float, response_bytes: int, error: Optional[str]
+    ) -> None:
+        self.calls += 1
+        self.response_bytes += response_bytes
+        self.latency_sum += latency
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.latency_counts[i] += 1
+                break
+        else:
+            self.latency_counts[-1] += 1
+        if error is not None:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": dict(self.errors),
+            "response_bytes": self.response_bytes,
+            "latency_sum": self.latency_sum,
+            "latency_buckets": {
+                str(bound): count
+                for bound, count in zip(
+                    LATENCY_BUCKETS + ("+Inf",), self.latency_counts
+                )
+            },
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests: Dict[Tuple[str, str], RequestMetrics] = {}
+
+    def record(
+        self,
+        request: str,
+        region_id: str,
+        latency: float,
+        response_bytes: int = 0,
+        error: Optional[str] = None,
+    ) -> None:
+        with self._lock:
+            metrics = self._requests.get((request, region_id))
+            if metrics is None:
+                metrics = self._requests[(request, region_id)] = RequestMetrics()
+            metrics.observe(latency, response_bytes, error)
+
+    def get(self, request: str, region_id: str) -> Optional[dict]:
+        with self._lock:
+            metrics = self._requests.get((request, region_id))
+            return metrics.to_dict() if metrics is not None else None
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            return [
+                {"request": request, "region": region_id, **metrics.to_dict()}
+                for (request, region_id), metrics in sorted(self._requests.items())
+            ]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._requests.clear()
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        lines = [
+            "# HELP aliyun_api_requests_total Api calls sent, including failed ones",
+            "# TYPE aliyun_api_requests_total counter",
+        ]
+        records = self.snapshot()
+        for record in records:
+            lines.append(
+                f"aliyun_api_requests_total{_labels(record)} {record['calls']}"
+            )
+
+        lines.append("# HELP aliyun_api_errors_total Failed api calls by error code")
+        lines.append("# TYPE aliyun_api_errors_total counter")
+        for record in records:
+            for code, count in sorted(record["errors"].items()):
+                lines.append(
+                    f"aliyun_api_errors_total{_labels(record, code=code)} {count}"
+                )
+
+        lines.append("# HELP aliyun_api_response_bytes_total Bytes of api responses")
+        lines.append("# TYPE aliyun_api_response_bytes_total counter")
+        for record in records:
+            lines.append(
+                f"aliyun_api_response_bytes_total{_labels(record)} {record['response_bytes']}"
+            )
+
+        lines.append("# HELP aliyun_api_request_duration_seconds Api call latency")
+        lines.append("# TYPE aliyun_api_request_duration_seconds histogram")
+        for record in records:
+            total = 0
+            for bound, count in record["latency_buckets"].items():
+                total += count
+                lines.append(
+                    f"aliyun_api_request_duration_seconds_bucket{_labels(record, le=bound)} {total}"
+                )
+            lines.append(
+                f"aliyun_api_request_duration_seconds_sum{_labels(record)} {record['latency_sum']}"
+            )
+            lines.append(
+                f"aliyun_api_request_duration_seconds_count{_labels(record)} {record['calls']}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str) -> None:
+        # The format follows the extension, Prometheus text unless it is .json
+        text = self.to_json() if path.endswith(".json") else self.to_prometheus()
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+
+
+def _labels(record: dict, **extra: str) -> str:
+    labels = {"request": record["request"], "region": record["region"], **extra}
+    return (
+        "{"
+        + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items())
+        + "}"
+    )
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = MetricsRegistry()
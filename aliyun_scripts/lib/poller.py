@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from enum import Enum
+from time import monotonic
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from aliyun_scripts.lib.actions import get_available_ecs, get_available_eip
+from aliyun_scripts.lib.exceptions import WaitTimeoutError
+from aliyun_scripts.lib.instances import EcsStatus, EipStatus
+from aliyun_scripts.lib.polling import DEFAULT_POLICY, WaitPolicy
+from aliyun_scripts.lib.tracing import tracer
+
+if TYPE_CHECKING:
+    from aliyunsdkcore.client import AcsClient
+
+
+@dataclass
+class _Waiter:
+    till_status: Enum
+    deadline: float
+    transition: str
+    # Delays between polls, as wait_status would sleep them
+    delays: Iterator[float]
+    cb: Optional[Callable[[], Any]] = None
+    started: float = field(default_factory=monotonic)
+    # Polled right away, like the first poll of wait_status
+    next_poll: float = field(default_factory=monotonic)
+    future: Future = field(default_factory=Future)
+
+
+class StatusPoller:
+    def __init__(self, client: AcsClient, min_interval: float = 0.3):
+        self._client = client
+        # Ticks are at least this far apart, and every waiter due before the
+        # next one could happen is polled on the current tick
+        self._min_interval = min_interval
+        self._last_tick = 0.0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        # Set when a waiter is registered, so its first poll is not held back
+        # by the ones already waiting
+        self._wakeup = threading.Event()
+        self._ecs_waiters: Dict[str, List[_Waiter]] = {}
+        # Eips are described per region, so they are keyed by (region, allocation id)
+        self._eip_waiters: Dict[Tuple[str, str], List[_Waiter]] = {}
+        self.ticks = 0
+
+    def wait_ecs(
+        self,
+        instance_id: str,
+        till_status: EcsStatus,
+        timeout: float,
+        cb: Optional[Callable[[], Any]] = None,
+        policy: WaitPolicy = DEFAULT_POLICY,
+    ) -> Future:
+        waiter = _Waiter(
+            till_status,
+            monotonic() + timeout,
+            f"ecs:{till_status.value}",
+            policy.delays(),
+            cb,
+        )
+        with self._lock:
+            self._ecs_waiters.setdefault(instance_id, []).append(waiter)
+            self._ensure_running()
+        self._wakeup.set()
+        return waiter.future
+
+    def wait_eip(
+        self,
+        allocation_id: str,
+        till_status: EipStatus,
+        region_id: str,
+        timeout: float,
+        cb: Optional[Callable[[], Any]] = None,
+        policy: WaitPolicy = DEFAULT_POLICY,
+    ) -> Future:
+        waiter = _Waiter(
+            till_status,
+            monotonic() + timeout,
+            f"eip:{till_status.value}",
+            policy.delays(),
+            cb,
+        )
+        with self._lock:
+            self._eip_waiters.setdefault((region_id, allocation_id), []).append(waiter)
+            self._ensure_running()
+        self._wakeup.set()
+        return waiter.future
+
+    def _ensure_running(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _next_poll(self) -> Optional[float]:
+        waiters = [
+            waiter
+            for waiters in (*self._ecs_waiters.values(), *self._eip_waiters.values())
+            for waiter in waiters
+        ]
+        return min(w.next_poll for w in waiters) if len(waiters) > 0 else None
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                next_poll = self._next_poll()
+                if next_poll is None:
+                    self._thread = None
+                    return
+            next_poll = max(next_poll, self._last_tick + self._min_interval)
+            if next_poll > monotonic():
+                # A waiter registered meanwhile may be due earlier
+                with tracer.span("poller sleep", "wait"):
+                    self._wakeup.wait(next_poll - monotonic())
+                    self._wakeup.clear()
+                continue
+            with self._lock:
+                horizon = monotonic() + self._min_interval
+                ecs_ids = self._due(self._ecs_waiters, horizon)
+                eip_keys = self._due(self._eip_waiters, horizon)
+            self.ticks += 1
+            self._last_tick = monotonic()
+            with tracer.span(
+                "poller tick", "wait", ecs=len(ecs_ids), eips=len(eip_keys)
+            ):
+                self._tick(ecs_ids, eip_keys)
+
+    @staticmethod
+    def _due(waiters: Dict[Any, List[_Waiter]], horizon: float) -> List[Any]:
+        return [
+            key
+            for key, key_waiters in waiters.items()
+            if any(waiter.next_poll <= horizon for waiter in key_waiters)
+        ]
+
+    def _tick(self, ecs_ids: List[str], eip_keys: List[Tuple[str, str]]) -> None:
+        if len(ecs_ids) > 0:
+            try:
+                statuses = {
+                    ecs.InstanceId: ecs.Status
+                    for ecs in get_available_ecs(self._client, ecs_ids, fresh=True)
+                }
+            except Exception as e:
+                self._fail(self._ecs_waiters, ecs_ids, e)
+            else:
+                self._resolve(self._ecs_waiters, ecs_ids, statuses.get)
+
+        regions: Dict[str, List[str]] = {}
+        for region_id, allocation_id in eip_keys:
+            regions.setdefault(region_id, []).append(allocation_id)
+        for region_id, allocation_ids in regions.items():
+            keys = [(region_id, allocation_id) for allocation_id in allocation_ids]
+            try:
+                statuses = {
+                    eip.AllocationId: eip.Status
+                    for eip in get_available_eip(
+                        self._client, None, region_id, allocation_ids, fresh=True
+                    )
+                }
+            except Exception as e:
+                self._fail(self._eip_waiters, keys, e)
+            else:
+                self._resolve(self._eip_waiters, keys, lambda key: statuses.get(key[1]))
+
+    def _resolve(
+        self,
+        waiters: Dict[Any, List[_Waiter]],
+        keys: List[Any],
+        get_status: Callable[[Any], Optional[str]],
+    ) -> None:
+        from aliyun_scripts.lib.utils import transition_history
+
+        now = monotonic()
+        horizon = now + self._min_interval
+        finished: List[Tuple[_Waiter, Optional[str]]] = []
+        pending: List[Tuple[Any, _Waiter]] = []
+        with self._lock:
+            for key in keys:
+                status = get_status(key)
+                remaining = []
+                for waiter in waiters.get(key, []):
+                    if waiter.future.done():
+                        # Cancelled by a caller that stopped waiting
+                        continue
+                    if status == waiter.till_status.value or now >= waiter.deadline:
+                        finished.append((waiter, status))
+                    else:
+                        if waiter.next_poll <= horizon:
+                            waiter.next_poll = min(
+                                now + next(waiter.delays), waiter.deadline
+                            )
+                            pending.append((key, waiter))
+                        remaining.append(waiter)
+                if len(remaining) > 0:
+                    waiters[key] = remaining
+                else:
+                    waiters.pop(key, None)
+
+        for waiter, status in finished:
+            elapsed = now - waiter.started
+            if status == waiter.till_status.value:
+                transition_history.record(waiter.transition, elapsed)
+                _settle(waiter.future, result=status)
+            else:
+                _settle(
+                    waiter.future,
+                    error=WaitTimeoutError(waiter.till_status.value, status, elapsed),
+                )
+        for key, waiter in pending:
+            if waiter.cb is None:
+                continue
+            try:
+                waiter.cb()
+            except Exception as e:
+                # Only the waiter whose callback failed gives up
+                with self._lock:
+                    remaining = [w for w in waiters.get(key, []) if w is not waiter]
+                    if len(remaining) > 0:
+                        waiters[key] = remaining
+                    else:
+                        waiters.pop(key, None)
+                _settle(waiter.future, error=e)
+
+    def _fail(
+        self, waiters: Dict[Any, List[_Waiter]], keys: List[Any], error: Exception
+    ) -> None:
+        with self._lock:
+            failed = [waiter for key in keys for waiter in waiters.pop(key, [])]
+        for waiter in failed:
+            _settle(waiter.future, error=error)
+
+
+def _settle(
+    future: Future, result: Any = None, error: Optional[BaseException] = None
+) -> None:
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
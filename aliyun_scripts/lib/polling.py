@@ -0,0 +1,92 @@
+import json
+import os
+import random
+import threading
+from collections import deque
+from dataclasses import dataclass, replace
+from statistics import median
+from typing import Deque, Dict, Iterator, Optional
+
+
+@dataclass(frozen=True)
+class WaitPolicy:
+    # Delay before the second poll; the first poll happens right away
+    first_delay: float = 0.5
+    initial_interval: float = 1
+    multiplier: float = 1.6
+    max_interval: float = 10
+    # Every delay is scaled by a random factor in [1 - jitter, 1 + jitter]
+    jitter: float = 0.2
+    # Seconds after which the wait gives up
+    timeout: float = 120
+
+    def delays(self) -> Iterator[float]:
+        yield self.first_delay
+        interval = self.initial_interval
+        while True:
+            yield interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            interval = min(interval * self.multiplier, self.max_interval)
+
+
+DEFAULT_POLICY = WaitPolicy()
+
+DEFAULT_POLICIES: Dict[str, WaitPolicy] = {
+    "ecs:Running": WaitPolicy(timeout=180),
+    "ecs:Stopped": WaitPolicy(first_delay=1, initial_interval=2, timeout=600),
+    "eip:Available": WaitPolicy(timeout=90),
+    "eip:InUse": WaitPolicy(timeout=90),
+}
+
+
+class TransitionHistory:
+    def __init__(self, path: Optional[str] = None, max_samples: int = 20):
+        self._path = path
+        self._max_samples = max_samples
+        self._lock = threading.Lock()
+        self._durations: Optional[Dict[str, Deque[float]]] = None
+
+    def _load(self) -> Dict[str, Deque[float]]:
+        if self._durations is None:
+            self._durations = {}
+            if self._path is not None:
+                try:
+                    with open(self._path) as f:
+                        for transition, samples in json.load(f).items():
+                            self._durations[transition] = deque(
+                                samples, self._max_samples
+                            )
+                except (OSError, ValueError):
+                    pass
+        return self._durations
+
+    def record(self, transition: str, duration: float) -> None:
+        with self._lock:
+            durations = self._load()
+            durations.setdefault(transition, deque(maxlen=self._max_samples)).append(
+                round(duration, 3)
+            )
+            if self._path is not None:
+                try:
+                    os.makedirs(os.path.dirname(self._path), exist_ok=True)
+                    tmp_path = f"{self._path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "w") as f:
+                        json.dump({k: list(v) for k, v in durations.items()}, f)
+                    os.replace(tmp_path, self._path)
+                except OSError:
+                    pass
+
+    def policy_for(self, transition: str) -> WaitPolicy:
+        policy = DEFAULT_POLICIES.get(transition, DEFAULT_POLICY)
+        with self._lock:
+            samples = list(self._load().get(transition, ()))
+        if len(samples) == 0:
+            return policy
+        # Poll about four times over a typical transition, and only give up
+        # once a wait has taken far longer than anything seen before
+        typical = median(samples)
+        return replace(
+            policy,
+            first_delay=max(min(policy.first_delay, typical / 2), 0.2),
+            initial_interval=min(max(typical / 4, 0.5), policy.max_interval),
+            timeout=max(policy.timeout, 3 * max(samples)),
+        )
@@ -0,0 +1,421 @@
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field, replace
+from time import monotonic, sleep
+from typing import (
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from aliyun_scripts.lib.exceptions import CircuitOpenError, DeadlineExceededError
+from aliyun_scripts.lib.polling import WaitPolicy
+
+T = TypeVar("T")
+
+# Errors after which the same request may well succeed
+TRANSIENT_CODES = {
+    "SDK.HttpError",
+    "SDK.ServerUnreachable",
+    "SDK.UnknownServerError",
+    "InternalError",
+    "ServiceUnavailable",
+    "UnknownError",
+}
+
+# Enough samples for the p95 to mean something
+MIN_SAMPLES = 20
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, DeadlineExceededError):
+        return True
+    if getattr(error, "error_code", None) in TRANSIENT_CODES:
+        return True
+    status = getattr(error, "http_status", None)
+    return isinstance(status, int) and status >= 500
+
+
+def is_read_only(action: str) -> bool:
+    return action.startswith("Describe")
+
+
+@dataclass(frozen=True)
+class ResiliencePolicy:
+    # Seconds a call may take, retries included
+    deadline: float = 60
+    hedge: bool = True
+    hedge_percentile: float = 0.95
+    min_hedge_delay: float = 0.05
+    # Used until an action has MIN_SAMPLES latencies
+    default_hedge_delay: float = 1
+    max_attempts: int = 3
+    retry_backoff: WaitPolicy = field(
+        default_factory=lambda: WaitPolicy(
+            first_delay=0.2, initial_interval=0.5, multiplier=2, max_interval=4
+        )
+    )
+    # Transient failures in a row that open the circuit of an endpoint
+    failure_threshold: int = 5
+    cooldown: float = 30
+
+
+class LatencyWindow:
+    def __init__(self, size: int = 200):
+        self._lock = threading.Lock()
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def add(self, latency: float) -> None:
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < MIN_SAMPLES:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_count = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def retry_in(self) -> float:
+        with self._lock:
+            return max(0, self._opened_at + self.cooldown - monotonic())
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and monotonic() >= self._opened_at + self.cooldown:
+                # A single trial call decides whether the endpoint is back
+                self.state = "half-open"
+                return True
+            return False
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def failed(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or (
+                self.state == "closed" and self.failures >= self.failure_threshold
+            ):
+                self.state = "open"
+                self.opened_count += 1
+                self._opened_at = monotonic()
+
+
+# Wraps every API call with a deadline, a circuit breaker per endpoint and,
+# for Describe actions only, hedging and retries of transient errors. A
+# mutating action that failed transiently may still have been applied, so it
+# is neither hedged nor retried here, nor given up on once sent
+class ResilientCaller:
+    def __init__(self, policy: Optional[ResiliencePolicy] = None, max_workers=64):
+        self.policy = policy or ResiliencePolicy()
+        self.max_workers = max_workers
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.retries = 0
+        self.deadlines_exceeded = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._windows: Dict[Tuple[str, str], LatencyWindow] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def configure(self, **changes) -> None:
+        with self._lock:
+            self.policy = replace(self.policy, **changes)
+
+    def may_hedge(self, action: str) -> bool:
+        return self.policy.hedge and is_read_only(action)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="acs"
+                )
+            return self._executor
+
+    def window(self, action: str, endpoint: str) -> LatencyWindow:
+        with self._lock:
+            return self._windows.setdefault((action, endpoint), LatencyWindow())
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    self.policy.failure_threshold, self.policy.cooldown
+                )
+                self._breakers[endpoint] = breaker
+            return breaker
+
+    def hedge_delay(self, action: str, endpoint: str) -> float:
+        p = self.window(action, endpoint).percentile(self.policy.hedge_percentile)
+        if p is None:
+            return self.policy.default_hedge_delay
+        return max(self.policy.min_hedge_delay, p)
+
+    def deadline(self) -> float:
+        return monotonic() + self.policy.deadline
+
+    def _admit(self, breaker: CircuitBreaker, endpoint: str) -> None:
+        if not breaker.allow():
+            with self._lock:
+                self.rejected += 1
+            raise CircuitOpenError(endpoint, breaker.retry_in())
+
+    def _retry_delay(
+        self,
+        action: str,
+        error: Exception,
+        breaker: CircuitBreaker,
+        attempts: int,
+        delays: Iterator[float],
+        deadline_at: float,
+    ) -> Optional[float]:
+        # Seconds to wait before the next attempt, None to give up
+        transient = is_transient(error)
+        if transient:
+            breaker.failed()
+        else:
+            # The endpoint answered, only the request was wrong
+            breaker.succeeded()
+        if not (is_read_only(action) and transient):
+            return None
+        if attempts >= self.policy.max_attempts:
+            return None
+        delay = next(delays)
+        if monotonic() + delay >= deadline_at:
+            return None
+        with self._lock:
+            self.retries += 1
+        return delay
+
+    def call(
+        self, action: str, endpoint: str, func: Callable[[], T], deadline_at: float
+    ) -> T:
+        # Runs func, which waits for the rate limiter and then calls exchange,
+        # again after a transient error of a Describe action
+        breaker = self.breaker(endpoint)
+        delays = self.policy.retry_backoff.delays()
+        attempts = 0
+        while True:
+            self._admit(breaker, endpoint)
+            attempts += 1
+            try:
+                result = func()
+            except Exception as e:
+                delay = self._retry_delay(
+                    action, e, breaker, attempts, delays, deadline_at
+                )
+                if delay is None:
+                    raise
+                sleep(delay)
+                continue
+            breaker.succeeded()
+            return result
+
+    async def call_async(
+        self,
+        action: str,
+        endpoint: str,
+        func: Callable[[], Awaitable[T]],
+        deadline_at: float,
+    ) -> T:
+        import asyncio
+
+        breaker = self.breaker(endpoint)
+        delays = self.policy.retry_backoff.delays()
+        attempts = 0
+        while True:
+            self._admit(breaker, endpoint)
+            attempts += 1
+            try:
+                result = await func()
+            except Exception as e:
+                delay = self._retry_delay(
+                    action, e, breaker, attempts, delays, deadline_at
+                )
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            breaker.succeeded()
+            return result
+
+    def _first_wait(self, action: str, endpoint: str, deadline_at: float) -> float:
+        # How long the first attempt runs alone before a hedge is considered
+        return max(
+            0, min(self.hedge_delay(action, endpoint), deadline_at - monotonic())
+        )
+
+    def _hedged(self) -> None:
+        with self._lock:
+            self.hedged += 1
+
+    def _won(self, primary: bool) -> None:
+        if not primary:
+            with self._lock:
+                self.hedge_wins += 1
+
+    def _deadline_exceeded(self, action: str) -> DeadlineExceededError:
+        # A Describe left in flight changes nothing
+        with self._lock:
+            self.deadlines_exceeded += 1
+        return DeadlineExceededError(action, self.policy.deadline)
+
+    def exchange(
+        self,
+        action: str,
+        endpoint: str,
+        send: Callable[[bool], T],
+        deadline_at: float,
+        may_hedge: Callable[[], bool],
+    ) -> T:
+        # Sends a request the rate limiter already let through. send(hedge)
+        # makes one http exchange; a hedge runs while the first one may still
+        # be in flight, so it has to use its own request. A mutation runs on
+        # the calling thread and is never given up on, as it may be applied
+        if not is_read_only(action):
+            return send(False)
+
+        executor = self._get_executor()
+        window = self.window(action, endpoint)
+
+        def timed(hedge: bool) -> T:
+            started = monotonic()
+            result = send(hedge)
+            window.add(monotonic() - started)
+            return result
+
+        primary = executor.submit(timed, False)
+        futures: List[Future] = [primary]
+        if self.policy.hedge:
+            done, _ = wait(
+                futures, timeout=self._first_wait(action, endpoint, deadline_at)
+            )
+            # A failed first attempt is retried with backoff instead, and no
+            # hedge is sent while the rate limiter has no token to spare
+            if len(done) == 0 and monotonic() < deadline_at and may_hedge():
+                futures.append(executor.submit(timed, True))
+                self._hedged()
+
+        error: Optional[BaseException] = None
+        pending = set(futures)
+        while len(pending) > 0:
+            done, pending = wait(
+                pending,
+                timeout=max(0, deadline_at - monotonic()),
+                return_when=FIRST_COMPLETED,
+            )
+            if len(done) == 0:
+                raise self._deadline_exceeded(action)
+            for future in done:
+                if future.exception() is None:
+                    self._won(future is primary)
+                    return future.result()
+                error = error or future.exception()
+        raise error  # type: ignore
+
+    async def exchange_async(
+        self,
+        action: str,
+        endpoint: str,
+        send: Callable[[bool], Awaitable[T]],
+        deadline_at: float,
+        may_hedge: Callable[[], bool],
+    ) -> T:
+        # The coroutine twin of exchange, attempts run as tasks instead of on
+        # the pool and the ones that lost are cancelled
+        import asyncio
+
+        if not is_read_only(action):
+            return await send(False)
+
+        window = self.window(action, endpoint)
+
+        async def timed(hedge: bool) -> T:
+            started = monotonic()
+            result = await send(hedge)
+            window.add(monotonic() - started)
+            return result
+
+        primary = asyncio.ensure_future(timed(False))
+        tasks: List[Awaitable] = [primary]
+        pending = set(tasks)
+        try:
+            if self.policy.hedge:
+                done, _ = await asyncio.wait(
+                    tasks, timeout=self._first_wait(action, endpoint, deadline_at)
+                )
+                if len(done) == 0 and monotonic() < deadline_at and may_hedge():
+                    tasks.append(asyncio.ensure_future(timed(True)))
+                    self._hedged()
+
+            error: Optional[BaseException] = None
+            pending = set(tasks)
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=max(0, deadline_at - monotonic()),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if len(done) == 0:
+                    raise self._deadline_exceeded(action)
+                for task in done:
+                    if task.exception() is None:
+                        self._won(task is primary)
+                        return task.result()
+                    error = error or task.exception()
+            raise error  # type: ignore
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._windows.clear()
+            self._breakers.clear()
+            self.hedged = 0
+            self.hedge_wins = 0
+            self.retries = 0
+            self.deadlines_exceeded = 0
+            self.rejected = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hedged": self.hedged,
+                "hedge wins": self.hedge_wins,
+                "retries": self.retries,
+                "deadlines exceeded": self.deadlines_exceeded,
+                "rejected": self.rejected,
+                "circuits opened": sum(
+                    breaker.opened_count for breaker in self._breakers.values()
+                ),
+            }
+
+
+resilience = ResilientCaller()
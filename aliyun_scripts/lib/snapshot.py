@@ -0,0 +1,113 @@
+import json
+import os
+import tempfile
+import threading
+from dataclasses import asdict
+from time import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from aliyun_scripts.lib.instances import EcsInstance, EipInstance
+
+
+class StateSnapshot:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, StateSnapshot) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+    def _read(self) -> Dict[str, Dict[str, dict]]:
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        state.setdefault("ecs", {})
+        state.setdefault("eip", {})
+        return state
+
+    def _write(self, state: Dict[str, Dict[str, dict]]) -> None:
+        # Write to a temporary file first so readers never see a partial snapshot
+        # The snapshot is only an optimization, so failing to write it is not fatal
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            os.unlink(tmp_path)
+
+    def _update(self, kind: str, records: Dict[str, dict]) -> None:
+        with self._lock:
+            state = self._read()
+            state[kind].update(records)
+            self._write(state)
+
+    def ecs_observed(self, ecs_list: List[EcsInstance]) -> None:
+        now = time()
+        self._update(
+            "ecs",
+            {ecs.InstanceId: {"at": now, "instance": asdict(ecs)} for ecs in ecs_list},
+        )
+
+    def eip_observed(self, eip_list: List[EipInstance]) -> None:
+        now = time()
+        self._update(
+            "eip",
+            {
+                eip.AllocationId: {"at": now, "instance": asdict(eip)}
+                for eip in eip_list
+            },
+        )
+
+    def invalidated(
+        self, instance_ids: Sequence[str], allocation_ids: Sequence[str]
+    ) -> None:
+        if len(instance_ids) == 0 and len(allocation_ids) == 0:
+            return
+        with self._lock:
+            state = self._read()
+            for instance_id in instance_ids:
+                state["ecs"].pop(instance_id, None)
+            for allocation_id in allocation_ids:
+                state["eip"].pop(allocation_id, None)
+            self._write(state)
+
+    def get_ecs(
+        self, instance_ids: Sequence[str], max_age: float
+    ) -> Optional[List[Tuple[EcsInstance, float]]]:
+        # Only answer when every requested instance is fresh enough
+        records = self._read()["ecs"]
+        now = time()
+        result = []
+        for instance_id in instance_ids:
+            record = records.get(instance_id)
+            if record is None or now - record["at"] > max_age:
+                return None
+            instance = dict(record["instance"])
+            eip = instance.pop("EipAddress")
+            result.append(
+                (
+                    EcsInstance(
+                        **instance,
+                        EipAddress=EipInstance(**eip) if eip is not None else None,
+                    ),
+                    now - record["at"],
+                )
+            )
+        return result
+
+    def get_eip(self, allocation_id: str, max_age: float) -> Optional[EipInstance]:
+        record = self._read()["eip"].get(allocation_id)
+        if record is None or time() - record["at"] > max_age:
+            return None
+        return EipInstance(**record["instance"])
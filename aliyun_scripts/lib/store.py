@@ -0,0 +1,350 @@
+from __future__ import annotations
+
+import sys
+import threading
+from time import time
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from aliyun_scripts.lib.instances import EcsInstance, EipInstance, EipStatus
+
+if TYPE_CHECKING:
+    from aliyun_scripts.lib.discovery import Inventory
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    # Statuses, regions and charge types repeat across thousands of records
+    return sys.intern(value) if value is not None else None
+
+
+class _EcsRecord:
+    __slots__ = (
+        "InstanceId",
+        "InstanceName",
+        "Status",
+        "RegionId",
+        "AllocationId",
+        "at",
+    )
+
+    def __init__(self, ecs: EcsInstance, at: float):
+        self.InstanceId = ecs.InstanceId
+        self.InstanceName = ecs.InstanceName
+        self.Status = _intern(ecs.Status)
+        self.RegionId = _intern(ecs.RegionId)
+        self.AllocationId = (
+            ecs.EipAddress.AllocationId if ecs.EipAddress is not None else None
+        )
+        self.at = at
+
+
+class _EipRecord:
+    __slots__ = (
+        "AllocationId",
+        "IpAddress",
+        "Bandwidth",
+        "InternetChargeType",
+        "IsSupportUnassociate",
+        "Status",
+        "RegionId",
+        "InstanceId",
+        "ISP",
+        "ChargeType",
+    )
+
+    def __init__(self, eip: EipInstance, previous: Optional[_EipRecord] = None):
+        # The eip embedded in DescribeInstances lacks a few fields, those are
+        # kept from what DescribeEipAddresses said before
+        def pick(name: str):
+            value = getattr(eip, name)
+            if value is None and previous is not None:
+                return getattr(previous, name)
+            return value
+
+        bandwidth = pick("Bandwidth")
+        self.AllocationId = eip.AllocationId
+        self.IpAddress = eip.IpAddress
+        self.Bandwidth = int(bandwidth) if bandwidth is not None else None
+        self.InternetChargeType = _intern(pick("InternetChargeType"))
+        self.IsSupportUnassociate = pick("IsSupportUnassociate")
+        self.Status = _intern(pick("Status"))
+        self.RegionId = _intern(pick("RegionId"))
+        self.InstanceId = eip.InstanceId
+        self.ISP = _intern(pick("ISP"))
+        self.ChargeType = _intern(pick("ChargeType"))
+
+
+class _Index:
+    __slots__ = ("_keys",)
+
+    def __init__(self):
+        self._keys: Dict[object, Set[str]] = {}
+
+    def add(self, value: object, key: str) -> None:
+        if value is not None:
+            self._keys.setdefault(value, set()).add(key)
+
+    def remove(self, value: object, key: str) -> None:
+        keys = self._keys.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._keys[value]
+
+    def get(self, value: object) -> Set[str]:
+        return self._keys.get(value, set())
+
+
+def _intersect(candidates: Iterable[Set[str]]) -> Optional[Set[str]]:
+    # None when nothing narrows the search down
+    candidates = sorted(candidates, key=len)
+    if len(candidates) == 0:
+        return None
+    return candidates[0].intersection(*candidates[1:])
+
+
+# A StateListener keeping the latest known ecs and eips with hash indexes, so
+# lookups like "who owns this ip" do not need to scan or call the API
+class InventoryStore:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ecs: Dict[str, _EcsRecord] = {}
+        self._eips: Dict[str, _EipRecord] = {}
+        self._eip_by_ip: Dict[str, str] = {}
+        self._ecs_by_status = _Index()
+        self._ecs_by_region = _Index()
+        self._eip_by_status = _Index()
+        self._eip_by_region = _Index()
+        # Changed by an action since they were last described, so their status
+        # and binding may be outdated
+        self.stale: Set[str] = set()
+
+    @classmethod
+    def from_inventory(cls, inventory: Inventory) -> InventoryStore:
+        store = cls()
+        store.eip_observed(inventory.eips)
+        store.ecs_observed(inventory.ecs)
+        return store
+
+    def __len__(self) -> int:
+        return len(self._ecs) + len(self._eips)
+
+    def ecs_observed(self, ecs_list: List[EcsInstance]) -> None:
+        now = time()
+        with self._lock:
+            for ecs in ecs_list:
+                self._put_ecs(ecs, now)
+
+    def eip_observed(self, eip_list: List[EipInstance]) -> None:
+        with self._lock:
+            for eip in eip_list:
+                self._put_eip(eip)
+
+    def invalidated(
+        self, instance_ids: Sequence[str], allocation_ids: Sequence[str]
+    ) -> None:
+        with self._lock:
+            self.stale.update(instance_ids)
+            self.stale.update(allocation_ids)
+
+    def _put_ecs(self, ecs: EcsInstance, at: float) -> None:
+        record = _EcsRecord(ecs, at)
+        previous = self._ecs.get(ecs.InstanceId)
+        if previous is not None:
+            self._ecs_by_status.remove(previous.Status, ecs.InstanceId)
+            self._ecs_by_region.remove(previous.RegionId, ecs.InstanceId)
+            if (
+                previous.AllocationId is not None
+                and previous.AllocationId != record.AllocationId
+            ):
+                # Unbound since, the eip has to be described again to be sure
+                old_eip = self._eips.get(previous.AllocationId)
+                if old_eip is not None and old_eip.InstanceId == ecs.InstanceId:
+                    self._eip_by_status.remove(old_eip.Status, old_eip.AllocationId)
+                    old_eip.InstanceId = None
+                    old_eip.Status = EipStatus.available.value
+                    self._eip_by_status.add(old_eip.Status, old_eip.AllocationId)
+                    self.stale.add(old_eip.AllocationId)
+        self._ecs[ecs.InstanceId] = record
+        self._ecs_by_status.add(record.Status, ecs.InstanceId)
+        self._ecs_by_region.add(record.RegionId, ecs.InstanceId)
+        self.stale.discard(ecs.InstanceId)
+        if ecs.EipAddress is not None:
+            eip = ecs.EipAddress
+            self._put_eip(
+                EipInstance(
+                    eip.AllocationId,
+                    eip.IpAddress,
+                    eip.Bandwidth,
+                    eip.InternetChargeType,
+                    eip.IsSupportUnassociate,
+                    eip.Status or EipStatus.in_use.value,
+                    eip.RegionId or ecs.RegionId,
+                    ecs.InstanceId,
+                    eip.ISP,
+                    eip.ChargeType,
+                )
+            )
+
+    def _put_eip(self, eip: EipInstance) -> None:
+        previous = self._eips.get(eip.AllocationId)
+        record = _EipRecord(eip, previous)
+        if previous is not None:
+            self._eip_by_status.remove(previous.Status, eip.AllocationId)
+            self._eip_by_region.remove(previous.RegionId, eip.AllocationId)
+            if self._eip_by_ip.get(previous.IpAddress) == eip.AllocationId:
+                del self._eip_by_ip[previous.IpAddress]
+        self._eips[eip.AllocationId] = record
+        self._eip_by_ip[record.IpAddress] = eip.AllocationId
+        self._eip_by_status.add(record.Status, eip.AllocationId)
+        self._eip_by_region.add(record.RegionId, eip.AllocationId)
+        self.stale.discard(eip.AllocationId)
+
+    def remove_ecs(self, instance_id: str) -> None:
+        with self._lock:
+            record = self._ecs.pop(instance_id, None)
+            if record is None:
+                return
+            self._ecs_by_status.remove(record.Status, instance_id)
+            self._ecs_by_region.remove(record.RegionId, instance_id)
+            self.stale.discard(instance_id)
+
+    def remove_eip(self, allocation_id: str) -> None:
+        with self._lock:
+            record = self._eips.pop(allocation_id, None)
+            if record is None:
+                return
+            self._eip_by_status.remove(record.Status, allocation_id)
+            self._eip_by_region.remove(record.RegionId, allocation_id)
+            if self._eip_by_ip.get(record.IpAddress) == allocation_id:
+                del self._eip_by_ip[record.IpAddress]
+            self.stale.discard(allocation_id)
+
+    def _to_eip(self, record: _EipRecord) -> EipInstance:
+        return EipInstance(
+            record.AllocationId,
+            record.IpAddress,
+            record.Bandwidth,
+            record.InternetChargeType,
+            record.IsSupportUnassociate,
+            record.Status,
+            record.RegionId,
+            record.InstanceId,
+            record.ISP,
+            record.ChargeType,
+        )
+
+    def _to_ecs(self, record: _EcsRecord) -> EcsInstance:
+        eip = self._eips.get(record.AllocationId) if record.AllocationId else None
+        return EcsInstance(
+            record.InstanceId,
+            record.InstanceName,
+            record.Status,
+            record.RegionId,
+            self._to_eip(eip) if eip is not None else None,
+        )
+
+    def get_ecs(self, instance_id: str) -> Optional[EcsInstance]:
+        with self._lock:
+            record = self._ecs.get(instance_id)
+            return self._to_ecs(record) if record is not None else None
+
+    def get_recent_ecs(
+        self, instance_ids: Sequence[str], max_age: float
+    ) -> Optional[List[Tuple[EcsInstance, float]]]:
+        # Like StateSnapshot.get_ecs, only answers when every requested
+        # instance was described recently and not changed since
+        now = time()
+        with self._lock:
+            result = []
+            for instance_id in instance_ids:
+                record = self._ecs.get(instance_id)
+                if (
+                    record is None
+                    or instance_id in self.stale
+                    or (
+                        record.AllocationId is not None
+                        and record.AllocationId in self.stale
+                    )
+                    or now - record.at > max_age
+                ):
+                    return None
+                result.append((self._to_ecs(record), now - record.at))
+            return result
+
+    def get_eip(self, allocation_id: str) -> Optional[EipInstance]:
+        with self._lock:
+            record = self._eips.get(allocation_id)
+            return self._to_eip(record) if record is not None else None
+
+    def eip_by_ip(self, ip_address: str) -> Optional[EipInstance]:
+        with self._lock:
+            allocation_id = self._eip_by_ip.get(ip_address)
+            return self.get_eip(allocation_id) if allocation_id is not None else None
+
+    def ecs_by_ip(self, ip_address: str) -> Optional[EcsInstance]:
+        with self._lock:
+            allocation_id = self._eip_by_ip.get(ip_address)
+            if allocation_id is None:
+                return None
+            instance_id = self._eips[allocation_id].InstanceId
+            return self.get_ecs(instance_id) if instance_id is not None else None
+
+    def find_ecs(
+        self, status: Optional[str] = None, region_id: Optional[str] = None
+    ) -> List[EcsInstance]:
+        with self._lock:
+            indexed = []
+            if status is not None:
+                indexed.append(self._ecs_by_status.get(status))
+            if region_id is not None:
+                indexed.append(self._ecs_by_region.get(region_id))
+            instance_ids = _intersect(indexed)
+            if instance_ids is None:
+                instance_ids = set(self._ecs)
+            return [self._to_ecs(self._ecs[key]) for key in sorted(instance_ids)]
+
+    def find_eips(
+        self,
+        status: Optional[str] = None,
+        region_id: Optional[str] = None,
+        bandwidth: Optional[int] = None,
+        isp: Optional[str] = None,
+        internet_charge_type: Optional[str] = None,
+    ) -> List[EipInstance]:
+        # Status and region are indexed, the rest only filters what they select
+        with self._lock:
+            indexed = []
+            if status is not None:
+                indexed.append(self._eip_by_status.get(status))
+            if region_id is not None:
+                indexed.append(self._eip_by_region.get(region_id))
+            allocation_ids = _intersect(indexed)
+            if allocation_ids is None:
+                allocation_ids = set(self._eips)
+            found = []
+            for allocation_id in sorted(allocation_ids):
+                record = self._eips[allocation_id]
+                if (
+                    (bandwidth is None or record.Bandwidth == int(bandwidth))
+                    and (isp is None or record.ISP == isp)
+                    and (
+                        internet_charge_type is None
+                        or record.InternetChargeType == internet_charge_type
+                    )
+                ):
+                    found.append(self._to_eip(record))
+            return found
+
+
+# Set by the agent, which keeps it up to date across commands so ip and status
+# can be answered from memory; None in other processes
+hosted_inventory: Optional[InventoryStore] = None
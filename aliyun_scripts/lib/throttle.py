@@ -0,0 +1,190 @@
+import threading
+from time import monotonic, sleep
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from aliyun_scripts.lib.polling import WaitPolicy
+
+T = TypeVar("T")
+
+DEFAULT_BURST = 5
+MIN_RATE = 0.2
+
+THROTTLING_BACKOFF = WaitPolicy(
+    first_delay=0.5, initial_interval=1, multiplier=2, max_interval=16, timeout=120
+)
+
+
+def is_throttling(error: Exception) -> bool:
+    # Checked by attribute so the sdk does not need to be imported,
+    # e.g. Throttling, Throttling.User and Throttling.Api
+    code = getattr(error, "error_code", None)
+    return isinstance(code, str) and code.startswith("Throttling")
+
+
+class TokenBucket:
+    # Without a rate the bucket never holds a call back, throttling errors are
+    # still counted and retried with backoff
+    def __init__(self, rate: Optional[float], burst: float):
+        self.rate = rate
+        self.burst = burst
+        # Slowed down by throttling errors, the rate recovers up to this
+        self.max_rate = rate
+        self.throttled_count = 0
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        # Tokens are taken in arrival order and may go negative, so a caller
+        # that has to wait already owns its token and cannot be overtaken
+        if self.rate is None:
+            return 0
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def try_acquire(self) -> bool:
+        # Takes a token only if one is available right away
+        if self.rate is None:
+            return True
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def succeeded(self) -> None:
+        if self.rate is None:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def throttled(self) -> None:
+        with self._lock:
+            self.throttled_count += 1
+            if self.rate is not None:
+                self.rate = max(MIN_RATE, self.rate / 2)
+                self._tokens = min(self._tokens, 0)
+
+
+class RequestScheduler:
+    def __init__(
+        self,
+        rates: Optional[Dict[str, float]] = None,
+        burst: float = DEFAULT_BURST,
+        backoff: WaitPolicy = THROTTLING_BACKOFF,
+    ):
+        self.rates = dict(rates or {})
+        self.burst = burst
+        self.backoff = backoff
+        self.retries = 0
+        self._lock = threading.Lock()
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+    def configure(self, rates: Dict[str, float]) -> None:
+        with self._lock:
+            self.rates.update(rates)
+            # Started over with the new rates on their next call
+            for key in [key for key in self._buckets if key[0] in rates]:
+                del self._buckets[key]
+
+    def bucket(self, action: str, region_id: str) -> TokenBucket:
+        # Only the actions with a configured rate are limited
+        with self._lock:
+            bucket = self._buckets.get((action, region_id))
+            if bucket is None:
+                bucket = TokenBucket(self.rates.get(action), self.burst)
+                self._buckets[(action, region_id)] = bucket
+            return bucket
+
+    def _should_retry(
+        self,
+        error: Exception,
+        bucket: TokenBucket,
+        started: float,
+        delay: float,
+        deadline: Optional[float],
+    ):
+        if not is_throttling(error) or monotonic() - started >= self.backoff.timeout:
+            return False
+        if deadline is not None and monotonic() + delay >= deadline:
+            # The caller gives up by then and must not be surprised by a
+            # late retry that is still applied
+            return False
+        bucket.throttled()
+        with self._lock:
+            self.retries += 1
+        return True
+
+    def call(
+        self,
+        action: str,
+        region_id: str,
+        send: Callable[[], T],
+        deadline: Optional[float] = None,
+    ) -> T:
+        bucket = self.bucket(action, region_id)
+        delays = self.backoff.delays()
+        started = monotonic()
+        while True:
+            sleep(bucket.reserve())
+            try:
+                result = send()
+            except Exception as e:
+                delay = next(delays)
+                if not self._should_retry(e, bucket, started, delay, deadline):
+                    raise
+                sleep(delay)
+                continue
+            bucket.succeeded()
+            return result
+
+    async def call_async(
+        self,
+        action: str,
+        region_id: str,
+        send: Callable[[], Awaitable[T]],
+        deadline: Optional[float] = None,
+    ) -> T:
+        import asyncio
+
+        bucket = self.bucket(action, region_id)
+        delays = self.backoff.delays()
+        started = monotonic()
+        while True:
+            await asyncio.sleep(bucket.reserve())
+            try:
+                result = await send()
+            except Exception as e:
+                delay = next(delays)
+                if not self._should_retry(e, bucket, started, delay, deadline):
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            bucket.succeeded()
+            return result
+
+    def reset(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+            self.retries = 0
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                f"{action}@{region_id}": {
+                    "rate": bucket.rate,
+                    "throttled": bucket.throttled_count,
+                }
+                for (action, region_id), bucket in self._buckets.items()
+            }
+
+
+scheduler = RequestScheduler()
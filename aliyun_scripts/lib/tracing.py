@@ -0,0 +1,214 @@
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+
+@dataclass
+class Span:
+    name: str
+    category: str
+    thread: int
+    start: float
+    end: float = 0
+    # Time spent in spans nested in this one on the same thread
+    children: float = 0
+    args: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    @property
+    def self_time(self) -> float:
+        return self.duration - self.children
+
+
+@dataclass
+class PhaseSummary:
+    name: str
+    count: int = 0
+    total: float = 0
+    self_time: float = 0
+    max: float = 0
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        # Spans open in the current thread or asyncio task, innermost last; a
+        # task starts with the spans open where it was created
+        self._stack: ContextVar[Tuple[Span, ...]] = ContextVar(
+            "tracer_stack", default=()
+        )
+        self._origin = perf_counter()
+        self._spans: List[Span] = []
+        # (timestamp, thread, message)
+        self._events: List[Tuple[float, int, str]] = []
+        self._threads: Dict[int, str] = {}
+
+    def start(self) -> None:
+        with self._lock:
+            self._origin = perf_counter()
+            self._spans = []
+            self._events = []
+            self._threads = {}
+        self.enabled = True
+
+    def stop(self) -> None:
+        self.enabled = False
+
+    def current(self) -> Optional[Span]:
+        stack = self._stack.get()
+        return stack[-1] if len(stack) > 0 else None
+
+    @contextmanager
+    def detached(self) -> Iterator[None]:
+        # Spans opened inside are not nested in the ones open outside, for
+        # work running alongside them such as a hedged request
+        token = self._stack.set(())
+        try:
+            yield
+        finally:
+            self._stack.reset(token)
+
+    @contextmanager
+    def span(
+        self,
+        name: str,
+        category: str = "phase",
+        parent: Optional[Span] = None,
+        **args: Any,
+    ) -> Iterator[None]:
+        # parent is a span of another thread this one is nested in, it is
+        # used when nothing is open on this thread
+        if not self.enabled:
+            yield
+            return
+        thread = threading.current_thread()
+        span = Span(name, category, thread.ident or 0, perf_counter(), args=args)
+        stack = self._stack.get()
+        token = self._stack.set((*stack, span))
+        try:
+            yield
+        finally:
+            self._stack.reset(token)
+            with self._lock:
+                span.end = perf_counter()
+                if len(stack) > 0:
+                    stack[-1].children += span.duration
+                elif parent is not None and parent.end == 0:
+                    # Work that outlives its parent is not part of its time
+                    parent.children += span.duration
+                self._spans.append(span)
+                self._threads.setdefault(span.thread, thread.name)
+
+    def instant(self, message: str) -> None:
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        with self._lock:
+            self._events.append((perf_counter(), thread.ident or 0, message))
+            self._threads.setdefault(thread.ident or 0, thread.name)
+
+    def spans(self) -> List[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def summary(self) -> List[PhaseSummary]:
+        phases: Dict[str, PhaseSummary] = {}
+        for span in self.spans():
+            phase = phases.setdefault(span.name, PhaseSummary(span.name))
+            phase.count += 1
+            phase.total += span.duration
+            phase.self_time += span.self_time
+            phase.max = max(phase.max, span.duration)
+        return sorted(phases.values(), key=lambda phase: -phase.self_time)
+
+    def format_summary(self) -> str:
+        rows = [f"{'phase':<36} {'count':>6} {'total s':>9} {'self s':>9} {'max s':>8}"]
+        for phase in self.summary():
+            rows.append(
+                f"{phase.name[:36]:<36} {phase.count:>6} {phase.total:>9.3f}"
+                f" {phase.self_time:>9.3f} {phase.max:>8.3f}"
+            )
+        return "\n".join(rows)
+
+    def to_chrome_trace(self) -> dict:
+        # The Trace Event Format read by chrome://tracing and ui.perfetto.dev
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self._spans)
+            events = list(self._events)
+            threads = dict(self._threads)
+            origin = self._origin
+        trace_events: List[Dict[str, Any]] = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in threads.items()
+        ]
+        for span in spans:
+            trace_events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": round((span.start - origin) * 1e6, 1),
+                    "dur": round(span.duration * 1e6, 1),
+                    "pid": pid,
+                    "tid": span.thread,
+                    "args": {k: str(v) for k, v in span.args.items()},
+                }
+            )
+        for timestamp, tid, message in events:
+            trace_events.append(
+                {
+                    "name": message,
+                    "cat": "log",
+                    "ph": "i",
+                    "s": "t",
+                    "ts": round((timestamp - origin) * 1e6, 1),
+                    "pid": pid,
+                    "tid": tid,
+                }
+            )
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def dump(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def finish(self, path: str) -> None:
+        # Ends a --profile run: writes the timeline and prints where the time went
+        self.stop()
+        self.dump(path)
+        print(self.format_summary(), file=sys.stderr)
+
+
+tracer = Tracer()
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def traced(name: str, category: str = "phase") -> Callable[[F], F]:
+    def decorate(func: F) -> F:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name, category):
+                return func(*args, **kwargs)
+
+        return wrapper  # type: ignore
+
+    return decorate
@@ -1,56 +1,218 @@
+from __future__ import annotations
+
+import copy
+import io
 import json
 import os
 import pprint
+import sys
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from contextvars import ContextVar
 from enum import Enum
-from time import sleep
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
-
-from aliyunsdkcore.client import AcsClient
+from time import monotonic, sleep
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    TextIO,
+    Tuple,
+    Union,
+)
 
+from aliyun_scripts.lib.clients import clients, json_files
+from aliyun_scripts.lib.exceptions import WaitTimeoutError
 from aliyun_scripts.lib.instances import EcsInstance, EcsStatus, EipInstance, EipStatus
+from aliyun_scripts.lib.metrics import error_code, metrics
+from aliyun_scripts.lib.polling import DEFAULT_POLICY, TransitionHistory, WaitPolicy
+from aliyun_scripts.lib.resilience import resilience
+from aliyun_scripts.lib.throttle import scheduler
+from aliyun_scripts.lib.tracing import Span, tracer
+
+if TYPE_CHECKING:
+    from aliyunsdkcore.client import AcsClient
+
+    from aliyun_scripts.lib.poller import StatusPoller
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 pp = pprint.PrettyPrinter(indent=4)
 SECRETS = os.path.expanduser("~/secrets.json")
 CONFIG = os.path.expanduser("~/config.json")
+# Set by update_config for the current thread or task only, so the commands
+# the agent runs side by side in threads of their own keep their own paths
+_config_paths: ContextVar[Tuple[str, str]] = ContextVar(
+    "config_paths", default=(SECRETS, CONFIG)
+)
+STATE_DIR = os.path.expanduser("~/.aliyun_scripts")
+SNAPSHOT = os.path.join(STATE_DIR, "state.json")
+# Slack given to a poller on top of the wait timeout it enforces itself
+POLLER_GRACE = 30
 
+transition_history = TransitionHistory(os.path.join(STATE_DIR, "transitions.json"))
 
-def p(verbose, *args, **kwargs):
+
+def p(verbose, obj: Any, log: Optional[Callable[[str], Any]] = None):
+    # Prints with log when given, e.g. from a thread the command started, see
+    # get_print; otherwise looks up sys.stdout on every call
     if verbose:
-        pp.pprint(*args, **kwargs)
+        (log or print)(pp.pformat(obj))
 
 
 def update_config(secrets: Optional[str], config: Optional[str]) -> None:
-    global SECRETS, CONFIG
+    current_secrets, current_config = _config_paths.get()
+    _config_paths.set(
+        (
+            secrets if secrets is not None else current_secrets,
+            config if config is not None else current_config,
+        )
+    )
+
 
-    if secrets is not None:
-        SECRETS = secrets
-    if config is not None:
-        CONFIG = config
+def _copy_request(r: Any) -> Any:
+    # Requests hold the signer module, which deepcopy cannot copy; the dicts
+    # are what signing changes
+    clone = copy.copy(r)
+    for name, value in vars(r).items():
+        if isinstance(value, dict):
+            setattr(clone, name, dict(value))
+    return clone
 
 
-def acs_req(client: AcsClient, r: Any, params: Dict[str, Any] = {}) -> dict:
+def _prepare_request(
+    client: AcsClient, r: Any, params: Optional[Dict[str, Any]]
+) -> Tuple[str, str]:
+    # Shared with aio.acs_req; returns the region and endpoint of the request
+    params = params or {}
     for k, v in params.items():
         r.add_query_param(k, v)
-    return json.loads(client.do_action_with_exception(r).decode())
+    region_id = params.get("RegionId") or client.get_region_id()
+    return region_id, f"{r.get_product()}@{region_id}"
+
+
+def _record_call(
+    r: Any,
+    region_id: str,
+    started: float,
+    response: Optional[bytes] = None,
+    error: Optional[Exception] = None,
+) -> None:
+    latency = monotonic() - started
+    if error is not None:
+        metrics.record(type(r).__name__, region_id, latency, 0, error_code(error))
+    else:
+        metrics.record(type(r).__name__, region_id, latency, len(response or b""))
+
+
+def acs_req(client: AcsClient, r: Any, params: Optional[Dict[str, Any]] = None) -> dict:
+    region_id, endpoint = _prepare_request(client, r, params)
+    action = r.get_action_name()
+    bucket = scheduler.bucket(action, region_id)
+    deadline = resilience.deadline()
+    # The sdk signs the request in place, so a hedge needs its own copy made
+    # before the first attempt starts
+    hedge_request = _copy_request(r) if resilience.may_hedge(action) else None
+
+    def send(request: Any, parent: Optional[Span]) -> bytes:
+        started = monotonic()
+        try:
+            with tracer.span("http", "api", parent=parent):
+                response = client.do_action_with_exception(request)
+        except Exception as e:
+            _record_call(request, region_id, started, error=e)
+            raise
+        _record_call(request, region_id, started, response)
+        return response
+
+    # Time outside of http is spent waiting for the rate limiter, retrying or
+    # parsing
+    with tracer.span(action, "api", region=region_id):
+        action_span = tracer.current()
+
+        def attempt(hedge: bool) -> bytes:
+            # A hedge overlaps the first attempt, only that one is part of
+            # the action's own time
+            return send(hedge_request, None) if hedge else send(r, action_span)
+
+        def exchange() -> bytes:
+            # A hedge takes a token of its own, but never waits for one
+            return resilience.exchange(
+                action,
+                endpoint,
+                attempt,
+                deadline,
+                lambda: hedge_request is not None and bucket.try_acquire(),
+            )
+
+        response = resilience.call(
+            action,
+            endpoint,
+            lambda: scheduler.call(action, region_id, exchange, deadline),
+            deadline,
+        )
+        return json.loads(response.decode())
+
+
+def load_config() -> dict:
+    return json_files.load(_config_paths.get()[1])
 
 
 def get_client_and_config() -> Tuple[AcsClient, dict]:
-    access_info = json.load(open(SECRETS))
-    config = json.load(open(CONFIG))
-    client = AcsClient(
-        ak=access_info["accessKey_id"],
-        secret=access_info["accessKey_secret"],
-        region_id=access_info["region_id"],
+    access_info = json_files.load(_config_paths.get()[0])
+    config = load_config()
+    scheduler.configure(config.get("ApiRateLimits", {}))
+    if "ApiDeadline" in config:
+        resilience.configure(deadline=config["ApiDeadline"])
+    client = clients.get(
+        access_info["accessKey_id"],
+        access_info["accessKey_secret"],
+        access_info["region_id"],
     )
     return client, config
 
 
-def get_client_config_and_ecs() -> Tuple[AcsClient, dict, Optional[EcsInstance]]:
+def get_target_ids(config: dict) -> Optional[List[str]]:
+    target = config["Target"]
+    if isinstance(target, dict):
+        # Tag selectors can only be resolved by the API
+        return None
+    return [target] if isinstance(target, str) else list(target)
+
+
+def get_target_ecs(client: AcsClient, config: dict) -> List[EcsInstance]:
     from aliyun_scripts.lib.actions import get_available_ecs
 
+    instance_ids = get_target_ids(config)
+    if instance_ids is None:
+        return get_available_ecs(client, tags=config["Target"]["Tags"])
+
+    ecs_list = get_available_ecs(client, instance_ids)
+    order = {instance_id: i for i, instance_id in enumerate(instance_ids)}
+    return sorted(ecs_list, key=lambda ecs: order.get(ecs.InstanceId, len(order)))
+
+
+def get_missing_ids(config: dict, ecs_list: Sequence[EcsInstance]) -> List[str]:
+    # Ids of the target the API did not return; a tag selector misses nothing
+    instance_ids = get_target_ids(config)
+    if instance_ids is None:
+        return []
+    found = {ecs.InstanceId for ecs in ecs_list}
+    return [instance_id for instance_id in instance_ids if instance_id not in found]
+
+
+def get_client_config_and_ecs_list() -> Tuple[AcsClient, dict, List[EcsInstance]]:
     client, config = get_client_and_config()
-    ecs_list = get_available_ecs(client, config["Target"])
+    return client, config, get_target_ecs(client, config)
+
+
+def get_client_config_and_ecs() -> Tuple[AcsClient, dict, Optional[EcsInstance]]:
+    client, config, ecs_list = get_client_config_and_ecs_list()
 
     if len(ecs_list) > 0:
         return client, config, ecs_list[0]
@@ -59,20 +221,43 @@ def get_client_config_and_ecs() -> Tuple[AcsClient, dict, Optional[EcsInstance]]
 
 
 def wait_status(
-    get_func: Callable[[Enum], List],
-    till_status: EipStatus,
+    get_status: Callable[[], Optional[str]],
+    till_status: Enum,
     cb: Optional[Callable[[], Any]] = None,
-    interval: int = 2,
-    max_retries: int = 5,
+    policy: Optional[WaitPolicy] = None,
+    transition: Optional[str] = None,
 ) -> None:
-    remaining_retries = max_retries
-    while len(get_func(till_status)) == 0:
-        if remaining_retries == 0:
-            raise Exception("Exceeded maximum retries")
-        remaining_retries -= 1
+    if policy is None:
+        policy = (
+            transition_history.policy_for(transition)
+            if transition is not None
+            else DEFAULT_POLICY
+        )
+    start = monotonic()
+    for delay in policy.delays():
+        with tracer.span("poll", "wait"):
+            last_status = get_status()
+        elapsed = monotonic() - start
+        if last_status == till_status.value:
+            if transition is not None:
+                transition_history.record(transition, elapsed)
+            return
+        if elapsed >= policy.timeout:
+            raise WaitTimeoutError(till_status.value, last_status, elapsed)
         if cb is not None:
             cb()
-        sleep(interval)
+        with tracer.span("sleep", "wait"):
+            sleep(min(delay, policy.timeout - elapsed))
+
+
+def _wait_future(future: Future, till_status: Enum, timeout: float) -> None:
+    # The poller times the wait out itself; this only guards against a poller
+    # that stopped resolving its waiters
+    try:
+        future.result(timeout + POLLER_GRACE)
+    except FutureTimeoutError:
+        future.cancel()
+        raise WaitTimeoutError(till_status.value, None, timeout + POLLER_GRACE)
 
 
 def wait_eip_status(
@@ -81,18 +266,29 @@ def wait_eip_status(
     till_status: EipStatus,
     region_id: str,
     cb: Optional[Callable[[], Any]] = None,
-    interval: int = 2,
-    max_retries: int = 5,
+    policy: Optional[WaitPolicy] = None,
+    poller: Optional["StatusPoller"] = None,
 ) -> None:
     if eip.AllocationId is None:
         raise ValueError("The eip address needs to have an allocationId")
 
-    from aliyun_scripts.lib.actions import get_available_eip
+    transition = f"eip:{till_status.value}"
+    with tracer.span(f"wait {transition}", "wait", eip=eip.AllocationId):
+        if poller is not None:
+            policy = policy or transition_history.policy_for(transition)
+            future = poller.wait_eip(
+                eip.AllocationId, till_status, region_id, policy.timeout, cb, policy
+            )
+            _wait_future(future, till_status, policy.timeout)
+            return
+
+        from aliyun_scripts.lib.actions import get_available_eip
 
-    def get_func(status: EipInstance) -> List[EipInstance]:
-        return get_available_eip(client, status, region_id, eip)
+        def get_status() -> Optional[str]:
+            eip_list = get_available_eip(client, None, region_id, eip, fresh=True)
+            return eip_list[0].Status if len(eip_list) > 0 else None
 
-    wait_status(get_func, till_status, cb, interval, max_retries)
+        wait_status(get_status, till_status, cb, policy, transition)
 
 
 def wait_ecs_status(
@@ -100,29 +296,74 @@ def wait_ecs_status(
     ecs: Union[EcsInstance, str],
     till_status: EcsStatus,
     cb: Optional[Callable[[], Any]] = None,
-    interval: int = 2,
-    max_retries: int = 5,
+    policy: Optional[WaitPolicy] = None,
+    poller: Optional["StatusPoller"] = None,
 ) -> None:
     instance_id = ecs.InstanceId if isinstance(ecs, EcsInstance) else ecs
     if instance_id is None:
         raise ValueError("The InstanceId cannot be None")
-    from aliyun_scripts.lib.actions import get_available_ecs
 
-    def get_func(status: EipInstance) -> List[EcsInstance]:
-        return get_available_ecs(client, instance_id, status)
+    transition = f"ecs:{till_status.value}"
+    with tracer.span(f"wait {transition}", "wait", ecs=instance_id):
+        if poller is not None:
+            policy = policy or transition_history.policy_for(transition)
+            future = poller.wait_ecs(
+                instance_id, till_status, policy.timeout, cb, policy
+            )
+            _wait_future(future, till_status, policy.timeout)
+            return
+        from aliyun_scripts.lib.actions import get_available_ecs
 
-    wait_status(
-        get_func,
-        till_status,
-        cb,
-        interval,
-        max_retries,
-    )
+        def get_status() -> Optional[str]:
+            ecs_list = get_available_ecs(client, instance_id, fresh=True)
+            return ecs_list[0].Status if len(ecs_list) > 0 else None
+
+        wait_status(get_status, till_status, cb, policy, transition)
+
+
+class RoutedStream(io.TextIOBase):
+    # Stands in for sys.stdout or sys.stderr in a process running several
+    # commands at once, each thread writes where its command routed it
+    def __init__(self, default: TextIO):
+        self.default = default
+        self._local = threading.local()
+
+    def target(self) -> TextIO:
+        return getattr(self._local, "stream", None) or self.default
+
+    @contextmanager
+    def routed(self, stream: TextIO) -> Iterator[None]:
+        previous = getattr(self._local, "stream", None)
+        self._local.stream = stream
+        try:
+            yield
+        finally:
+            self._local.stream = previous
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        return self.target().write(text)
+
+    def flush(self) -> None:
+        self.target().flush()
+
+
+def command_stdout() -> TextIO:
+    stdout = sys.stdout
+    return stdout.target() if isinstance(stdout, RoutedStream) else stdout
 
 
 def get_print(quiet: bool):
+    # Bound to the stdout of the thread creating it, so the threads a command
+    # starts print where the command does
+    out = command_stdout()
+
     def _print(*args, **kwargs):
+        # Shows up as a log marker on the --profile timeline
+        tracer.instant(" ".join(str(arg) for arg in args))
         if not quiet:
-            print(*args, **kwargs)
+            print(*args, file=out, **kwargs)
 
     return _print
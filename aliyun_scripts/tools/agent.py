@@ -0,0 +1,331 @@
+import argparse
+import importlib
+import io
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+from contextlib import contextmanager
+from time import monotonic
+from typing import Any, Dict, Iterator, List, Optional
+
+from aliyun_scripts.lib.clients import clients
+from aliyun_scripts.lib.utils import STATE_DIR, RoutedStream
+
+PROTOCOL_VERSION = 1
+SOCKET = os.environ.get("ALIYUN_AGENT_SOCKET", os.path.join(STATE_DIR, "agent.sock"))
+
+TOOLS = {
+    "aliyun-ecs": "aliyun_scripts.tools.ecs_tool",
+    "aliyun-eip": "aliyun_scripts.tools.eip_tool",
+}
+# Imported when the agent starts, so no command pays for them
+WARM_MODULES = [
+    "aliyunsdkcore.client",
+    "aliyunsdkecs.request.v20140526.AllocateEipAddressRequest",
+    "aliyunsdkecs.request.v20140526.AssociateEipAddressRequest",
+    "aliyunsdkecs.request.v20140526.DescribeInstancesRequest",
+    "aliyunsdkecs.request.v20140526.StartInstanceRequest",
+    "aliyunsdkecs.request.v20140526.StopInstanceRequest",
+    "aliyunsdkecs.request.v20140526.UnassociateEipAddressRequest",
+    "aliyunsdkvpc.request.v20160428.DescribeEipAddressesRequest",
+    "aliyunsdkvpc.request.v20160428.ReleaseEipAddressRequest",
+    *TOOLS.values(),
+]
+
+# Signals that only describe, they run alongside each other
+READ_ONLY_SIGNALS = {"aliyun-ecs": {"ip", "status"}}
+# Options using the process wide tracer and metrics
+EXCLUSIVE_OPTIONS = {"--profile", "--metrics-out"}
+
+# Set inside the agent, where the tools run their commands themselves
+_serving = False
+
+
+def forward(tool: str, argv: List[str]) -> Optional[int]:
+    # Returns the exit code of the command run by the agent, or None when the
+    # caller should run it in-process because no agent is available
+    if _serving or os.environ.get("ALIYUN_NO_AGENT") or not os.path.exists(SOCKET):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with conn:
+        try:
+            conn.connect(SOCKET)
+            request = {
+                "version": PROTOCOL_VERSION,
+                "tool": tool,
+                "argv": argv,
+                "cwd": os.getcwd(),
+            }
+            conn.sendall(json.dumps(request).encode() + b"\n")
+        except OSError:
+            return None
+
+        for line in conn.makefile("rb"):
+            message = json.loads(line)
+            if "fallback" in message:
+                return None
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "err" in message:
+                sys.stderr.write(message["err"])
+                sys.stderr.flush()
+            elif "exit" in message:
+                return message["exit"]
+    # The command may have been half done, so running it again is not safe
+    print("The agent exited before the command finished", file=sys.stderr)
+    return 1
+
+
+class _MessageStream(io.TextIOBase):
+    def __init__(self, conn: socket.socket, key: str):
+        self._conn = conn
+        self._key = key
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if len(text) > 0:
+            _send(self._conn, {self._key: text})
+        return len(text)
+
+
+def _send(conn: socket.socket, message: Dict[str, Any]) -> None:
+    try:
+        conn.sendall(json.dumps(message).encode() + b"\n")
+    except OSError:
+        # The client went away, the command still runs to the end
+        pass
+
+
+def is_read_only(tool: str, argv: List[str]) -> bool:
+    # Anything not recognized here runs alone, like it always could
+    signals = READ_ONLY_SIGNALS.get(tool, set())
+    signal = None
+    for i, arg in enumerate(argv):
+        if arg.split("=", 1)[0] in EXCLUSIVE_OPTIONS:
+            return False
+        if arg in ("-s", "--signal") and i + 1 < len(argv):
+            signal = argv[i + 1]
+        elif arg.startswith("--signal="):
+            signal = arg[len("--signal=") :]
+        elif arg.startswith("-s") and not arg.startswith("--") and len(arg) > 2:
+            signal = arg[2:]
+    return signal in signals
+
+
+class _CommandGate:
+    # Read-only commands run alongside each other as long as they share the
+    # working directory, which is process wide; any other command runs alone
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._running = 0
+        self._exclusive = False
+        # Exclusive commands waiting, read-only ones let them go first
+        self._waiting = 0
+        self._cwd: Optional[str] = None
+        self._agent_cwd = os.getcwd()
+
+    @property
+    def busy(self) -> bool:
+        return self._running > 0
+
+    @contextmanager
+    def enter(self, cwd: str, exclusive: bool) -> Iterator[None]:
+        with self._condition:
+            if exclusive:
+                self._waiting += 1
+                self._condition.wait_for(lambda: self._running == 0)
+                self._waiting -= 1
+            else:
+                self._condition.wait_for(
+                    lambda: self._running == 0
+                    or (not self._exclusive and self._waiting == 0 and self._cwd == cwd)
+                )
+            if self._running == 0:
+                self._agent_cwd = os.getcwd()
+                os.chdir(cwd)
+                self._cwd = cwd
+            self._running += 1
+            self._exclusive = exclusive
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running -= 1
+                if self._running == 0:
+                    os.chdir(self._agent_cwd)
+                    self._cwd = None
+                    self._exclusive = False
+                self._condition.notify_all()
+
+
+class Agent:
+    def __init__(self, path: str = SOCKET, idle_timeout: float = 0):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.commands = 0
+        self._gate = _CommandGate()
+        self._stdout: Optional[RoutedStream] = None
+        self._stderr: Optional[RoutedStream] = None
+        self._last_active = monotonic()
+
+    def warm_up(self) -> None:
+        for module in WARM_MODULES:
+            importlib.import_module(module)
+
+        from aliyun_scripts.lib.utils import get_client_and_config
+
+        try:
+            get_client_and_config()
+        except (OSError, ValueError, KeyError):
+            # Nothing to keep warm yet, the first command reports the problem
+            pass
+
+    def serve_forever(self) -> None:
+        global _serving
+
+        _serving = True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            with probe:
+                try:
+                    probe.connect(self.path)
+                except OSError:
+                    # Left behind by an agent that did not shut down cleanly
+                    os.unlink(self.path)
+                else:
+                    raise RuntimeError(f"Another agent is listening on {self.path}")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The agent acts with the credentials of its user, nobody else may talk to it
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        server.listen()
+        if self.idle_timeout > 0:
+            server.settimeout(min(self.idle_timeout, 60))
+
+        # Every command writes to its own connection, anything else to the
+        # agent's own output
+        stdout, stderr = sys.stdout, sys.stderr
+        self._stdout, self._stderr = RoutedStream(stdout), RoutedStream(stderr)
+        sys.stdout, sys.stderr = self._stdout, self._stderr
+        try:
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    if (
+                        not self._gate.busy
+                        and monotonic() - self._last_active > self.idle_timeout
+                    ):
+                        return
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            server.close()
+            os.unlink(self.path)
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def _handle(self, conn: socket.socket) -> None:
+        with conn:
+            try:
+                request = json.loads(conn.makefile("rb").readline())
+            except ValueError:
+                return
+            if (
+                request.get("version") != PROTOCOL_VERSION
+                or request.get("tool") not in TOOLS
+            ):
+                _send(conn, {"fallback": True})
+                return
+            tool, argv = request["tool"], request["argv"]
+            exclusive = not is_read_only(tool, argv)
+            with self._gate.enter(request["cwd"], exclusive):
+                self._last_active = monotonic()
+                exit_code = self._run(conn, tool, argv, exclusive)
+                self.commands += 1
+                self._last_active = monotonic()
+            _send(conn, {"exit": exit_code})
+
+    def _run(
+        self, conn: socket.socket, tool: str, argv: List[str], exclusive: bool
+    ) -> int:
+        from aliyun_scripts.lib.metrics import metrics
+
+        # Commands with --metrics-out run alone, so only they start from zero;
+        # the config paths a command sets only last for its own thread
+        if exclusive:
+            metrics.reset()
+        with self._stdout.routed(_MessageStream(conn, "out")), self._stderr.routed(
+            _MessageStream(conn, "err")
+        ):
+            try:
+                importlib.import_module(TOOLS[tool]).main(argv)
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    return e.code or 0
+                print(e.code, file=sys.stderr)
+                return 1
+            except Exception:
+                traceback.print_exc()
+                return 1
+        return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Keep warm aliyun clients and run aliyun-ecs/aliyun-eip commands for them"
+    )
+
+    parser.add_argument("--socket", default=SOCKET, help="Path of the unix socket")
+
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=0,
+        help="Exit after this many seconds without commands, 0 to run forever",
+    )
+
+    parser.add_argument("--quiet", "-q", action="store_true", help="Disable output")
+
+    return parser.parse_args()
+
+
+def main():
+    from aliyun_scripts.lib import eip_pool, store
+    from aliyun_scripts.lib.actions import add_state_listener
+
+    args = parse_args()
+
+    # Exit through serve_forever's cleanup, which removes the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    agent = Agent(args.socket, args.idle_timeout)
+    agent.warm_up()
+    # Rebinds take eips from pools that stay warm between commands
+    eip_pool.hosted_pools = eip_pool.EipPoolRegistry()
+    # Follows every describe and action of every command, so ip and status can
+    # be answered from memory
+    store.hosted_inventory = store.InventoryStore()
+    add_state_listener(store.hosted_inventory)
+    if not args.quiet:
+        print(f"Listening on {args.socket}")
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        eip_pool.hosted_pools.close()
+        clients.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict
+from functools import partial
+from time import monotonic
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, TextIO
+
+from aliyun_scripts.lib.actions import (
+    add_state_listener,
+    get_available_ecs,
+    shutdown_ecs,
+    start_ecs,
+)
+from aliyun_scripts.lib.eip_pool import EipPoolRegistry
+from aliyun_scripts.lib.executor import DEFAULT_CONCURRENCY, run_concurrently
+from aliyun_scripts.lib.instances import EcsInstance, EcsStatus
+from aliyun_scripts.lib.metrics import error_code, metrics
+from aliyun_scripts.lib.poller import StatusPoller
+from aliyun_scripts.lib.snapshot import StateSnapshot
+from aliyun_scripts.lib.utils import (
+    SNAPSHOT,
+    get_client_and_config,
+    get_missing_ids,
+    get_target_ids,
+    update_config,
+    wait_ecs_status,
+)
+from aliyun_scripts.tools.eip_tool import (
+    eip_pools,
+    get_eip_config,
+    pool_for,
+    unbind_allocate_and_bind_new_eip,
+    unbind_release,
+)
+
+if TYPE_CHECKING:
+    from aliyunsdkcore.client import AcsClient
+
+SIGNALS = ["stop", "start", "rebind", "ip", "status", "release"]
+
+
+class CommandError(Exception):
+    pass
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        client: AcsClient,
+        config: dict,
+        concurrency: int,
+        out: Optional[TextIO] = None,
+        pools: Optional[EipPoolRegistry] = None,
+    ):
+        self.client = client
+        self.config = config
+        self.pools = pools
+        self.out = out if out is not None else sys.stdout
+        self.concurrency = concurrency
+        self.poller = StatusPoller(client)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._out_lock = threading.Lock()
+        # Done once the last command read for each instance finished; commands
+        # on the same instance run in the order they were read, the others
+        # concurrently
+        self._last: Dict[str, Future] = {}
+        self.pending: List[Future] = []
+        self.failed = 0
+
+    def write(self, result: Dict[str, Any]) -> None:
+        with self._out_lock:
+            if not result["ok"]:
+                self.failed += 1
+            self.out.write(json.dumps(result) + "\n")
+            self.out.flush()
+
+    def submit(self, line_number: int, line: str) -> None:
+        started = monotonic()
+        command_id: Any = line_number
+        try:
+            command = json.loads(line)
+            if not isinstance(command, dict):
+                raise CommandError("A command needs to be a JSON object")
+            command_id = command.get("id", line_number)
+            signal = command.get("signal")
+            if signal not in SIGNALS:
+                raise CommandError(f"Unknown signal {signal!r}")
+            instance_ids = self.resolve(command.get("target", self.config["Target"]))
+        except Exception as e:
+            self.write(_failure(command_id, e, started))
+            return
+
+        previous = {self._last[i] for i in instance_ids if i in self._last}
+        done: Future = Future()
+        for instance_id in instance_ids:
+            self._last[instance_id] = done
+        self.pending.append(done)
+        start = partial(
+            self.executor.submit,
+            self.run,
+            command_id,
+            signal,
+            instance_ids,
+            command.get("options", {}),
+            done,
+            started,
+        )
+        if len(previous) == 0:
+            start()
+            return
+
+        # Submitted once the earlier commands finished, so no worker is held
+        # waiting for them. Earlier commands report their own failures
+        remaining = len(previous)
+        lock = threading.Lock()
+
+        def finished(future: Future) -> None:
+            nonlocal remaining
+            with lock:
+                remaining -= 1
+                ready = remaining == 0
+            if ready:
+                start()
+
+        for future in previous:
+            future.add_done_callback(finished)
+
+    def resolve(self, target: Any) -> List[str]:
+        instance_ids = get_target_ids({"Target": target})
+        if instance_ids is None:
+            # Tag selectors are resolved now, so the order per instance is known
+            instance_ids = [
+                ecs.InstanceId
+                for ecs in get_available_ecs(self.client, tags=target["Tags"])
+            ]
+        if len(instance_ids) == 0:
+            raise CommandError("The target matches no ecs")
+        return instance_ids
+
+    def run(
+        self,
+        command_id: Any,
+        signal: str,
+        instance_ids: List[str],
+        options: Dict[str, Any],
+        done: Future,
+        started: float,
+    ) -> None:
+        try:
+            self._run(command_id, signal, instance_ids, options, started)
+        finally:
+            done.set_result(None)
+
+    def _run(
+        self,
+        command_id: Any,
+        signal: str,
+        instance_ids: List[str],
+        options: Dict[str, Any],
+        started: float,
+    ) -> None:
+        try:
+            # Earlier commands may have changed the instances
+            ecs_list = get_available_ecs(self.client, instance_ids, fresh=True)
+            missing = get_missing_ids({"Target": instance_ids}, ecs_list)
+            if len(missing) > 0:
+                raise CommandError(f"The ecs {', '.join(missing)} does not exist")
+            action = partial(getattr(self, f"_{signal}"), options=options)
+            # The instances of one command do not depend on each other
+            tasks = run_concurrently(action, ecs_list, self.concurrency)
+            for task in tasks:
+                if not task.ok:
+                    raise task.error
+            results = [task.result for task in tasks]
+        except Exception as e:
+            self.write(_failure(command_id, e, started))
+            return
+        self.write(
+            {
+                "id": command_id,
+                "ok": True,
+                "result": results if len(results) > 1 else results[0],
+                "seconds": round(monotonic() - started, 3),
+            }
+        )
+
+    def _stop(self, ecs: EcsInstance, options: Dict[str, Any]) -> dict:
+        shutdown_ecs(
+            self.client,
+            ecs,
+            options.get("StoppedMode", "StopCharging"),
+            options.get("ForceStop", False),
+        )
+        if options.get("Wait", True):
+            wait_ecs_status(self.client, ecs, EcsStatus.stopped, poller=self.poller)
+        return {"InstanceId": ecs.InstanceId}
+
+    def _start(self, ecs: EcsInstance, options: Dict[str, Any]) -> dict:
+        start_ecs(self.client, ecs)
+        if options.get("Wait", True):
+            wait_ecs_status(self.client, ecs, EcsStatus.running, poller=self.poller)
+        return {"InstanceId": ecs.InstanceId}
+
+    def _rebind(self, ecs: EcsInstance, options: Dict[str, Any]) -> dict:
+        report = unbind_allocate_and_bind_new_eip(
+            self.client,
+            ecs,
+            get_eip_config(self.config, ecs.RegionId),
+            False,
+            True,
+            options.get("ReleaseOldEip", True),
+            options.get("AllocateNewEip", True),
+            self.poller,
+            pool_for(self.pools, self.client, self.config, ecs.RegionId),
+        )
+        if report is None:
+            raise CommandError("No eip available")
+        return {
+            "InstanceId": ecs.InstanceId,
+            "IpAddress": report.new_eip.IpAddress,
+            "OldIpAddress": report.old_eip.IpAddress
+            if report.old_eip is not None
+            else None,
+            "Downtime": round(report.downtime, 3),
+            "LeakedAllocationId": report.leaked_eip.AllocationId
+            if report.leaked_eip is not None
+            else None,
+        }
+
+    def _release(self, ecs: EcsInstance, options: Dict[str, Any]) -> dict:
+        unbind_release(
+            self.client, ecs, options.get("Release", True), False, True, self.poller
+        )
+        return {
+            "InstanceId": ecs.InstanceId,
+            "AllocationId": ecs.EipAddress.AllocationId
+            if ecs.EipAddress is not None
+            else None,
+        }
+
+    def _ip(self, ecs: EcsInstance, options: Dict[str, Any]) -> dict:
+        return {
+            "InstanceId": ecs.InstanceId,
+            "IpAddress": ecs.EipAddress.IpAddress
+            if ecs.EipAddress is not None
+            else None,
+        }
+
+    def _status(self, ecs: EcsInstance, options: Dict[str, Any]) -> dict:
+        return asdict(ecs)
+
+    def wait(self) -> None:
+        for future in self.pending:
+            future.result()
+        self.executor.shutdown()
+
+
+def _failure(command_id: Any, error: Exception, started: float) -> Dict[str, Any]:
+    return {
+        "id": command_id,
+        "ok": False,
+        "error": str(error) or repr(error),
+        "code": error_code(error),
+        "seconds": round(monotonic() - started, 3),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run aliyun-ecs commands read as JSON lines from stdin, e.g. "
+        '{"id": 1, "signal": "rebind", "target": "i-1", "options": {"ReleaseOldEip": true}}'
+    )
+
+    parser.add_argument("--config", "-c")
+
+    parser.add_argument("--secrets", "-a")
+
+    parser.add_argument(
+        "--concurrency",
+        "-j",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Maximum number of commands running at the same time",
+    )
+
+    parser.add_argument(
+        "--metrics-out",
+        help="Write api call metrics to this file on exit, as JSON if it ends with .json and in the Prometheus text format otherwise",
+    )
+
+    return parser.parse_args()
+
+
+def run(args: argparse.Namespace) -> int:
+    update_config(args.secrets, args.config)
+    add_state_listener(StateSnapshot(SNAPSHOT))
+
+    client, config = get_client_and_config()
+    with eip_pools() as pools:
+        runner = BatchRunner(client, config, args.concurrency, pools=pools)
+        # Commands start while later lines are still being read
+        for line_number, line in enumerate(sys.stdin, start=1):
+            if line.strip() != "":
+                runner.submit(line_number, line)
+        runner.wait()
+    return 1 if runner.failed > 0 else 0
+
+
+def main():
+    args = parse_args()
+    try:
+        exit_code = run(args)
+    finally:
+        if args.metrics_out is not None:
+            metrics.dump(args.metrics_out)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,52 @@
 import argparse
+import sys
+from typing import Callable, List, Optional
 
-from aliyun_scripts.lib.actions import shutdown_ecs, start_ecs
-from aliyun_scripts.lib.instances import EcsStatus
+from aliyun_scripts.lib import store
+from aliyun_scripts.lib.actions import add_state_listener, shutdown_ecs, start_ecs
+from aliyun_scripts.lib.discovery import Inventory, discover
+from aliyun_scripts.lib.executor import (
+    DEFAULT_CONCURRENCY,
+    RolloutResult,
+    TaskResult,
+    parse_budget,
+    shutdown_many,
+    start_many,
+)
+from aliyun_scripts.lib.instances import EcsInstance, EcsStatus, EipStatus
+from aliyun_scripts.lib.metrics import metrics
+from aliyun_scripts.lib.snapshot import StateSnapshot
+from aliyun_scripts.lib.tracing import tracer
 from aliyun_scripts.lib.utils import (
-    get_client_config_and_ecs,
+    SNAPSHOT,
+    get_client_and_config,
+    get_client_config_and_ecs_list,
+    get_missing_ids,
     get_print,
+    get_target_ids,
+    load_config,
+    p,
     update_config,
     wait_ecs_status,
 )
-from aliyun_scripts.tools.eip_tool import (
-    load_config_and_unbind_allocate_and_bind_new_eip,
-    unbind_release,
-)
+from aliyun_scripts.tools.agent import forward
+
+TOOL_NAME = "aliyun-ecs"
 
 
-def parse_args():
+def parse_args(argv: Optional[List[str]] = None):
     parser = argparse.ArgumentParser(description="Manage the ecs using aliyun API")
 
-    signals = ["stop", "start", "rebind", "ip", "status", "release"]
+    signals = [
+        "stop",
+        "start",
+        "rebind",
+        "ip",
+        "status",
+        "release",
+        "discover",
+        "rotate",
+    ]
     parser.add_argument(
         "-s",
         "--signal",
@@ -33,60 +62,321 @@ def parse_args():
 
     parser.add_argument("--secrets", "-a")
 
+    parser.add_argument(
+        "--profile",
+        help="Write a timeline of the api calls, waits and phases to this file in the Chrome trace format and print a summary",
+    )
+
+    parser.add_argument(
+        "--metrics-out",
+        help="Write api call metrics to this file on exit, as JSON if it ends with .json and in the Prometheus text format otherwise",
+    )
+
     parser.add_argument("--quiet", "-q", action="store_true", help="Disable output")
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--concurrency",
+        "-j",
+        type=int,
+        help=f"Maximum number of ecs handled at the same time, {DEFAULT_CONCURRENCY} by default; discover queries every region at once by default",
+    )
 
+    parser.add_argument(
+        "--max-unavailable",
+        default="10%",
+        help="Number or percentage of ecs rotate leaves without a public ip at the same time, at least 1",
+    )
 
-def main():
-    args = parse_args()
-    _print = get_print(args.quiet)
+    parser.add_argument(
+        "--max-failures",
+        default="0",
+        help="Number or percentage of failed ecs after which rotate stops starting new ones",
+    )
 
-    update_config(args.secrets, args.config)
+    parser.add_argument(
+        "--regions",
+        help="Comma separated regions searched by discover, all regions by default",
+    )
 
-    client, _, ecs = get_client_config_and_ecs()
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=0,
+        help="Answer ip and status from the local snapshot if it is at most this many seconds old",
+    )
 
-    if ecs is None:
-        print("The requested ecs does not exist")
-        exit(1)
-
-    if args.signal == "stop":
-        _print("+ Shutting down the ecs")
-        shutdown_ecs(client, ecs, "StopCharging")
-        wait_ecs_status(
-            client,
-            ecs,
-            EcsStatus.stopped,
-            lambda: print("Waiting the ecs to stop..."),
-            interval=5,
-        )
-        _print("Successfully stopped the ecs")
-    elif args.signal == "start":
-        _print("+ Starting the ecs")
-        start_ecs(client, ecs)
-        wait_ecs_status(
-            client,
-            ecs,
-            EcsStatus.running,
-            lambda: print("Waiting the ecs to start running..."),
-        )
-        _print("Successfully started the ecs")
-    elif args.signal == "rebind":
-        _print("+ Rebinding the ecs")
-        load_config_and_unbind_allocate_and_bind_new_eip(
-            args.verbose, args.quiet, True, True
-        )
-    elif args.signal == "ip":
+    return parser.parse_args(argv)
+
+
+def print_results(results: List[TaskResult], _print: Callable) -> None:
+    for result in results:
+        ecs = result.target
+        if result.ok:
+            _print(f"{ecs.InstanceId} ({ecs.InstanceName}): done")
+        else:
+            print(f"{ecs.InstanceId} ({ecs.InstanceName}): failed, {result.error!r}")
+
+
+def print_info(
+    signal: str,
+    ecs: EcsInstance,
+    _print: Callable,
+    age: Optional[float] = None,
+    source: str = "the local snapshot",
+) -> None:
+    if signal == "ip":
         if ecs.EipAddress is not None:
             _print(
                 f"The ip address of {ecs.InstanceId} ({ecs.InstanceName}) is:\n{ecs.EipAddress.IpAddress}"
             )
         else:
-            _print("No eip binded")
-    elif args.signal == "status":
+            _print(f"No eip binded to {ecs.InstanceId} ({ecs.InstanceName})")
+    else:
         _print(f"The status of {ecs.InstanceId} ({ecs.InstanceName}) is:\n{ecs.Status}")
-    elif args.signal == "release":
-        unbind_release(client, ecs, True, args.verbose, args.quiet)
+    if age is not None:
+        _print(f"(from {source}, {age:.1f}s old)")
+
+
+def print_rollout(rollout: RolloutResult, total: int, _print: Callable) -> None:
+    downtimes = [
+        result.result.downtime
+        for result in rollout.results
+        if result.ok and result.result is not None
+    ]
+    _print(
+        f"Rotated {len(downtimes)} of {total} ecs in {rollout.wall_time:.1f}s"
+        + (
+            f", without a public ip for {sum(downtimes) / len(downtimes):.1f}s"
+            f" on average and {max(downtimes):.1f}s at most"
+            if len(downtimes) > 0
+            else ""
+        )
+    )
+    for result in rollout.failed:
+        ecs = result.target
+        print(f"{ecs.InstanceId} ({ecs.InstanceName}): failed, {result.error!r}")
+    if rollout.aborted:
+        print(
+            f"Aborted after {len(rollout.failed)} failures, {len(rollout.skipped)} ecs were not rotated: "
+            + ", ".join(ecs.InstanceId for ecs in rollout.skipped)
+        )
+
+
+def print_inventory(inventory: Inventory, _print: Callable) -> None:
+    for region_id in inventory.regions:
+        if region_id in inventory.errors:
+            print(f"{region_id}: failed, {inventory.errors[region_id]!r}")
+            continue
+        ecs_list = inventory.ecs_in(region_id)
+        idle_eips = [
+            eip
+            for eip in inventory.eips_in(region_id)
+            if eip.Status == EipStatus.available.value
+        ]
+        if len(ecs_list) == 0 and len(idle_eips) == 0:
+            continue
+        _print(f"{region_id} ({inventory.durations.get(region_id, 0):.2f}s):")
+        for ecs in ecs_list:
+            ip = ecs.EipAddress.IpAddress if ecs.EipAddress is not None else "N/A"
+            _print(f"  {ecs.InstanceId} ({ecs.InstanceName}): {ecs.Status}, {ip}")
+        for eip in idle_eips:
+            _print(f"  {eip.AllocationId}: {eip.IpAddress}, not in use")
+
+
+def run(args: argparse.Namespace) -> None:
+    _print = get_print(args.quiet)
+
+    update_config(args.secrets, args.config)
+
+    snapshot = StateSnapshot(SNAPSHOT)
+    if args.max_age > 0 and args.signal in ("ip", "status"):
+        instance_ids = get_target_ids(load_config())
+        cached = None
+        if instance_ids is not None and store.hosted_inventory is not None:
+            # Kept in memory by the agent, no need to read the snapshot file
+            cached = store.hosted_inventory.get_recent_ecs(instance_ids, args.max_age)
+            source = "the agent's inventory"
+        if instance_ids is not None and cached is None:
+            cached = snapshot.get_ecs(instance_ids, args.max_age)
+            source = "the local snapshot"
+        if cached is not None:
+            for ecs, age in cached:
+                print_info(args.signal, ecs, _print, age, source)
+            return
+    add_state_listener(snapshot)
+
+    if args.signal == "discover":
+        client, config = get_client_and_config()
+        if args.regions is not None:
+            regions = [region for region in args.regions.split(",") if region != ""]
+        else:
+            regions = config.get("Regions")
+        _print("+ Discovering ecs and eips")
+        inventory = discover(client, regions, args.concurrency)
+        print_inventory(inventory, _print)
+        if len(inventory.errors) > 0:
+            sys.exit(1)
+        return
+
+    if args.signal in ("rebind", "release", "rotate"):
+        from aliyun_scripts.tools.eip_tool import (
+            eip_pools,
+            get_eip_config,
+            pool_for,
+            rebind_many,
+            rotate_eips,
+            unbind_allocate_and_bind_new_eip,
+            unbind_release,
+        )
+
+    client, config, ecs_list = get_client_config_and_ecs_list()
+    concurrency = args.concurrency or DEFAULT_CONCURRENCY
+
+    missing = get_missing_ids(config, ecs_list)
+    if len(missing) > 0:
+        # Nothing is done to the others either, so a typo cannot go unnoticed
+        print(f"The ecs {', '.join(missing)} does not exist")
+        sys.exit(1)
+    if len(ecs_list) == 0:
+        print("The requested ecs does not exist")
+        sys.exit(1)
+
+    if args.signal == "rotate":
+        max_unavailable = max(parse_budget(args.max_unavailable, len(ecs_list)), 1)
+        max_failures = parse_budget(args.max_failures, len(ecs_list))
+        _print(
+            f"+ Rotating the eips of {len(ecs_list)} ecs, {max_unavailable} at a time"
+        )
+
+        def report(result: TaskResult) -> None:
+            ecs = result.target
+            if result.ok and result.result is not None:
+                _print(
+                    f"{ecs.InstanceId} ({ecs.InstanceName}): {result.result.new_eip.IpAddress}, "
+                    f"without a public ip for {result.result.downtime:.1f}s"
+                )
+                if result.result.leaked_eip is not None:
+                    print(
+                        f"{ecs.InstanceId} ({ecs.InstanceName}): the old eip "
+                        f"{result.result.leaked_eip.AllocationId} could not be released"
+                    )
+
+        with eip_pools() as pools:
+            rollout = rotate_eips(
+                client,
+                ecs_list,
+                config,
+                not args.quiet and args.verbose,
+                True,
+                max_unavailable,
+                max_failures,
+                pools,
+                report,
+            )
+            if pools is not None:
+                p(args.verbose, pools.stats())
+        print_rollout(rollout, len(ecs_list), _print)
+        if len(rollout.failed) > 0:
+            sys.exit(1)
+        return
+
+    if len(ecs_list) > 1 and args.signal in ("stop", "start", "rebind"):
+        if args.signal == "stop":
+            _print(f"+ Shutting down {len(ecs_list)} ecs")
+            results = shutdown_many(
+                client,
+                ecs_list,
+                "StopCharging",
+                concurrency,
+                lambda ecs: _print(f"Waiting the ecs {ecs.InstanceId} to stop..."),
+            )
+        elif args.signal == "start":
+            _print(f"+ Starting {len(ecs_list)} ecs")
+            results = start_many(
+                client,
+                ecs_list,
+                concurrency,
+                lambda ecs: _print(
+                    f"Waiting the ecs {ecs.InstanceId} to start running..."
+                ),
+            )
+        else:
+            _print(f"+ Rebinding {len(ecs_list)} ecs")
+            with eip_pools() as pools:
+                results = rebind_many(
+                    client,
+                    ecs_list,
+                    config,
+                    not args.quiet and args.verbose,
+                    args.quiet,
+                    concurrency=concurrency,
+                    pools=pools,
+                )
+                if pools is not None:
+                    p(args.verbose, pools.stats())
+        print_results(results, _print)
+        if not all(result.ok for result in results):
+            sys.exit(1)
+        return
+
+    for ecs in ecs_list:
+        if args.signal == "stop":
+            _print(f"+ Shutting down the ecs {ecs.InstanceId}")
+            shutdown_ecs(client, ecs, "StopCharging")
+            wait_ecs_status(
+                client,
+                ecs,
+                EcsStatus.stopped,
+                lambda: print("Waiting the ecs to stop..."),
+            )
+            _print("Successfully stopped the ecs")
+        elif args.signal == "start":
+            _print(f"+ Starting the ecs {ecs.InstanceId}")
+            start_ecs(client, ecs)
+            wait_ecs_status(
+                client,
+                ecs,
+                EcsStatus.running,
+                lambda: print("Waiting the ecs to start running..."),
+            )
+            _print("Successfully started the ecs")
+        elif args.signal == "rebind":
+            _print(f"+ Rebinding the ecs {ecs.InstanceId}")
+            with eip_pools() as pools:
+                unbind_allocate_and_bind_new_eip(
+                    client,
+                    ecs,
+                    get_eip_config(config, ecs.RegionId),
+                    not args.quiet and args.verbose,
+                    args.quiet,
+                    True,
+                    True,
+                    pool=pool_for(pools, client, config, ecs.RegionId),
+                )
+        elif args.signal in ("ip", "status"):
+            print_info(args.signal, ecs, _print)
+        elif args.signal == "release":
+            unbind_release(client, ecs, True, args.verbose, args.quiet)
+
+
+def main(argv: Optional[List[str]] = None):
+    # The agent passes the argv of the command it runs
+    argv = sys.argv[1:] if argv is None else argv
+    exit_code = forward(TOOL_NAME, argv)
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+    args = parse_args(argv)
+    if args.profile is not None:
+        tracer.start()
+    try:
+        with tracer.span(f"{TOOL_NAME} -s {args.signal}", "command"):
+            run(args)
+    finally:
+        if args.metrics_out is not None:
+            metrics.dump(args.metrics_out)
+        if args.profile is not None:
+            tracer.finish(args.profile)
 
 
 if __name__ == "__main__":
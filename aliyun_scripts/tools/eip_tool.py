@@ -1,35 +1,82 @@
-import argparse
-from dataclasses import asdict
-from typing import Callable, Optional
+from __future__ import annotations
 
-from aliyunsdkcore.client import AcsClient
+import argparse
+import sys
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from time import monotonic
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+)
 
+from aliyun_scripts.lib import eip_pool
 from aliyun_scripts.lib.actions import (
+    add_state_listener,
     allocate_eip,
     bind_eip_to_ecs,
-    get_available_eip,
+    iter_available_eip,
     release_eip,
     unbind_eip_from_ecs,
 )
+from aliyun_scripts.lib.eip_pool import (
+    EipPool,
+    EipPoolRegistry,
+    claim_eip,
+    unclaim_eip,
+)
 from aliyun_scripts.lib.exceptions import UnbindFailureError
-from aliyun_scripts.lib.instances import EcsInstance, EipConfiguration, EipStatus
+from aliyun_scripts.lib.executor import (
+    DEFAULT_CONCURRENCY,
+    RolloutResult,
+    TaskResult,
+    run_concurrently,
+    run_rolling,
+)
+from aliyun_scripts.lib.instances import (
+    EcsInstance,
+    EipConfiguration,
+    EipInstance,
+    EipStatus,
+)
+from aliyun_scripts.lib.metrics import metrics
+from aliyun_scripts.lib.poller import StatusPoller
+from aliyun_scripts.lib.snapshot import StateSnapshot
+from aliyun_scripts.lib.tracing import traced, tracer
 from aliyun_scripts.lib.utils import (
+    SNAPSHOT,
     get_client_config_and_ecs,
     get_print,
     p,
     update_config,
     wait_eip_status,
 )
+from aliyun_scripts.tools.agent import forward
+
+if TYPE_CHECKING:
+    from aliyunsdkcore.client import AcsClient
 
+TOOL_NAME = "aliyun-eip"
 
+
+@traced("unbind and release")
 def unbind_release(
     client: AcsClient,
     target_ecs: EcsInstance,
     release_old_eip: bool,
     verbose: bool,
     quiet: bool,
+    poller: Optional[StatusPoller] = None,
+    log: Optional[Callable[[str], Any]] = None,
 ):
-    _print = get_print(quiet)
+    _print = log if log is not None else get_print(quiet)
     try:
         _print("+ Trying to unbind currently binded eip")
         eip = unbind_eip_from_ecs(client, target_ecs)
@@ -39,6 +86,7 @@ def unbind_release(
             EipStatus.available,
             target_ecs.RegionId,
             lambda: _print("Waiting for the eip to be unbinded..."),
+            poller=poller,
         )
         _print("Successfully unbinded the eip")
         p(verbose, asdict(eip))
@@ -52,6 +100,63 @@ def unbind_release(
         _print("No eip to be unbinded, continuing...")
 
 
+@dataclass
+class RebindReport:
+    ecs: EcsInstance
+    new_eip: EipInstance
+    old_eip: Optional[EipInstance]
+    # Seconds between unbinding the old eip and the new one being in use
+    downtime: float
+    total: float
+    # The old eip when it was unbound but could not be released
+    leaked_eip: Optional[EipInstance] = None
+
+
+@traced("find existing eip")
+def _take_existing_eip(
+    client: AcsClient,
+    region_id: str,
+    verbose: bool,
+    _print: Callable[[str], Any],
+    pool: Optional[EipPool] = None,
+) -> Optional[EipInstance]:
+    new_eip = pool.acquire() if pool is not None else None
+    if new_eip is not None:
+        _print("Took a pre-allocated eip from the pool")
+        p(verbose, asdict(new_eip), _print)
+        return new_eip
+
+    # See if there is already an available eip
+    _print("+ Finding existing available eips")
+    # The first claimable eip ends the search, so later pages are never fetched
+    eip_list = iter_available_eip(
+        client, EipStatus.available, region_id, prefetch=False
+    )
+
+    # Concurrent rebinds may see the same available eip, so each one claims its pick
+    for eip in eip_list:
+        if claim_eip(eip.AllocationId):
+            _print("Available eip found, going to use it without creating a new one")
+            p(verbose, asdict(eip), _print)
+            return eip
+    _print("No available eip found")
+    return None
+
+
+def _allocate_and_claim(
+    client: AcsClient,
+    eip_config: EipConfiguration,
+    verbose: bool,
+    _print: Callable[[str], Any],
+) -> EipInstance:
+    new_eip = allocate_eip(client, eip_config, verbose)
+    claim_eip(new_eip.AllocationId)
+    _print("Allocated new eip")
+    p(verbose, new_eip, _print)
+    return new_eip
+
+
+@traced("rebind")
 def unbind_allocate_and_bind_new_eip(
     client: AcsClient,
     target_ecs: EcsInstance,
@@ -60,48 +165,232 @@ def unbind_allocate_and_bind_new_eip(
     quiet: bool,
     release_old_eip: bool,
     allocate_new_eip: bool,
-) -> Optional[EcsInstance]:
-    _print = get_print(quiet)
+    poller: Optional[StatusPoller] = None,
+    pool: Optional[EipPool] = None,
+    log: Optional[Callable[[str], Any]] = None,
+) -> Optional[RebindReport]:
+    _print = log if log is not None else get_print(quiet)
+    started = monotonic()
+
+    old_eip = target_ecs.EipAddress
+    if old_eip is not None and old_eip.AllocationId is None:
+        old_eip = None
+    # The old eip turns available halfway through, keep other rebinds off it
+    old_claimed = old_eip is not None and claim_eip(old_eip.AllocationId)
 
-    # See if there is already an available eip
-    _print("+ Finding existing available eips")
-    eip_list = get_available_eip(client, EipStatus.available, target_ecs.RegionId)
     new_eip = None
+    allocation: Optional[Future] = None
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        new_eip = _take_existing_eip(client, target_ecs.RegionId, verbose, _print, pool)
+        if new_eip is None:
+            if not allocate_new_eip:
+                _print("Cannot create new eip by configuration, exitting now...")
+                return None
+            # Allocating does not depend on the old eip, so it runs while unbinding
+            _print("+ Going to create a new eip with the following configuration")
+            p(verbose, asdict(eip_config), _print)
+            allocation = executor.submit(
+                _allocate_and_claim, client, eip_config, verbose, _print
+            )
+
+        unbinded_at = None
+        if old_eip is not None:
+            _print("+ Trying to unbind currently binded eip")
+            # The ip may already be gone before the unbind call returns
+            unbinded_at = monotonic()
+            unbind_eip_from_ecs(client, target_ecs, old_eip)
+            wait_eip_status(
+                client,
+                old_eip,
+                EipStatus.available,
+                target_ecs.RegionId,
+                lambda: _print("Waiting for the eip to be unbinded..."),
+                poller=poller,
+            )
+            _print("Successfully unbinded the eip")
+            p(verbose, asdict(old_eip), _print)
+        else:
+            _print("No eip to be unbinded, continuing...")
+
+        if allocation is not None:
+            try:
+                new_eip = allocation.result()
+            except Exception:
+                if old_eip is not None:
+                    _print("Failed to allocate a new eip, binding the old one back")
+                    bind_eip_to_ecs(client, old_eip, target_ecs)
+                raise
+
+        _print("+ Trying to bind the new eip")
+        try:
+            bind_eip_to_ecs(client, new_eip, target_ecs)
+        except Exception:
+            # The old eip is not released yet, so the ecs gets its ip back
+            if old_eip is not None:
+                _print("Failed to bind the new eip, binding the old one back")
+                bind_eip_to_ecs(client, old_eip, target_ecs)
+            raise
 
-    if len(eip_list) > 0:
-        _print("Available eip found, going to use it without creating a new one")
-        new_eip = eip_list[0]
-        p(verbose, asdict(new_eip))
-    else:
-        _print("No available eip found")
-        if not allocate_new_eip:
-            _print("Cannot create new eip by configuration, exitting now...")
-            return None
-        _print("+ Going to create a new eip with the following configuration")
-        p(verbose, asdict(eip_config))
-        new_eip = allocate_eip(client, eip_config, verbose)
-        _print("Allocated new eip")
-        p(verbose, new_eip)
-
-    # If there is an eip currently binded, we unbind it first
-    unbind_release(client, target_ecs, release_old_eip, verbose, quiet)
-
-    _print("+ Trying to bind the new eip")
-    bind_eip_to_ecs(client, new_eip, target_ecs)
-    wait_eip_status(
+        # Nothing waits for the old eip to be released
+        release: Optional[Future] = None
+        if old_eip is not None and release_old_eip:
+            _print("+ Trying to release the unbinded eip")
+            release = executor.submit(release_eip, client, old_eip)
+        elif old_eip is not None:
+            _print("Not going to release the old eip by configuration")
+
+        wait_eip_status(
+            client,
+            new_eip,
+            EipStatus.in_use,
+            target_ecs.RegionId,
+            lambda: _print("Waiting for the eip to be binded..."),
+            poller=poller,
+        )
+        downtime = monotonic() - unbinded_at if unbinded_at is not None else 0
+        _print(
+            f"Binded eip {new_eip.AllocationId} ({new_eip.IpAddress}) to ecs {target_ecs.InstanceId} ({target_ecs.InstanceName})"
+        )
+        _print(f"The ecs was without a public ip for {downtime:.1f}s")
+
+        leaked_eip = None
+        if release is not None:
+            # The new eip is in use already, so this does not fail the rebind
+            try:
+                release.result()
+                _print("Successfully relased the eip")
+            except Exception as e:
+                leaked_eip = old_eip
+                _print(f"Failed to release the old eip {old_eip.AllocationId}: {e}")
+    finally:
+        executor.shutdown()
+        if (
+            new_eip is None
+            and allocation is not None
+            and allocation.done()
+            and allocation.exception() is None
+        ):
+            new_eip = allocation.result()
+        if new_eip is not None:
+            unclaim_eip(new_eip.AllocationId)
+        if old_claimed:
+            unclaim_eip(old_eip.AllocationId)
+
+    return RebindReport(
+        target_ecs, new_eip, old_eip, downtime, monotonic() - started, leaked_eip
+    )
+
+
+def _rebinder(
+    client: AcsClient,
+    ecs_list: Sequence[EcsInstance],
+    config: dict,
+    verbose: bool,
+    quiet: bool,
+    release_old_eip: bool,
+    allocate_new_eip: bool,
+    pools: Optional[EipPoolRegistry],
+) -> Callable[[EcsInstance], Optional[RebindReport]]:
+    # One poller and logger shared by every rebind, and every pool starts
+    # filling before the first rebind needs it
+    poller = StatusPoller(client)
+    pool_by_region = {
+        region_id: pool_for(pools, client, config, region_id)
+        for region_id in sorted({ecs.RegionId for ecs in ecs_list})
+    }
+    log = get_print(quiet)
+
+    def rebind(ecs: EcsInstance) -> Optional[RebindReport]:
+        return unbind_allocate_and_bind_new_eip(
+            client,
+            ecs,
+            get_eip_config(config, ecs.RegionId),
+            verbose,
+            quiet,
+            release_old_eip,
+            allocate_new_eip,
+            poller,
+            pool_by_region[ecs.RegionId],
+            log,
+        )
+
+    return rebind
+
+
+def rebind_many(
+    client: AcsClient,
+    ecs_list: Sequence[EcsInstance],
+    config: dict,
+    verbose: bool,
+    quiet: bool,
+    release_old_eip: bool = True,
+    allocate_new_eip: bool = True,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    pools: Optional[EipPoolRegistry] = None,
+) -> List[TaskResult]:
+    rebind = _rebinder(
         client,
-        new_eip,
-        EipStatus.in_use,
-        target_ecs.RegionId,
-        lambda: _print("Waiting for the eip to be binded..."),
+        ecs_list,
+        config,
+        verbose,
+        quiet,
+        release_old_eip,
+        allocate_new_eip,
+        pools,
     )
-    _print(
-        f"Binded eip {new_eip.AllocationId} ({new_eip.IpAddress}) to ecs {target_ecs.InstanceId} ({target_ecs.InstanceName})"
+    return run_concurrently(rebind, ecs_list, concurrency)
+
+
+def rotate_eips(
+    client: AcsClient,
+    ecs_list: Sequence[EcsInstance],
+    config: dict,
+    verbose: bool,
+    quiet: bool,
+    max_unavailable: int,
+    max_failures: int = 0,
+    pools: Optional[EipPoolRegistry] = None,
+    cb: Optional[Callable[[TaskResult], Any]] = None,
+) -> RolloutResult:
+    # At most max_unavailable ecs are without their public ip at any time
+    rebind = _rebinder(client, ecs_list, config, verbose, quiet, True, True, pools)
+    return run_rolling(rebind, ecs_list, max_unavailable, max_failures, cb)
+
+
+@contextmanager
+def eip_pools() -> Iterator[Optional[EipPoolRegistry]]:
+    # Only the agent's pools outlive a command. A pool living for one command
+    # would allocate ahead of it and release what it did not use at the end,
+    # so anywhere else eips are allocated on demand
+    yield eip_pool.hosted_pools
+
+
+def pool_for(
+    pools: Optional[EipPoolRegistry], client: AcsClient, config: dict, region_id: str
+) -> Optional[EipPool]:
+    size = config.get("EipPoolSize", 0)
+    if pools is None or size <= 0:
+        return None
+    return pools.get(
+        client,
+        get_eip_config(config, region_id),
+        size,
+        config.get("EipPoolIdleTimeout", 1800),
     )
-    return target_ecs
 
 
-def parse_args():
+def get_eip_config(config: dict, region_id: str) -> EipConfiguration:
+    return EipConfiguration(
+        RegionId=region_id,
+        BandWidth=config["BandWidth"],
+        InstanceChargeType=config["InstanceChargeType"],
+        InternetChargeType=config["InternetChargeType"],
+        ISP=config["ISP"],
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -114,7 +403,17 @@ def parse_args():
 
     parser.add_argument("--secrets", "-s")
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--profile",
+        help="Write a timeline of the api calls, waits and phases to this file in the Chrome trace format and print a summary",
+    )
+
+    parser.add_argument(
+        "--metrics-out",
+        help="Write api call metrics to this file on exit, as JSON if it ends with .json and in the Prometheus text format otherwise",
+    )
+
+    return parser.parse_args(argv)
 
 
 def load_config_and_unbind_allocate_and_bind_new_eip(
@@ -122,7 +421,7 @@ def load_config_and_unbind_allocate_and_bind_new_eip(
     quiet: bool,
     release_old_eip: bool = True,
     allocate_new_eip: bool = True,
-) -> Optional[EcsInstance]:
+) -> Optional[RebindReport]:
     _print = get_print(quiet)
 
     client, config, target_ecs = get_client_config_and_ecs()
@@ -131,33 +430,48 @@ def load_config_and_unbind_allocate_and_bind_new_eip(
         return None
     _print("Ecs instance found")
     p(verbose, asdict(target_ecs))
-    eip_config = EipConfiguration(
-        RegionId=target_ecs.RegionId,
-        BandWidth=config["BandWidth"],
-        InstanceChargeType=config["InstanceChargeType"],
-        InternetChargeType=config["InternetChargeType"],
-        ISP=config["ISP"],
-    )
-    unbind_allocate_and_bind_new_eip(
-        client,
-        target_ecs,
-        eip_config,
-        not quiet and verbose,
-        quiet,
-        release_old_eip,
-        allocate_new_eip,
-    )
-
+    eip_config = get_eip_config(config, target_ecs.RegionId)
+    with eip_pools() as pools:
+        return unbind_allocate_and_bind_new_eip(
+            client,
+            target_ecs,
+            eip_config,
+            not quiet and verbose,
+            quiet,
+            release_old_eip,
+            allocate_new_eip,
+            pool=pool_for(pools, client, config, target_ecs.RegionId),
+        )
 
-def main():
-    args = parse_args()
 
+def run(args: argparse.Namespace) -> None:
     update_config(args.secrets, args.config)
+    add_state_listener(StateSnapshot(SNAPSHOT))
 
     load_config_and_unbind_allocate_and_bind_new_eip(
         args.verbose, args.quiet, True, True
     )
 
 
+def main(argv: Optional[List[str]] = None):
+    # The agent passes the argv of the command it runs
+    argv = sys.argv[1:] if argv is None else argv
+    exit_code = forward(TOOL_NAME, argv)
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+    args = parse_args(argv)
+    if args.profile is not None:
+        tracer.start()
+    try:
+        with tracer.span(f"{TOOL_NAME}", "command"):
+            run(args)
+    finally:
+        if args.metrics_out is not None:
+            metrics.dump(args.metrics_out)
+        if args.profile is not None:
+            tracer.finish(args.profile)
+
+
 if __name__ == "__main__":
     main()
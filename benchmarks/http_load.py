@@ -0,0 +1,149 @@
+import argparse
+import statistics
+import threading
+from time import monotonic
+from typing import Callable, Dict, List, Tuple
+
+from aliyun_scripts.lib.actions import _describe_ecs_batches, _describe_eip_batches
+from aliyun_scripts.lib.fake_client import FakeAcsClient, lognormal
+from aliyun_scripts.lib.fake_server import FakeAcsServer
+from aliyun_scripts.lib.resilience import resilience
+from aliyun_scripts.lib.utils import acs_req
+
+ACCESS_KEY_ID = "load-test"
+SECRET = "load-test-secret"
+
+
+def add_ecs(fake: FakeAcsClient, count: int) -> List[str]:
+    return [fake.add_ecs(eip=True) for _ in range(count)]
+
+
+def add_eips(fake: FakeAcsClient, count: int) -> List[str]:
+    return [fake.add_eip() for _ in range(count)]
+
+
+# Sent with acs_req directly, so neither the describe cache nor the coalescing
+# of identical requests hides any request
+def describe_ecs(client, ids: List[str]) -> dict:
+    from aliyunsdkecs.request.v20140526.DescribeInstancesRequest import (
+        DescribeInstancesRequest,
+    )
+
+    (batch,) = _describe_ecs_batches(ids, None, None)
+    return acs_req(client, DescribeInstancesRequest(), batch)
+
+
+def describe_eip(client, ids: List[str]) -> dict:
+    from aliyunsdkvpc.request.v20160428.DescribeEipAddressesRequest import (
+        DescribeEipAddressesRequest,
+    )
+
+    (batch,) = _describe_eip_batches(None, None, ids)
+    return acs_req(client, DescribeEipAddressesRequest(), batch)
+
+
+# How the described resources are created, and how they are described
+ACTIONS: Dict[str, Tuple[Callable, Callable]] = {
+    "describe-ecs": (add_ecs, describe_ecs),
+    "describe-eip": (add_eips, describe_eip),
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Send signed requests through the real AcsClient to a local fake endpoint"
+    )
+    parser.add_argument("action", nargs="?", default="describe-ecs", choices=ACTIONS)
+    parser.add_argument("--threads", "-t", type=int, default=8)
+    parser.add_argument("--requests", "-n", type=int, default=2000)
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0,
+        help="Median server side latency, drawn from a log-normal distribution",
+    )
+    parser.add_argument(
+        "--instances",
+        type=int,
+        default=20,
+        help="Ecs or eips in the fake account, every request describes all of them",
+    )
+    parser.add_argument(
+        "--client-per-request",
+        action="store_true",
+        help="Create a new AcsClient for every request instead of sharing one",
+    )
+    parser.add_argument(
+        "--pool-size", type=int, default=10, help="Connection pool size of the client"
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="Hedge slow describes as the tools do, the extra requests are counted separately",
+    )
+    args = parser.parse_args()
+
+    # A hedge is a second request for the same call, so it would skew the
+    # requests/s and latencies unless asked for
+    resilience.configure(hedge=args.hedge)
+    fake = FakeAcsClient(latency=lognormal(args.latency_ms / 1000))
+    add, action = ACTIONS[args.action]
+    ids = add(fake, args.instances)
+
+    with FakeAcsServer(fake, {ACCESS_KEY_ID: SECRET}) as server:
+        shared = server.connect(ACCESS_KEY_ID, pool_size=args.pool_size)
+        latencies: List[float] = []
+        errors = 0
+        lock = threading.Lock()
+        remaining = iter(range(args.requests))
+
+        def worker() -> None:
+            nonlocal errors
+            while True:
+                with lock:
+                    if next(remaining, None) is None:
+                        return
+                client = (
+                    server.connect(ACCESS_KEY_ID, pool_size=args.pool_size)
+                    if args.client_per_request
+                    else shared
+                )
+                started = monotonic()
+                try:
+                    action(client, ids)
+                except Exception:
+                    with lock:
+                        errors += 1
+                    continue
+                elapsed = monotonic() - started
+                with lock:
+                    latencies.append(elapsed)
+
+        started = monotonic()
+        threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_time = monotonic() - started
+
+    print(f"{args.action}: {args.requests} requests, {args.threads} threads")
+    print(f"  requests/s: {len(latencies) / wall_time:10.1f}")
+    if len(latencies) > 0:
+        print(f"         p50: {percentile(latencies, 0.5) * 1000:10.2f} ms")
+        print(f"         p99: {percentile(latencies, 0.99) * 1000:10.2f} ms")
+        print(f"        mean: {statistics.mean(latencies) * 1000:10.2f} ms")
+    print(f"      errors: {errors:10d}")
+    print(f"   api calls: {sum(fake.calls.values()):10d}")
+    if args.hedge:
+        stats = resilience.stats()
+        print(f"      hedged: {stats['hedged']:10d} ({stats['hedge wins']} won)")
+
+
+if __name__ == "__main__":
+    main()
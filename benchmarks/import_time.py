@@ -0,0 +1,99 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+ENTRY_POINTS = {
+    "aliyun-ecs": "aliyun_scripts.tools.ecs_tool",
+    "aliyun-eip": "aliyun_scripts.tools.eip_tool",
+    "aliyun-ui": "aliyun_scripts.gui.app",
+    "aliyun-agent": "aliyun_scripts.tools.agent",
+    "aliyun-batch": "aliyun_scripts.tools.batch_tool",
+}
+FORBIDDEN_PREFIXES = ("aliyunsdk",)
+
+
+def measure(module: str) -> Tuple[float, Dict[str, Tuple[int, int]]]:
+    # Run `<entry point> --help` in a fresh interpreter and collect the
+    # -X importtime breakdown, in microseconds
+    code = (
+        "import sys\n"
+        f"sys.argv = ['{module}', '--help']\n"
+        f"from {module} import main\n"
+        "try:\n"
+        "    main()\n"
+        "except SystemExit:\n"
+        "    pass\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+        # Measure the in-process path even if an agent is running
+        env={**os.environ, "ALIYUN_NO_AGENT": "1"},
+    )
+    modules: Dict[str, Tuple[int, int]] = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+        # Top level imports are not indented, their cumulative time covers the rest
+        if not name.startswith("  "):
+            total += int(cumulative_us)
+    return total / 1000, modules
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure the cold-start import time of the console entry points"
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=200,
+        help="Fail if the median import time of an entry point exceeds this",
+    )
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    failures: List[str] = []
+    for entry_point, module in ENTRY_POINTS.items():
+        try:
+            runs = [measure(module) for _ in range(args.runs)]
+        except subprocess.CalledProcessError as e:
+            print(f"{entry_point}: skipped, failed to import\n{e.stderr}")
+            continue
+        median_ms = statistics.median(total for total, _ in runs)
+        modules = runs[-1][1]
+        print(f"{entry_point} --help: {median_ms:.1f} ms (budget {args.budget_ms} ms)")
+        for name, (self_us, cumulative_us) in sorted(
+            modules.items(), key=lambda item: item[1][0], reverse=True
+        )[: args.top]:
+            print(
+                f"  {self_us / 1000:8.2f} ms self {cumulative_us / 1000:8.2f} ms  {name.strip()}"
+            )
+
+        forbidden = [
+            name.strip()
+            for name in modules
+            if name.strip().startswith(FORBIDDEN_PREFIXES)
+        ]
+        if len(forbidden) > 0:
+            failures.append(f"{entry_point} imports the sdk at startup: {forbidden[0]}")
+        if median_ms > args.budget_ms:
+            failures.append(f"{entry_point} takes {median_ms:.1f} ms to import")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import argparse
+import statistics
+from time import monotonic
+from typing import Callable, Dict, List, Optional
+
+from aliyun_scripts.lib import utils
+from aliyun_scripts.lib.actions import get_available_ecs, shutdown_ecs, start_ecs
+from aliyun_scripts.lib.cache import describe_cache
+from aliyun_scripts.lib.executor import shutdown_many, start_many
+from aliyun_scripts.lib.fake_client import FakeAcsClient, constant, lognormal
+from aliyun_scripts.lib.instances import EcsStatus, EipStatus
+from aliyun_scripts.lib.polling import TransitionHistory
+from aliyun_scripts.lib.resilience import resilience
+from aliyun_scripts.lib.throttle import scheduler
+from aliyun_scripts.tools.eip_tool import (
+    get_eip_config,
+    rebind_many,
+    unbind_allocate_and_bind_new_eip,
+    unbind_release,
+)
+
+EIP_CONFIG = {
+    "BandWidth": 5,
+    "InstanceChargeType": "PostPaid",
+    "InternetChargeType": "PayByTraffic",
+    "ISP": "BGP",
+}
+
+# A scenario prepares the fake account and returns the workflow to be timed,
+# the workflow may return extra measurements such as the rebind downtime
+Workflow = Callable[[], Optional[Dict[str, float]]]
+Scenario = Callable[[FakeAcsClient, int], Workflow]
+
+
+def rebind(client: FakeAcsClient, n: int) -> Workflow:
+    ecs = get_available_ecs(client, client.add_ecs(eip=True))[0]
+
+    def run() -> Dict[str, float]:
+        report = unbind_allocate_and_bind_new_eip(
+            client,
+            ecs,
+            get_eip_config(EIP_CONFIG, ecs.RegionId),
+            False,
+            True,
+            True,
+            True,
+        )
+        return {"downtime": report.downtime}
+
+    return run
+
+
+def release(client: FakeAcsClient, n: int) -> Workflow:
+    ecs = get_available_ecs(client, client.add_ecs(eip=True))[0]
+    return lambda: unbind_release(client, ecs, True, False, True)
+
+
+def start(client: FakeAcsClient, n: int) -> Workflow:
+    ecs = get_available_ecs(client, client.add_ecs(status=EcsStatus.stopped))[0]
+
+    def run() -> None:
+        start_ecs(client, ecs)
+        utils.wait_ecs_status(client, ecs, EcsStatus.running)
+
+    return run
+
+
+def stop(client: FakeAcsClient, n: int) -> Workflow:
+    ecs = get_available_ecs(client, client.add_ecs())[0]
+
+    def run() -> None:
+        shutdown_ecs(client, ecs, "StopCharging")
+        utils.wait_ecs_status(client, ecs, EcsStatus.stopped)
+
+    return run
+
+
+def _check(results) -> None:
+    failed = [result for result in results if not result.ok]
+    if len(failed) > 0:
+        raise RuntimeError(f"{len(failed)} ecs failed, e.g. {failed[0].error!r}")
+
+
+def start_n(client: FakeAcsClient, n: int) -> Workflow:
+    ecs_list = get_available_ecs(
+        client, [client.add_ecs(status=EcsStatus.stopped) for _ in range(n)]
+    )
+    return lambda: _check(start_many(client, ecs_list))
+
+
+def stop_n(client: FakeAcsClient, n: int) -> Workflow:
+    ecs_list = get_available_ecs(client, [client.add_ecs() for _ in range(n)])
+    return lambda: _check(shutdown_many(client, ecs_list, "StopCharging"))
+
+
+def rebind_n(client: FakeAcsClient, n: int) -> Workflow:
+    ecs_list = get_available_ecs(client, [client.add_ecs(eip=True) for _ in range(n)])
+
+    def run() -> Dict[str, float]:
+        results = rebind_many(client, ecs_list, EIP_CONFIG, False, True)
+        _check(results)
+        return {"max downtime": max(result.result.downtime for result in results)}
+
+    return run
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    "rebind": rebind,
+    "release": release,
+    "start": start,
+    "stop": stop,
+    "start-n": start_n,
+    "stop-n": stop_n,
+    "rebind-n": rebind_n,
+}
+
+
+def measure(
+    scenario: Scenario, make_client: Callable[[], FakeAcsClient], n: int, runs: int
+) -> Dict[str, List[float]]:
+    samples: Dict[str, List[float]] = {"seconds": []}
+    for _ in range(runs):
+        # Every run starts from a new account and nothing learned by earlier runs
+        describe_cache.clear()
+        scheduler.reset()
+        resilience.reset()
+        utils.transition_history = TransitionHistory()
+        client = make_client()
+        workflow = scenario(client, n)
+        started = monotonic()
+        extra = workflow()
+        samples["seconds"].append(monotonic() - started)
+        for name, value in (extra or {}).items():
+            samples.setdefault(name, []).append(value)
+        samples.setdefault("api calls", []).append(sum(client.calls.values()))
+    return samples
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Time the ecs and eip workflows end to end against a fake account"
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        metavar="scenario",
+        help=f"Any of {', '.join(SCENARIOS)}, all of them by default",
+    )
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--instances", "-n", type=int, default=20, help="Size of the *-n scenarios"
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=50,
+        help="Median api latency, drawn from a log-normal distribution",
+    )
+    parser.add_argument(
+        "--ecs-transition", type=float, default=2, help="Seconds to start or stop"
+    )
+    parser.add_argument(
+        "--eip-transition", type=float, default=0.5, help="Seconds to bind or unbind"
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0,
+        help="Probability that an api call is rejected with a Throttling error",
+    )
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if len(unknown) > 0:
+        parser.error(f"unknown scenario {unknown[0]}")
+
+    def make_client() -> FakeAcsClient:
+        return FakeAcsClient(
+            latency=lognormal(args.latency_ms / 1000),
+            transition_delays={
+                EcsStatus.starting.value: constant(args.ecs_transition),
+                EcsStatus.stopping.value: constant(args.ecs_transition),
+                EipStatus.associating.value: constant(args.eip_transition),
+                EipStatus.unassociating.value: constant(args.eip_transition),
+            },
+            throttle_rate=args.throttle_rate,
+        )
+
+    for name in args.scenarios or list(SCENARIOS):
+        samples = measure(SCENARIOS[name], make_client, args.instances, args.runs)
+        title = f"{name} (n={args.instances})" if name.endswith("-n") else name
+        print(title)
+        for metric, values in samples.items():
+            print(
+                f"  {metric:>14}: median {statistics.median(values):8.2f}"
+                f"  min {min(values):8.2f}  max {max(values):8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,9 @@ setup(
         "aliyun-python-sdk-ecs==4.24.3",
         "aliyun-python-sdk-vpc==3.0.14",
     ],
+    extras_require={
+        "async": ["aiohttp>=3.7"],
+    },
     packages=find_packages(),
     project_urls={
         "Source": "https://github.com/PIG208/aliyun-script",
@@ -20,6 +23,8 @@ setup(
             "aliyun-ecs=aliyun_scripts.tools.ecs_tool:main",
             "aliyun-eip=aliyun_scripts.tools.eip_tool:main",
             "aliyun-ui=aliyun_scripts.gui.app:main",
+            "aliyun-agent=aliyun_scripts.tools.agent:main",
+            "aliyun-batch=aliyun_scripts.tools.batch_tool:main",
         ],
     },
 )
@@ -0,0 +1,23 @@
+import pytest
+
+from aliyun_scripts.lib import eip_pool, utils
+from aliyun_scripts.lib.cache import describe_cache
+from aliyun_scripts.lib.metrics import metrics
+from aliyun_scripts.lib.polling import TransitionHistory
+from aliyun_scripts.lib.resilience import resilience
+from aliyun_scripts.lib.throttle import scheduler
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    # Fake clients reuse the same ids, nothing may carry over between tests
+    describe_cache.clear()
+    scheduler.reset()
+    resilience.reset()
+    metrics.reset()
+    monkeypatch.setattr(eip_pool, "_claimed_eips", set())
+    # configure() replaces these, the next test gets the defaults back
+    monkeypatch.setattr(scheduler, "rates", dict(scheduler.rates))
+    monkeypatch.setattr(resilience, "policy", resilience.policy)
+    # Keeps the waits of the tests out of ~/.aliyun_scripts
+    monkeypatch.setattr(utils, "transition_history", TransitionHistory())
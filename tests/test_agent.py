@@ -0,0 +1,164 @@
+import json
+import os
+import socket
+import threading
+from time import monotonic, sleep
+
+import pytest
+
+from aliyun_scripts.lib import actions
+from aliyun_scripts.lib.clients import clients
+from aliyun_scripts.lib.fake_client import FakeAcsClient
+from aliyun_scripts.tools import agent, ecs_tool
+
+CONFIG = {
+    "InstanceChargeType": "PostPaid",
+    "InternetChargeType": "PayByTraffic",
+    "BandWidth": 5,
+    "ISP": "BGP",
+}
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeAcsClient()
+    monkeypatch.setattr(clients, "get", lambda *args: fake)
+    return fake
+
+
+@pytest.fixture
+def start_agent(tmp_path, monkeypatch):
+    (tmp_path / "secrets.json").write_text(
+        json.dumps(
+            {"accessKey_id": "id", "accessKey_secret": "secret", "region_id": "cn"}
+        )
+    )
+    monkeypatch.setattr(ecs_tool, "SNAPSHOT", str(tmp_path / "state.json"))
+    monkeypatch.setattr(actions, "_state_listeners", [])
+    monkeypatch.setattr(agent, "_serving", False)
+    threads = []
+
+    # Started by the test itself, pytest swaps sys.stdout between setup and
+    # the test and the agent routes it for its commands
+    def start_agent() -> str:
+        path = str(tmp_path / "agent.sock")
+        server = agent.Agent(path, idle_timeout=0.5)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        threads.append(thread)
+        deadline = monotonic() + 5
+        while not os.path.exists(path):
+            assert monotonic() < deadline
+            sleep(0.01)
+        return path
+
+    yield start_agent
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+
+
+def send(path: str, request: dict) -> list:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        conn.sendall(json.dumps(request).encode() + b"\n")
+        return [json.loads(line) for line in conn.makefile("rb")]
+
+
+def command(cwd, tool: str, *argv: str) -> dict:
+    return {
+        "version": agent.PROTOCOL_VERSION,
+        "tool": tool,
+        "argv": list(argv),
+        "cwd": str(cwd),
+    }
+
+
+def output(messages: list) -> str:
+    return "".join(message.get("out", "") for message in messages)
+
+
+def test_unknown_requests_fall_back_to_running_in_process(start_agent, tmp_path):
+    socket_path = start_agent()
+    request = command(tmp_path, "aliyun-ecs", "-s", "status")
+
+    assert send(socket_path, {**request, "version": 0}) == [{"fallback": True}]
+    assert send(socket_path, {**request, "tool": "rm"}) == [{"fallback": True}]
+
+
+def test_commands_run_in_the_callers_directory(start_agent, tmp_path, fake):
+    socket_path = start_agent()
+    instance_id = fake.add_ecs()
+    (tmp_path / "config.json").write_text(json.dumps({**CONFIG, "Target": instance_id}))
+
+    messages = send(
+        socket_path,
+        command(
+            tmp_path,
+            "aliyun-ecs",
+            *("-s", "status", "-c", "config.json", "-a", "secrets.json"),
+        ),
+    )
+
+    assert messages[-1] == {"exit": 0}
+    assert f"The status of {instance_id}" in output(messages)
+
+
+def test_the_exit_code_of_a_failed_command_is_sent_back(start_agent, tmp_path, fake):
+    socket_path = start_agent()
+    (tmp_path / "config.json").write_text(json.dumps({**CONFIG, "Target": "i-gone"}))
+
+    messages = send(
+        socket_path,
+        command(
+            tmp_path,
+            "aliyun-ecs",
+            *("-s", "status", "-c", "config.json", "-a", "secrets.json"),
+        ),
+    )
+
+    assert messages[-1] == {"exit": 1}
+    assert "The ecs i-gone does not exist" in output(messages)
+
+
+def test_read_only_commands_run_side_by_side(start_agent, tmp_path, fake):
+    socket_path = start_agent()
+    fake.latency = 0.5
+    instance_ids = [fake.add_ecs(), fake.add_ecs()]
+    for i, instance_id in enumerate(instance_ids):
+        (tmp_path / f"config{i}.json").write_text(
+            json.dumps({**CONFIG, "Target": instance_id})
+        )
+    outputs = {}
+
+    def status(i: int) -> None:
+        outputs[i] = output(
+            send(
+                socket_path,
+                command(
+                    tmp_path,
+                    "aliyun-ecs",
+                    *("-s", "status", "-c", f"config{i}.json", "-a", "secrets.json"),
+                ),
+            )
+        )
+
+    started = monotonic()
+    threads = [threading.Thread(target=status, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert monotonic() - started < 0.9
+    for i, instance_id in enumerate(instance_ids):
+        assert instance_id in outputs[i]
+        assert instance_ids[1 - i] not in outputs[i]
+
+
+def test_only_describing_commands_are_read_only():
+    assert agent.is_read_only("aliyun-ecs", ["-s", "status", "-c", "config.json"])
+    assert agent.is_read_only("aliyun-ecs", ["--signal=ip"])
+    assert not agent.is_read_only("aliyun-ecs", ["-s", "stop"])
+    assert not agent.is_read_only("aliyun-ecs", ["-s", "ip", "--profile", "ip.json"])
+    assert not agent.is_read_only("aliyun-eip", [])
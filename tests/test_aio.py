@@ -0,0 +1,174 @@
+import asyncio
+from dataclasses import asdict
+
+import pytest
+from aliyunsdkcore.acs_exception.exceptions import ServerException
+
+from aliyun_scripts.lib import actions, aio_actions
+from aliyun_scripts.lib.aio import AsyncAcsClient
+from aliyun_scripts.lib.fake_client import FakeAcsClient
+from aliyun_scripts.lib.fake_server import PRODUCTS, FakeAcsServer
+from aliyun_scripts.lib.instances import EcsStatus
+from aliyun_scripts.lib.resilience import resilience
+from aliyun_scripts.lib.tracing import tracer
+
+ACCESS_KEY_ID = "test"
+REGION = "cn-hangzhou"
+
+
+class RecordingListener:
+    def __init__(self):
+        self.ecs = []
+        self.invalidations = []
+
+    def ecs_observed(self, ecs_list):
+        self.ecs.append([ecs.InstanceId for ecs in ecs_list])
+
+    def eip_observed(self, eip_list):
+        pass
+
+    def invalidated(self, instance_ids, allocation_ids):
+        self.invalidations.append(list(instance_ids))
+
+
+@pytest.fixture
+def fake():
+    return FakeAcsClient(transition_delays={EcsStatus.stopping.value: 0})
+
+
+@pytest.fixture
+def server(fake):
+    with FakeAcsServer(fake, {ACCESS_KEY_ID: "secret"}) as server:
+        yield server
+
+
+@pytest.fixture
+def listener():
+    listener = RecordingListener()
+    actions.add_state_listener(listener)
+    yield listener
+    actions.remove_state_listener(listener)
+
+
+def run(server, coroutine_function):
+    # Runs coroutine_function(client) with an async client of the fake server
+    async def main():
+        async with AsyncAcsClient(
+            ACCESS_KEY_ID, "secret", REGION, port=server.port
+        ) as client:
+            for product in PRODUCTS:
+                client.add_endpoint(REGION, product, server.server_address[0])
+            return await coroutine_function(client)
+
+    return asyncio.run(main())
+
+
+def test_describes_match_the_sync_path(fake, server):
+    ids = [fake.add_ecs(eip=True) for _ in range(3)]
+    fake.add_eip()
+    client = server.connect(ACCESS_KEY_ID)
+
+    async def describe(aclient):
+        return (
+            await aio_actions.get_available_ecs(aclient, ids, fresh=True),
+            await aio_actions.get_available_eip(aclient, fresh=True),
+        )
+
+    ecs_list, eip_list = run(server, describe)
+
+    assert [asdict(ecs) for ecs in ecs_list] == [
+        asdict(ecs) for ecs in actions.get_available_ecs(client, ids, fresh=True)
+    ]
+    assert [asdict(eip) for eip in eip_list] == [
+        asdict(eip) for eip in actions.get_available_eip(client, fresh=True)
+    ]
+
+
+def test_describes_are_cached_and_reported(fake, server, listener):
+    instance_id = fake.add_ecs()
+
+    async def describe_twice(aclient):
+        await aio_actions.get_available_ecs(aclient, instance_id)
+        await aio_actions.get_available_ecs(aclient, instance_id)
+
+    run(server, describe_twice)
+
+    assert fake.calls["DescribeInstances"] == 1
+    assert listener.ecs == [[instance_id]]
+
+
+def test_mutations_invalidate_the_cache(fake, server, listener):
+    instance_id = fake.add_ecs()
+
+    async def stop(aclient):
+        await aio_actions.get_available_ecs(aclient, instance_id)
+        await aio_actions.shutdown_ecs(aclient, instance_id, "StopCharging")
+        return await aio_actions.get_available_ecs(aclient, instance_id)
+
+    (ecs,) = run(server, stop)
+
+    assert ecs.Status == EcsStatus.stopped.value
+    assert listener.invalidations == [[instance_id]]
+
+
+def test_transient_describe_errors_are_retried(fake, server):
+    instance_id = fake.add_ecs()
+    fake.fail("DescribeInstances")
+
+    (ecs,) = run(
+        server, lambda aclient: aio_actions.get_available_ecs(aclient, instance_id)
+    )
+
+    assert ecs.InstanceId == instance_id
+    assert fake.calls["DescribeInstances"] == 2
+    assert resilience.stats()["retries"] == 1
+
+
+def test_mutations_are_not_retried(fake, server):
+    instance_id = fake.add_ecs()
+    fake.fail("StopInstance")
+
+    with pytest.raises(ServerException):
+        run(
+            server,
+            lambda aclient: aio_actions.shutdown_ecs(
+                aclient, instance_id, "StopCharging"
+            ),
+        )
+    assert fake.calls["StopInstance"] == 1
+
+
+def test_slow_describes_are_hedged(fake, server):
+    instance_id = fake.add_ecs()
+    latencies = iter([0.5])
+    fake.latency = lambda: next(latencies, 0)
+    resilience.configure(default_hedge_delay=0.05)
+
+    (ecs,) = run(
+        server, lambda aclient: aio_actions.get_available_ecs(aclient, instance_id)
+    )
+
+    assert ecs.InstanceId == instance_id
+    assert resilience.stats()["hedged"] == 1
+    assert resilience.stats()["hedge wins"] == 1
+
+
+def test_calls_are_traced(fake, server):
+    instance_id = fake.add_ecs()
+    tracer.start()
+    try:
+        run(
+            server,
+            lambda aclient: asyncio.gather(
+                aio_actions.get_available_ecs(aclient, instance_id),
+                aio_actions.get_regions(aclient),
+            ),
+        )
+    finally:
+        tracer.stop()
+
+    spans = {span.name: span for span in tracer.spans()}
+    assert {"DescribeInstances", "DescribeRegions", "http"} <= set(spans)
+    for name in ("DescribeInstances", "DescribeRegions"):
+        # Each action has its own http exchange nested in it
+        assert 0 < spans[name].children <= spans[name].duration
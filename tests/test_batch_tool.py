@@ -0,0 +1,106 @@
+import io
+import json
+
+from aliyun_scripts.lib.fake_client import FakeAcsClient
+from aliyun_scripts.lib.instances import EcsStatus
+from aliyun_scripts.tools.batch_tool import BatchRunner
+
+
+def run_batch(fake: FakeAcsClient, *commands: dict, concurrency: int = 4) -> list:
+    out = io.StringIO()
+    runner = BatchRunner(fake, {"Target": []}, concurrency=concurrency, out=out)
+    for line_number, command in enumerate(commands, start=1):
+        runner.submit(line_number, json.dumps(command))
+    runner.wait()
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_commands_on_the_same_ecs_run_in_input_order():
+    fake = FakeAcsClient(
+        transition_delays={
+            EcsStatus.stopping.value: 0.2,
+            EcsStatus.starting.value: 0.2,
+        }
+    )
+    instance_id = fake.add_ecs()
+
+    results = run_batch(
+        fake,
+        {"id": "stop", "signal": "stop", "target": instance_id},
+        {"id": "start", "signal": "start", "target": instance_id},
+        {"id": "status", "signal": "status", "target": instance_id},
+    )
+
+    assert [result["id"] for result in results] == ["stop", "start", "status"]
+    assert all(result["ok"] for result in results)
+    assert results[-1]["result"]["Status"] == EcsStatus.running.value
+
+
+def test_commands_on_other_ecs_do_not_wait_for_each_other():
+    fake = FakeAcsClient(transition_delays={EcsStatus.stopping.value: 1})
+    slow = fake.add_ecs()
+    fast = fake.add_ecs()
+
+    results = run_batch(
+        fake,
+        {"id": "stop", "signal": "stop", "target": slow},
+        {"id": "ip", "signal": "ip", "target": fast},
+    )
+
+    assert [result["id"] for result in results] == ["ip", "stop"]
+
+
+def test_a_failed_command_does_not_stop_the_next_one_on_the_ecs():
+    fake = FakeAcsClient()
+    instance_id = fake.add_ecs()
+    fake.fail("StopInstance", "IncorrectInstanceStatus", 403)
+
+    results = run_batch(
+        fake,
+        {"id": "stop", "signal": "stop", "target": instance_id},
+        {"id": "status", "signal": "status", "target": instance_id},
+        {"id": "typo", "signal": "reboot", "target": instance_id},
+    )
+
+    assert {result["id"]: result["ok"] for result in results} == {
+        "stop": False,
+        "status": True,
+        "typo": False,
+    }
+
+
+def test_a_waiting_command_does_not_hold_a_worker():
+    fake = FakeAcsClient(transition_delays={EcsStatus.stopping.value: 1})
+    slow = fake.add_ecs()
+    fast = fake.add_ecs()
+
+    results = run_batch(
+        fake,
+        {"id": "stop", "signal": "stop", "target": slow},
+        {"id": "status", "signal": "status", "target": slow},
+        {"id": "ip", "signal": "ip", "target": fast},
+        concurrency=2,
+    )
+
+    assert [result["id"] for result in results] == ["ip", "stop", "status"]
+
+
+def test_the_instances_of_a_command_run_concurrently():
+    fake = FakeAcsClient()
+    fake.latency = 0.3
+    instance_ids = [fake.add_ecs() for _ in range(3)]
+
+    results = run_batch(
+        fake,
+        {
+            "id": "stop",
+            "signal": "stop",
+            "target": instance_ids,
+            "options": {"Wait": False},
+        },
+    )
+
+    assert results[0]["ok"]
+    assert [result["InstanceId"] for result in results[0]["result"]] == instance_ids
+    # One describe and the three stops side by side, instead of one by one
+    assert results[0]["seconds"] < 1
@@ -0,0 +1,52 @@
+import threading
+
+from aliyun_scripts.lib.actions import get_available_ecs, shutdown_ecs
+from aliyun_scripts.lib.cache import describe_cache
+from aliyun_scripts.lib.fake_client import FakeAcsClient
+from aliyun_scripts.lib.instances import EcsStatus
+
+
+class PausingFakeAcsClient(FakeAcsClient):
+    # Holds DescribeInstances after it has read the state, until resumed
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.described = threading.Event()
+        self.resume = threading.Event()
+        self.pause = False
+
+    def handle(self, action, params):
+        result = super().handle(action, params)
+        if action == "DescribeInstances" and self.pause:
+            self.pause = False
+            self.described.set()
+            self.resume.wait(5)
+        return result
+
+
+def test_describe_in_flight_during_change_is_not_cached():
+    describe_cache.clear()
+    client = PausingFakeAcsClient(transition_delays={EcsStatus.stopping.value: 0})
+    instance_id = client.add_ecs()
+
+    client.pause = True
+    reader = threading.Thread(target=get_available_ecs, args=(client, [instance_id]))
+    reader.start()
+    assert client.described.wait(5)
+    shutdown_ecs(client, instance_id, "StopCharging")
+    client.resume.set()
+    reader.join()
+
+    # The result read before StopInstance must not be served from the cache
+    (ecs,) = get_available_ecs(client, [instance_id])
+    assert ecs.Status == EcsStatus.stopped.value
+
+
+def test_cache_is_scoped_to_the_account():
+    describe_cache.clear()
+    client = FakeAcsClient()
+    other = FakeAcsClient()
+    other.get_access_key = lambda: "other-access-key"
+    instance_id = client.add_ecs()
+
+    assert len(get_available_ecs(client, [instance_id])) == 1
+    assert get_available_ecs(other, [instance_id]) == []
@@ -0,0 +1,109 @@
+import json
+import sys
+
+import pytest
+
+from aliyun_scripts.lib import actions, store, utils
+from aliyun_scripts.lib.actions import add_state_listener, get_available_ecs
+from aliyun_scripts.lib.clients import clients
+from aliyun_scripts.lib.fake_client import FakeAcsClient
+from aliyun_scripts.lib.instances import EipStatus
+from aliyun_scripts.tools import ecs_tool
+
+CONFIG = {
+    "InstanceChargeType": "PostPaid",
+    "InternetChargeType": "PayByTraffic",
+    "BandWidth": 5,
+    "ISP": "BGP",
+}
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeAcsClient(
+        transition_delays={
+            EipStatus.associating.value: 0,
+            EipStatus.unassociating.value: 0,
+        }
+    )
+    monkeypatch.setattr(clients, "get", lambda *args: fake)
+    return fake
+
+
+@pytest.fixture
+def run_tool(tmp_path, monkeypatch):
+    secrets = tmp_path / "secrets.json"
+    secrets.write_text(
+        json.dumps(
+            {"accessKey_id": "id", "accessKey_secret": "secret", "region_id": "cn"}
+        )
+    )
+    monkeypatch.setattr(ecs_tool, "SNAPSHOT", str(tmp_path / "state.json"))
+    monkeypatch.setattr(actions, "_state_listeners", [])
+    # The paths set by the tool would last for the rest of the tests
+    paths = utils._config_paths.set(utils._config_paths.get())
+
+    def run_tool(config: dict, *argv: str) -> None:
+        path = tmp_path / "config.json"
+        path.write_text(json.dumps({**CONFIG, **config}))
+        monkeypatch.setattr(
+            sys, "argv", ["aliyun-ecs", "-c", str(path), "-a", str(secrets), *argv]
+        )
+        ecs_tool.run(ecs_tool.parse_args())
+
+    yield run_tool
+    utils._config_paths.reset(paths)
+
+
+def test_rotate_allocates_on_demand_outside_the_agent(fake, run_tool):
+    instance_ids = [fake.add_ecs(eip=True) for _ in range(2)]
+
+    run_tool({"Target": instance_ids, "EipPoolSize": 3}, "-s", "rotate", "-q")
+
+    assert fake.calls["AllocateEipAddress"] == 2
+
+
+def test_status_is_answered_from_a_fresh_snapshot(fake, run_tool, capsys):
+    instance_id = fake.add_ecs()
+    run_tool({"Target": instance_id}, "-s", "status")
+    describes = fake.calls["DescribeInstances"]
+    capsys.readouterr()
+
+    run_tool({"Target": instance_id}, "-s", "status", "--max-age", "60")
+
+    assert fake.calls["DescribeInstances"] == describes
+    out = capsys.readouterr().out
+    assert "Running" in out
+    assert "from the local snapshot" in out
+
+
+def test_status_falls_back_to_the_api_when_an_ecs_is_not_in_the_snapshot(
+    fake, run_tool, capsys
+):
+    observed = fake.add_ecs()
+    run_tool({"Target": observed}, "-s", "status")
+    describes = fake.calls["DescribeInstances"]
+    capsys.readouterr()
+
+    run_tool({"Target": [observed, fake.add_ecs()]}, "-s", "status", "--max-age", "60")
+
+    assert fake.calls["DescribeInstances"] == describes + 1
+    assert "from the local snapshot" not in capsys.readouterr().out
+
+
+def test_status_is_answered_from_the_agents_inventory(
+    fake, run_tool, monkeypatch, capsys
+):
+    inventory = store.InventoryStore()
+    monkeypatch.setattr(store, "hosted_inventory", inventory)
+    instance_id = fake.add_ecs()
+    run_tool({"Target": instance_id}, "-s", "status")
+    add_state_listener(inventory)
+    describes = fake.calls["DescribeInstances"]
+    get_available_ecs(fake, instance_id, fresh=True)
+    capsys.readouterr()
+
+    run_tool({"Target": instance_id}, "-s", "status", "--max-age", "60")
+
+    assert fake.calls["DescribeInstances"] == describes + 1
+    assert "from the agent's inventory" in capsys.readouterr().out
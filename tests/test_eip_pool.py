@@ -0,0 +1,50 @@
+from time import monotonic, sleep
+
+from aliyun_scripts.lib.eip_pool import EipPool, claim_eip, unclaim_eip
+from aliyun_scripts.lib.fake_client import FakeAcsClient
+from aliyun_scripts.lib.instances import EipConfiguration
+
+CONFIG = EipConfiguration(
+    RegionId="cn-hangzhou",
+    BandWidth=5,
+    InstanceChargeType="PostPaid",
+    InternetChargeType="PayByTraffic",
+    ISP="BGP",
+)
+
+
+def wait_for(condition, timeout: float = 5) -> None:
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline
+        sleep(0.01)
+
+
+def test_an_eip_is_claimed_by_one_caller_at_a_time():
+    assert claim_eip("eip-1")
+    assert not claim_eip("eip-1")
+    unclaim_eip("eip-1")
+    assert claim_eip("eip-1")
+
+
+def test_pool_adopts_matching_eips_and_hands_them_out_claimed():
+    fake = FakeAcsClient()
+    other = fake.add_eip(bandwidth=10)
+    matching = fake.add_eip()
+    pool = EipPool(fake, CONFIG, size=1, refill_interval=0.05)
+    pool.start()
+    try:
+        wait_for(lambda: len(pool) == 1)
+        eip = pool.acquire()
+
+        assert eip.AllocationId == matching
+        assert not claim_eip(matching)
+        assert claim_eip(other)
+        assert pool.stats()["adopted"] == 1
+        # Refilled with an eip of its own once the adopted one is taken
+        wait_for(lambda: len(pool) == 1)
+        assert pool.stats()["allocated"] == 1
+    finally:
+        pool.stop(release=True)
+
+    assert fake.calls["ReleaseEipAddress"] == 1
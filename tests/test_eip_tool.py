@@ -0,0 +1,84 @@
+import pytest
+from aliyunsdkcore.acs_exception.exceptions import ServerException
+
+from aliyun_scripts.lib.actions import get_available_ecs
+from aliyun_scripts.lib.fake_client import FakeAcsClient
+from aliyun_scripts.lib.instances import EipStatus
+from aliyun_scripts.tools.eip_tool import (
+    get_eip_config,
+    rebind_many,
+    unbind_allocate_and_bind_new_eip,
+)
+
+CONFIG = {
+    "InstanceChargeType": "PostPaid",
+    "InternetChargeType": "PayByTraffic",
+    "BandWidth": 5,
+    "ISP": "BGP",
+}
+
+
+@pytest.fixture
+def fake():
+    return FakeAcsClient(
+        transition_delays={
+            EipStatus.associating.value: 0,
+            EipStatus.unassociating.value: 0,
+        }
+    )
+
+
+def rebind(fake: FakeAcsClient, instance_id: str):
+    ecs = get_available_ecs(fake, instance_id)[0]
+    return unbind_allocate_and_bind_new_eip(
+        fake, ecs, get_eip_config(CONFIG, ecs.RegionId), False, True, True, True
+    )
+
+
+def bound_eip(fake: FakeAcsClient, instance_id: str) -> str:
+    return get_available_ecs(fake, instance_id, fresh=True)[0].EipAddress.AllocationId
+
+
+def test_old_eip_is_bound_back_when_allocating_fails(fake):
+    instance_id = fake.add_ecs(eip=True)
+    old_eip = bound_eip(fake, instance_id)
+    fake.fail("AllocateEipAddress", "QuotaExceeded.Eip", 403)
+
+    with pytest.raises(ServerException):
+        rebind(fake, instance_id)
+
+    assert bound_eip(fake, instance_id) == old_eip
+
+
+def test_old_eip_is_bound_back_when_binding_fails(fake):
+    instance_id = fake.add_ecs(eip=True)
+    old_eip = bound_eip(fake, instance_id)
+    fake.fail("AssociateEipAddress", "Forbidden.RAM", 403)
+
+    with pytest.raises(ServerException):
+        rebind(fake, instance_id)
+
+    assert bound_eip(fake, instance_id) == old_eip
+
+
+def test_old_eip_is_reported_when_releasing_fails(fake):
+    instance_id = fake.add_ecs(eip=True)
+    old_eip = bound_eip(fake, instance_id)
+    fake.fail("ReleaseEipAddress", "Forbidden.RAM", 403)
+
+    report = rebind(fake, instance_id)
+
+    assert report.leaked_eip.AllocationId == old_eip
+    assert report.new_eip.AllocationId == bound_eip(fake, instance_id)
+    assert report.new_eip.AllocationId != old_eip
+
+
+def test_concurrent_rebinds_never_take_the_same_available_eip(fake):
+    ecs_list = get_available_ecs(fake, [fake.add_ecs(eip=True) for _ in range(2)])
+    fake.add_eip()
+
+    results = rebind_many(fake, ecs_list, CONFIG, False, True, concurrency=2)
+
+    new_eips = {result.result.new_eip.AllocationId for result in results}
+    assert len(new_eips) == 2
+    assert fake.calls["AllocateEipAddress"] == 1
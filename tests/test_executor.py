@@ -0,0 +1,67 @@
+import threading
+from time import sleep
+
+from aliyun_scripts.lib.executor import parse_budget, run_concurrently, run_rolling
+from aliyun_scripts.lib.instances import EcsInstance
+
+
+def make_ecs(n: int):
+    return [
+        EcsInstance(f"i-{i}", f"ecs-{i}", "Running", "cn-hangzhou") for i in range(n)
+    ]
+
+
+def test_run_concurrently_keeps_results_and_errors_in_order():
+    def func(ecs: EcsInstance) -> str:
+        if ecs.InstanceId == "i-1":
+            raise RuntimeError("broken")
+        return ecs.InstanceId
+
+    results = run_concurrently(func, make_ecs(3), concurrency=2)
+
+    assert [result.target.InstanceId for result in results] == ["i-0", "i-1", "i-2"]
+    assert [result.ok for result in results] == [True, False, True]
+    assert results[0].result == "i-0"
+    assert isinstance(results[1].error, RuntimeError)
+
+
+def test_run_rolling_stops_starting_ecs_once_the_budget_is_spent():
+    def func(ecs: EcsInstance) -> None:
+        if ecs.InstanceId in ("i-0", "i-1"):
+            raise RuntimeError("broken")
+
+    rollout = run_rolling(func, make_ecs(5), max_in_flight=1, max_failures=1)
+
+    assert [result.target.InstanceId for result in rollout.results] == ["i-0", "i-1"]
+    assert [ecs.InstanceId for ecs in rollout.skipped] == ["i-2", "i-3", "i-4"]
+    assert rollout.aborted
+    assert len(rollout.failed) == 2
+
+
+def test_run_rolling_keeps_at_most_max_in_flight_busy():
+    lock = threading.Lock()
+    in_flight = [0]
+    peak = [0]
+
+    def func(ecs: EcsInstance) -> str:
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return ecs.InstanceId
+
+    reported = []
+    rollout = run_rolling(func, make_ecs(6), max_in_flight=2, cb=reported.append)
+
+    assert peak[0] == 2
+    assert not rollout.aborted
+    assert [result.result for result in rollout.results] == [f"i-{i}" for i in range(6)]
+    assert len(reported) == 6
+
+
+def test_parse_budget():
+    assert parse_budget("3", 10) == 3
+    assert parse_budget("25%", 10) == 2
+    assert parse_budget("0%", 10) == 0
@@ -0,0 +1,40 @@
+import pytest
+
+from aliyun_scripts.lib.fake_client import FakeAcsClient
+from aliyun_scripts.lib.instances import EcsStatus
+from aliyun_scripts.lib.poller import StatusPoller
+from aliyun_scripts.lib.polling import WaitPolicy
+
+
+def stopping(fake: FakeAcsClient) -> str:
+    instance_id = fake.add_ecs()
+    fake.handle("StopInstance", {"InstanceId": instance_id})
+    return instance_id
+
+
+def test_failing_callback_only_fails_its_own_waiter():
+    fake = FakeAcsClient(transition_delays={EcsStatus.stopping.value: 0.5})
+    poller = StatusPoller(fake)
+    policy = WaitPolicy(first_delay=0.1, initial_interval=0.1, jitter=0)
+
+    def broken():
+        raise RuntimeError("broken callback")
+
+    other = poller.wait_ecs(stopping(fake), EcsStatus.stopped, 10, None, policy)
+    failing = poller.wait_ecs(stopping(fake), EcsStatus.stopped, 10, broken, policy)
+
+    with pytest.raises(RuntimeError, match="broken callback"):
+        failing.result(5)
+    assert other.result(5) == EcsStatus.stopped.value
+
+
+def test_waiters_follow_their_own_backoff():
+    fake = FakeAcsClient(transition_delays={EcsStatus.stopping.value: 2.2})
+    poller = StatusPoller(fake)
+    policy = WaitPolicy(first_delay=0.5, initial_interval=2, jitter=0)
+
+    future = poller.wait_ecs(stopping(fake), EcsStatus.stopped, 10, None, policy)
+
+    assert future.result(5) == EcsStatus.stopped.value
+    # Polled right away, after the first delay and after the first interval
+    assert fake.calls["DescribeInstances"] == 3
@@ -0,0 +1,119 @@
+import threading
+from time import monotonic, sleep
+
+import pytest
+
+from aliyun_scripts.lib.exceptions import CircuitOpenError
+from aliyun_scripts.lib.fake_client import FakeApiError
+from aliyun_scripts.lib.polling import WaitPolicy
+from aliyun_scripts.lib.resilience import ResiliencePolicy, ResilientCaller
+
+ENDPOINT = "ecs.cn-hangzhou.aliyuncs.com"
+BACKOFF = WaitPolicy(first_delay=0.01, initial_interval=0.01)
+
+
+def unavailable():
+    raise FakeApiError("ServiceUnavailable", "Try again later", 503)
+
+
+def caller(**policy) -> ResilientCaller:
+    return ResilientCaller(ResiliencePolicy(retry_backoff=BACKOFF, **policy))
+
+
+def test_circuit_opens_after_transient_failures_in_a_row():
+    resilience = caller(failure_threshold=2, cooldown=60)
+    for _ in range(2):
+        with pytest.raises(FakeApiError):
+            resilience.call("StopInstance", ENDPOINT, unavailable, monotonic() + 5)
+
+    calls = []
+    with pytest.raises(CircuitOpenError):
+        resilience.call("StopInstance", ENDPOINT, lambda: calls.append(1), 0)
+    assert calls == []
+    assert resilience.stats()["circuits opened"] == 1
+    assert resilience.stats()["rejected"] == 1
+
+
+def test_circuit_closes_after_a_successful_trial():
+    resilience = caller(failure_threshold=1, cooldown=0.05)
+    with pytest.raises(FakeApiError):
+        resilience.call("StopInstance", ENDPOINT, unavailable, monotonic() + 5)
+    sleep(0.05)
+
+    assert resilience.call("StopInstance", ENDPOINT, lambda: "ok", 0) == "ok"
+    assert resilience.breaker(ENDPOINT).state == "closed"
+
+
+def test_only_describe_actions_are_retried():
+    resilience = caller(max_attempts=3, failure_threshold=10)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            unavailable()
+        return "ok"
+
+    deadline = monotonic() + 5
+    assert resilience.call("DescribeInstances", ENDPOINT, flaky, deadline) == "ok"
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(FakeApiError):
+        resilience.call("StopInstance", ENDPOINT, flaky, deadline)
+    assert len(calls) == 1
+
+
+def slow_first_attempt(delay: float):
+    release = threading.Event()
+
+    def send(hedge: bool) -> str:
+        if hedge:
+            return "hedge"
+        release.wait(delay)
+        return "first"
+
+    return send, release
+
+
+def test_slow_describe_is_hedged():
+    resilience = caller(default_hedge_delay=0.05)
+    send, release = slow_first_attempt(5)
+
+    result = resilience.exchange(
+        "DescribeInstances", ENDPOINT, send, monotonic() + 5, lambda: True
+    )
+    release.set()
+
+    assert result == "hedge"
+    assert resilience.stats()["hedged"] == 1
+    assert resilience.stats()["hedge wins"] == 1
+
+
+def test_no_hedge_without_a_token_to_spare():
+    resilience = caller(default_hedge_delay=0.05)
+    send, _ = slow_first_attempt(0.2)
+
+    result = resilience.exchange(
+        "DescribeInstances", ENDPOINT, send, monotonic() + 5, lambda: False
+    )
+
+    assert result == "first"
+    assert resilience.stats()["hedged"] == 0
+
+
+def test_mutations_are_never_hedged():
+    resilience = caller(default_hedge_delay=0)
+    attempts = []
+
+    def send(hedge: bool) -> str:
+        attempts.append(hedge)
+        sleep(0.1)
+        return "done"
+
+    result = resilience.exchange(
+        "StopInstance", ENDPOINT, send, monotonic() + 5, lambda: True
+    )
+
+    assert result == "done"
+    assert attempts == [False]
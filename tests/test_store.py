@@ -0,0 +1,64 @@
+import pytest
+
+from aliyun_scripts.lib import actions
+from aliyun_scripts.lib.actions import (
+    add_state_listener,
+    get_available_ecs,
+    unbind_eip_from_ecs,
+)
+from aliyun_scripts.lib.fake_client import FakeAcsClient
+from aliyun_scripts.lib.instances import EipStatus
+from aliyun_scripts.lib.store import InventoryStore
+
+
+@pytest.fixture
+def fake():
+    return FakeAcsClient(transition_delays={EipStatus.unassociating.value: 0})
+
+
+@pytest.fixture
+def store(monkeypatch):
+    monkeypatch.setattr(actions, "_state_listeners", [])
+    store = InventoryStore()
+    add_state_listener(store)
+    return store
+
+
+def test_describes_are_indexed(fake, store):
+    instance_id = fake.add_ecs(eip=True)
+
+    ecs = get_available_ecs(fake, instance_id, fresh=True)[0]
+
+    assert store.get_ecs(instance_id).Status == ecs.Status
+    assert store.ecs_by_ip(ecs.EipAddress.IpAddress).InstanceId == instance_id
+    in_use = store.find_eips(status=EipStatus.in_use.value)
+    assert [eip.AllocationId for eip in in_use] == [ecs.EipAddress.AllocationId]
+
+
+def test_an_unbound_eip_leaves_the_in_use_index(fake, store):
+    instance_id = fake.add_ecs(eip=True)
+    ecs = get_available_ecs(fake, instance_id, fresh=True)[0]
+    old_eip = unbind_eip_from_ecs(fake, ecs)
+
+    get_available_ecs(fake, instance_id, fresh=True)
+
+    assert store.find_eips(status=EipStatus.in_use.value) == []
+    available = store.find_eips(status=EipStatus.available.value)
+    assert [eip.AllocationId for eip in available] == [old_eip.AllocationId]
+    assert store.get_eip(old_eip.AllocationId).InstanceId is None
+    assert store.ecs_by_ip(old_eip.IpAddress) is None
+
+
+def test_changed_ecs_are_not_answered_until_described_again(fake, store):
+    instance_id = fake.add_ecs(eip=True)
+    ecs = get_available_ecs(fake, instance_id, fresh=True)[0]
+    recent, _ = store.get_recent_ecs([instance_id], 60)[0]
+    assert recent.EipAddress.IpAddress == ecs.EipAddress.IpAddress
+
+    unbind_eip_from_ecs(fake, ecs)
+    assert store.get_recent_ecs([instance_id], 60) is None
+
+    get_available_ecs(fake, instance_id, fresh=True)
+    recent, _ = store.get_recent_ecs([instance_id], 60)[0]
+    assert recent.EipAddress is None
+    assert store.get_recent_ecs([instance_id], 0) is None
@@ -0,0 +1,72 @@
+from time import monotonic
+
+import pytest
+
+from aliyun_scripts.lib.fake_client import FakeApiError
+from aliyun_scripts.lib.polling import WaitPolicy
+from aliyun_scripts.lib.throttle import RequestScheduler, TokenBucket
+
+BACKOFF = WaitPolicy(first_delay=0.01, initial_interval=0.01, timeout=5)
+
+
+def test_only_configured_actions_are_limited():
+    scheduler = RequestScheduler({"DescribeInstances": 1}, burst=1)
+
+    assert [
+        scheduler.bucket("StopInstance", "cn-hangzhou").reserve() for _ in range(50)
+    ] == [0] * 50
+    limited = scheduler.bucket("DescribeInstances", "cn-hangzhou")
+    assert limited.reserve() == 0
+    assert limited.reserve() > 0.9
+
+
+def throttling_then(result, failures: int):
+    calls = []
+
+    def send():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise FakeApiError("Throttling.User", "Request was denied")
+        return result
+
+    return send, calls
+
+
+def test_throttling_errors_are_retried_with_backoff():
+    scheduler = RequestScheduler(backoff=BACKOFF)
+    send, calls = throttling_then("ok", 2)
+
+    assert scheduler.call("StopInstance", "cn-hangzhou", send) == "ok"
+    assert len(calls) == 3
+    assert scheduler.retries == 2
+    assert scheduler.bucket("StopInstance", "cn-hangzhou").throttled_count == 2
+
+
+def test_other_errors_are_not_retried():
+    scheduler = RequestScheduler(backoff=BACKOFF)
+
+    def send():
+        raise FakeApiError("InvalidInstanceId.NotFound", "Not found", 404)
+
+    with pytest.raises(FakeApiError):
+        scheduler.call("StopInstance", "cn-hangzhou", send)
+    assert scheduler.retries == 0
+
+
+def test_no_retry_is_started_past_the_deadline():
+    scheduler = RequestScheduler(backoff=BACKOFF)
+    send, calls = throttling_then("ok", 1)
+
+    with pytest.raises(FakeApiError):
+        scheduler.call("StopInstance", "cn-hangzhou", send, deadline=monotonic())
+    assert len(calls) == 1
+
+
+def test_configured_rate_slows_down_and_recovers():
+    bucket = TokenBucket(4, 1)
+
+    bucket.throttled()
+    assert bucket.rate == 2
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == 4
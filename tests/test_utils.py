@@ -0,0 +1,22 @@
+from aliyun_scripts.lib.fake_client import FakeAcsClient
+from aliyun_scripts.lib.utils import get_missing_ids, get_target_ecs
+
+
+def test_missing_targets_are_reported():
+    client = FakeAcsClient()
+    first = client.add_ecs()
+    second = client.add_ecs()
+    config = {"Target": [second, "i-typo", first]}
+
+    ecs_list = get_target_ecs(client, config)
+
+    assert [ecs.InstanceId for ecs in ecs_list] == [second, first]
+    assert get_missing_ids(config, ecs_list) == ["i-typo"]
+
+
+def test_tag_selector_misses_nothing():
+    client = FakeAcsClient()
+    client.add_ecs(tags={"env": "prod"})
+    config = {"Target": {"Tags": {"env": "prod"}}}
+
+    assert get_missing_ids(config, get_target_ecs(client, config)) == []